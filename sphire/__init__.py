@@ -26,6 +26,10 @@
 # *
 # **************************************************************************
 
+import sys
+import time
+import threading
+
 import pwem
 import pyworkflow.utils as pwutils
 from pyworkflow.utils import runJob
@@ -42,6 +46,12 @@ class Plugin(pwem.Plugin):
     _pathVars = [CRYOLO_CUDA_LIB]
     _url = 'https://github.com/scipion-em/scipion-em-sphire'
     _supportedVersions = VERSIONS
+    # Results of probing crYOLO environments, by activation command
+    _envProbes = {}
+    _envProbesLock = threading.Lock()
+    ENV_PROBE_TTL = 300  # seconds
+    ENV_PROBE_TIMEOUT = 120  # seconds
+    ENV_PROBE_FAST_TIMEOUT = 10  # seconds, to not block the GUI
 
     @classmethod
     def _defineVariables(cls):
@@ -52,6 +62,7 @@ class Plugin(pwem.Plugin):
         cls._defineEmVar(JANNI_GENMOD_VAR, JANNI_GENMOD_DEFAULT)
         cls._defineEmVar(CRYOLO_NS_GENMOD_VAR, CRYOLO_NS_GENMOD_DEFAULT)
         cls._defineVar(CRYOLO_CUDA_LIB, pwem.Config.CUDA_LIB)
+        cls._defineVar(CRYOLO_FAKE, 'False')
 
     @classmethod
     def getCryoloEnvActivation(cls, useCpu=False):
@@ -60,10 +71,70 @@ class Plugin(pwem.Plugin):
 
     @classmethod
     def getActiveVersion(cls, *args):
-        """ Return the env name that is currently active. """
+        """ Return the crYOLO version installed in the active environment,
+        or the version in the env name if it could not be probed or it is
+        not a supported one (e.g. a development build). """
+        version = cls.probeCryoloEnv(useCpu=False)['version']
+        if version in cls._supportedVersions:
+            return version
         envVar = cls.getCryoloEnvActivation(useCpu=False)
         return envVar.split()[-1].split("-")[-1]
 
+    @classmethod
+    def probeCryoloEnv(cls, useCpu=False, ttl=None, timeout=None):
+        """ Check if the crYOLO environment can be activated and which
+        crYOLO version it has. Activating a conda environment takes some
+        seconds, so results are cached by activation command.
+        Params:
+            useCpu: probe the CPU environment instead of the GPU one.
+            ttl: seconds a cached result is valid (ENV_PROBE_TTL by default).
+            timeout: seconds to wait for the probe (ENV_PROBE_TIMEOUT by
+                default), use ENV_PROBE_FAST_TIMEOUT from the GUI.
+        Return a dict with 'exists' (None if unknown), 'version' (None if
+        unknown) and 'time' of the probe.
+        """
+        if cls.usingFakeCryolo():
+            return {'exists': True, 'version': None, 'time': time.time()}
+
+        ttl = cls.ENV_PROBE_TTL if ttl is None else ttl
+        timeout = cls.ENV_PROBE_TIMEOUT if timeout is None else timeout
+        activation = '%s %s' % (cls.getCondaActivationCmd(),
+                                cls.getCryoloEnvActivation(useCpu))
+        with cls._envProbesLock:
+            probe = cls._envProbes.get(activation)
+            if probe is None or time.time() - probe['time'] > ttl:
+                probe = cls._probeEnv(activation, timeout)
+                cls._envProbes[activation] = probe
+            return dict(probe)
+
+    @classmethod
+    def _probeEnv(cls, activation, timeout):
+        import subprocess
+        # Only the activation determines the exit code
+        cmd = f"{activation} && (pip show cryolo 2>/dev/null || true)"
+        try:
+            p = subprocess.run(cmd, shell=True, capture_output=True, text=True,
+                               env=cls.getEnviron(), timeout=timeout)
+            exists = p.returncode == 0
+            output = p.stdout
+        except subprocess.TimeoutExpired:
+            exists, output = None, ''
+        except OSError:
+            exists, output = False, ''
+
+        version = None
+        for line in output.splitlines():
+            if line.startswith('Version:'):
+                version = line.split(':', 1)[1].strip()
+
+        return {'exists': exists, 'version': version, 'time': time.time()}
+
+    @classmethod
+    def invalidateEnvProbes(cls):
+        """ Forget the cached environment probes, e.g. after installing. """
+        with cls._envProbesLock:
+            cls._envProbes.clear()
+
     @classmethod
     def getModelFn(cls, modelKey):
         return os.path.abspath(cls.getVar(modelKey))
@@ -178,14 +249,39 @@ class Plugin(pwem.Plugin):
             return False
         return True
 
+    @classmethod
+    def usingFakeCryolo(cls):
+        """ Return True if the stand-in crYOLO programs should be used
+        instead of the real ones (e.g. for load tests). """
+        return pwutils.strToBoolean(cls.getVar(CRYOLO_FAKE))
+
+    @classmethod
+    def getCryoloProgram(cls, program, useCpu=False):
+        """ Return the command to run a crYOLO program after
+        activating its environment. """
+        if cls.usingFakeCryolo():
+            fakeCryolo = os.path.join(os.path.dirname(__file__), 'fake_cryolo.py')
+            return f'{sys.executable} {fakeCryolo} {program}'
+
+        return '%s %s && %s' % (cls.getCondaActivationCmd(),
+                                cls.getCryoloEnvActivation(useCpu), program)
+
     @classmethod
     def runCryolo(cls, protocol, program, args, cwd=None, useCpu=False):
         """ Run crYOLO command from a given protocol. """
-        fullProgram = '%s %s && %s' % (cls.getCondaActivationCmd(),
-                                       cls.getCryoloEnvActivation(useCpu), program)
+        fullProgram = cls.getCryoloProgram(program, useCpu)
         protocol.runJob(fullProgram, args, env=cls.getEnviron(), cwd=cwd,
                         numberOfMpi=1)
 
+    @classmethod
+    def runJanni(cls, protocol, inputDir, outputDir, gpuId, model=None):
+        """ Run JANNI denoising over the micrographs in inputDir.
+        Denoised micrographs are written by JANNI in a subfolder of
+        outputDir with the same name as inputDir. """
+        model = model or cls.getModelFn(JANNI_GENMOD_VAR)
+        args = f"denoise -g {gpuId} {inputDir}/ {outputDir}/ {model}"
+        cls.runCryolo(protocol, 'janni_denoise.py', args)
+
     @classmethod
     def runNapariBoxManager(cls, tmpDir, program, args):
         """ Run Napari boxmanager from a given protocol. """
@@ -54,6 +54,10 @@ CRYOLO_ENV_ACTIVATION_CPU = 'CRYOLO_ENV_ACTIVATION_CPU'
 
 CRYOLO_CUDA_LIB = 'CRYOLO_CUDA_LIB'
 
+# Run the stand-in crYOLO/JANNI programs of fake_cryolo.py instead of
+# the real ones (load tests), see there the timing variables
+CRYOLO_FAKE = 'CRYOLO_FAKE'
+
 
 # Model constants
 def _modelFn(modelKey):
@@ -31,6 +31,7 @@ import numpy as np
 
 logger = logging.getLogger(__name__)
 import os
+from concurrent.futures import ThreadPoolExecutor
 from emtable import Table
 
 import pyworkflow.utils as pwutils
@@ -62,14 +63,18 @@ class CoordBoxWriter:
         self._file = open(filename, 'a+')
 
     def writeCoord(self, coord):
+        self.writeBox(coord.getX(), coord.getY(),
+                      getattr(coord, '_cryoloScore', 0.0))
+
+    def writeBox(self, x, y, score=0.0):
+        """ Write the box centered at x, y. """
         box = self._boxSize
         half = self._halfBox
-        x = coord.getX() - half
+        x = x - half
         if self._yFlipHeight is None:
-            y = coord.getY() - half
+            y = y - half
         else:
-            y = self._yFlipHeight - coord.getY() - half
-        score = getattr(coord, '_cryoloScore', 0.0)
+            y = self._yFlipHeight - y - half
         self._file.write("%s\t%s\t%s\t%s\t%s\n" % (x, y, box, box, score))
 
     def writeCoordinate3DHeader(self):
@@ -92,15 +97,20 @@ _NumBoxes #11
         self._file.write(HEADER)
 
     def writeCoord3D(self, coord3d):
+        self.writeBox3D(coord3d.getX(BOTTOM_LEFT_CORNER),
+                        coord3d.getY(BOTTOM_LEFT_CORNER),
+                        coord3d.getZ(BOTTOM_LEFT_CORNER),
+                        coord3d.getGroupId())
+
+    def writeBox3D(self, x, y, z, groupId):
+        """ Write the box centered at x, y (bottom left corner origin). """
         box = self._boxSize
         half = self._halfBox
-        x = coord3d.getX(BOTTOM_LEFT_CORNER) - half
+        x = x - half
         if self._yFlipHeight is None:
-            y = coord3d.getY(BOTTOM_LEFT_CORNER) - half
+            y = y - half
         else:
-            y = self._yFlipHeight - coord3d.getY(BOTTOM_LEFT_CORNER) - half
-        z = coord3d.getZ(BOTTOM_LEFT_CORNER)
-        groupId = coord3d.getGroupId()
+            y = self._yFlipHeight - y - half
         self._file.write("%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\n"
                          % (x, y, z, box, box, box, groupId, box, box, box, 10))
 
@@ -169,41 +179,210 @@ class CoordBoxReader:
                 yield tuple(map(round, row[:3])) + (0.0, 0.0, 32)
 
 
-def writeSetOfCoordinates(boxDir, coordSet, micList=None):
+CBOX_2D_HEADER = """
+data_cryolo
+
+loop_
+_CoordinateX #1
+_CoordinateY #2
+_Width #3
+_Height #4
+_EstWidth #5
+_EstHeight #6
+_Confidence #7
+_NumBoxes #8
+"""
+
+
+def readCboxBoxes(filename):
+    """ Read the boxes of a 2D .cbox file into a numpy array.
+    Returns an array with one row per box and the columns:
+    x, y, width, height, confidence (x, y are the box corner as
+    written by crYOLO).
+    """
+    boxes = [(row.CoordinateX, row.CoordinateY,
+              row.get('Width', 0), row.get('Height', row.get('Width', 0)),
+              row.get('Confidence', 0.0))
+             for row in Table.iterRows(filename, tableName='cryolo')]
+    return np.array(boxes, dtype=float).reshape(-1, 5)
+
+
+def writeCboxBoxes(filename, boxes, numBoxes=None):
+    """ Write boxes (as returned by readCboxBoxes or fuseBoxes) into
+    a 2D .cbox file that crYOLO and CoordBoxReader can read.
+    """
+    if numBoxes is None:
+        numBoxes = np.ones(len(boxes), dtype=int)
+
+    with open(filename, 'w') as f:
+        f.write(CBOX_2D_HEADER)
+        for (x, y, w, h, score), n in zip(boxes, numBoxes):
+            f.write("%0.2f\t%0.2f\t%d\t%d\t%d\t%d\t%0.4f\t%d\n"
+                    % (x, y, round(w), round(h), round(w), round(h), score, n))
+
+
+def fuseBoxes(boxesList, iouThreshold=0.5, numModels=None):
+    """ Fuse boxes predicted by several models on the same micrograph
+    using weighted box fusion.
+    Boxes from all models are visited by decreasing confidence and merged
+    into the best overlapping cluster (IoU >= iouThreshold). The candidate
+    clusters are looked up in a spatial hash grid, so each box is only
+    compared against its neighbours.
+    Params:
+        boxesList: list with one array per model, as returned by
+            readCboxBoxes (x, y, width, height, confidence).
+        iouThreshold: minimum IoU to merge a box into a cluster.
+        numModels: number of models in the ensemble, if None it is
+            the length of boxesList.
+    Returns:
+        a tuple (boxes, numBoxes) with the fused boxes and the number of
+        boxes merged in each of them. The fused confidence is the sum of
+        the confidences divided by the number of models, so boxes picked
+        by only some of the models are penalized.
+    """
+    nModels = numModels or len(boxesList)
+    allBoxes = [b for b in boxesList if len(b)]
+    if not allBoxes:
+        return np.zeros((0, 5)), np.zeros(0, dtype=int)
+
+    boxes = np.concatenate(allBoxes)
+    boxes = boxes[np.argsort(-boxes[:, 4], kind='stable')]
+    centers = boxes[:, :2] + boxes[:, 2:4] / 2.0
+    cellSize = max(boxes[:, 2:4].max(), 1.0)
+    cells = np.floor(centers / cellSize).astype(int)
+
+    n = len(boxes)
+    # Fused clusters: center x, y, width, height and accumulators
+    fused = np.zeros((n, 4))
+    weighted = np.zeros((n, 4))
+    weights = np.zeros(n)
+    scores = np.zeros(n)
+    counts = np.zeros(n, dtype=int)
+    nClusters = 0
+    grid = {}
+
+    for i in range(n):
+        cx, cy = cells[i]
+        candidates = [c for dx in (-1, 0, 1) for dy in (-1, 0, 1)
+                      for c in grid.get((cx + dx, cy + dy), [])]
+        best = -1
+        if candidates:
+            candidates = np.array(candidates)
+            iou = _boxesIou(centers[i], boxes[i, 2:4],
+                            fused[candidates, :2], fused[candidates, 2:4])
+            j = np.argmax(iou)
+            if iou[j] >= iouThreshold:
+                best = candidates[j]
+
+        if best < 0:
+            best = nClusters
+            nClusters += 1
+            grid.setdefault((cx, cy), []).append(best)
+
+        weight = max(boxes[i, 4], 1e-6)
+        weighted[best, :2] += weight * centers[i]
+        weighted[best, 2:4] += weight * boxes[i, 2:4]
+        weights[best] += weight
+        scores[best] += boxes[i, 4]
+        counts[best] += 1
+        fused[best] = weighted[best] / weights[best]
+
+    fused, scores, counts = fused[:nClusters], scores[:nClusters], counts[:nClusters]
+    result = np.empty((nClusters, 5))
+    result[:, :2] = fused[:, :2] - fused[:, 2:4] / 2.0
+    result[:, 2:4] = fused[:, 2:4]
+    result[:, 4] = scores / max(nModels, 1)
+
+    return result, counts
+
+
+def _boxesIou(center, size, centers, sizes):
+    """ Compute the IoU between one box and an array of boxes, all of
+    them given by their center and size. """
+    lo = np.maximum(center - size / 2.0, centers - sizes / 2.0)
+    hi = np.minimum(center + size / 2.0, centers + sizes / 2.0)
+    inter = np.prod(np.clip(hi - lo, 0, None), axis=1)
+    union = np.prod(size) + np.prod(sizes, axis=1) - inter
+    return inter / np.maximum(union, 1e-9)
+
+
+def selectDiverseSubset(features, n):
+    """ Select n rows of the features matrix (one row per micrograph)
+    that are as different as possible (greedy farthest point selection).
+    Features are normalized, so all of them have the same weight, and
+    the selection starts from the row with the highest first feature.
+    Return the indexes of the selected rows.
+    """
+    features = np.asarray(features, dtype=float)
+    if len(features) <= n:
+        return np.arange(len(features))
+
+    std = features.std(axis=0)
+    std[std == 0] = 1
+    norm = (features - features.mean(axis=0)) / std
+
+    selected = [int(np.argmax(features[:, 0]))]
+    minDist = np.linalg.norm(norm - norm[selected[0]], axis=1)
+
+    while len(selected) < n:
+        i = int(np.argmax(minDist))
+        selected.append(i)
+        minDist = np.minimum(minDist, np.linalg.norm(norm - norm[i], axis=1))
+
+    return np.array(selected)
+
+
+def writeSetOfCoordinates(boxDir, coordSet, micList=None, micIds=None):
     """ Convert a SetOfCoordinates to Cryolo box files.
     Params:
         boxDir: the output directory where to generate the files.
         coordSet: the input SetOfCoordinates that will be converted.
         micList: if not None, only coordinates from this micrographs
             will be written.
+        micIds: same as micList, but providing the micrograph ids.
     """
-    # Get the SOM (SetOfMicrographs)
-    micSet = coordSet.getMicrographs()
-    micIdSet = micSet.getIdSet() if micList is None else set(m.getObjId()
-                                                             for m in micList)
-
-    # Get first mic from mics
-    mic = micSet.getFirstItem()
-    # Get fileName from mic
-    writer = CoordBoxWriter(coordSet.getBoxSize(),
-                            getFlipYHeight(mic.getFileName()))
-    lastMicId = None
-    doWrite = True
-
-    # Loop through coordinates and generate box files
-    for coord in coordSet.iterItems(orderBy='_micId'):
-        micId = coord.getMicId()
-        mic = micSet[micId]
+    if micIds is None and micList is not None:
+        micIds = [m.getObjId() for m in micList]
+    boxes = readCoordBoxes(coordSet, micIds=micIds)
+    mic = coordSet.getMicrographs().getFirstItem()
+    writeCoordBoxes(boxDir, boxes, coordSet.getBoxSize(),
+                    getFlipYHeight(mic.getFileName()))
 
-        if micId != lastMicId:
-            doWrite = micId in micIdSet
-            if doWrite:
-                writer.open(os.path.join(boxDir, getMicFn(mic, "box")))
-            lastMicId = micId
 
-        if doWrite:
-            writer.writeCoord(coord)
+def readCoordBoxes(coordSet, micIds=None):
+    """ Read the coordinates of a SetOfCoordinates as plain data, that
+    can be written to box files from any thread with writeCoordBoxes.
+    Params:
+        coordSet: the input SetOfCoordinates.
+        micIds: if not None, only coordinates from these micrographs
+            will be read.
+    Return a dict with the box file name of each micrograph and the
+    list of (x, y, score) of its coordinates.
+    """
+    micSet = coordSet.getMicrographs()
+    micIdSet = None if micIds is None else set(micIds)
+    # Read the micrographs once, instead of looking up each coordinate
+    boxFiles = {mic.getObjId(): getMicFn(mic, "box") for mic in micSet
+                if micIdSet is None or mic.getObjId() in micIdSet}
+    boxes = {}
 
+    for coord in coordSet.iterItems(orderBy='_micId'):
+        boxFn = boxFiles.get(coord.getMicId())
+        if boxFn is not None:
+            score = getattr(coord, '_cryoloScore', None)
+            boxes.setdefault(boxFn, []).append(
+                (coord.getX(), coord.getY(), 0.0 if score is None else score.get()))
+
+    return boxes
+
+
+def writeCoordBoxes(boxDir, boxes, boxSize, yFlipHeight=None):
+    """ Write the box files of the coordinates read by readCoordBoxes. """
+    writer = CoordBoxWriter(boxSize, yFlipHeight)
+    for boxFn, coords in boxes.items():
+        writer.open(os.path.join(boxDir, boxFn))
+        for x, y, score in coords:
+            writer.writeBox(x, y, score)
     writer.close()
 
 
@@ -226,46 +405,102 @@ def readSetOfCoordinates3D(tomogram, coord3DSet, coordsFile, boxSize,
     coord3DSet.setBoxSize(boxSize if boxSize is not None else width)
 
 
-def writeSetOfCoordinates3D(boxDir, coord3DSet, tomoList=None):
+def deleteTomogramCoordinates3D(coord3DSet, tomogram):
+    """ Remove the coordinates of a tomogram from a set opened for append,
+    e.g. before reading them again from a modified file.
+    Return the number of coordinates removed.
+    """
+    # String literals go in single quotes, with quotes inside doubled
+    tsId = tomogram.getTsId().replace("'", "''")
+    coordIds = [coord.getObjId() for coord in
+                coord3DSet.iterItems(where="%s='%s'" % (Coordinate3D.TOMO_ID_ATTR,
+                                                         tsId))]
+    # Set has no public method to delete items
+    mapper = coord3DSet._getMapper()
+    for coordId in coordIds:
+        mapper.db.deleteObject(coordId)
+    coord3DSet._size.set(coord3DSet.getSize() - len(coordIds))
+
+    return len(coordIds)
+
+
+def writeSetOfCoordinates3D(boxDir, coord3DSet, tomoList=None, tomoIds=None):
     """ Convert a SetOfCoordinates to Cryolo cbox files.
     Params:
         boxDir: the output directory where to generate the files.
         coordSet: the input SetOfCoordinates that will be converted.
         tomoList: if not None, only coordinates from this micrographs
             will be written.
+        tomoIds: same as tomoList, but providing the tomogram ids.
+    """
+    if tomoIds is None and tomoList is not None:
+        tomoIds = [t.getObjId() for t in tomoList]
+    boxes = readCoordBoxes3D(coord3DSet, tomoIds=tomoIds)
+    writeCoordBoxes3D(boxDir, boxes, coord3DSet.getBoxSize())
+
+
+def readCoordBoxes3D(coord3DSet, tomoIds=None):
+    """ Same as readCoordBoxes, for a SetOfCoordinates3D.
+    Return a dict with the cbox file name of each tomogram and the list
+    of (x, y, z, groupId) of its coordinates.
     """
     tomoSet = coord3DSet.getPrecedents()
-    tomoIdSet = tomoSet.getIdSet() if tomoList is None else set(m.getObjId()
-                                                                for m in tomoList)
+    tomoIdSet = None if tomoIds is None else set(tomoIds)
+    boxFiles = {tomo.getObjId(): getMicFn(tomo, "cbox") for tomo in tomoSet
+                if tomoIdSet is None or tomo.getObjId() in tomoIdSet}
+    boxes = {}
+
+    for coord in coord3DSet.iterCoordinates():
+        boxFn = boxFiles.get(coord.getVolume().getObjId())
+        if boxFn is not None:
+            boxes.setdefault(boxFn, []).append(
+                (coord.getX(BOTTOM_LEFT_CORNER), coord.getY(BOTTOM_LEFT_CORNER),
+                 coord.getZ(BOTTOM_LEFT_CORNER), coord.getGroupId()))
+
+    return boxes
+
+
+def writeCoordBoxes3D(boxDir, boxes, boxSize):
+    """ Write the cbox files of the coordinates read by readCoordBoxes3D. """
+    writer = CoordBoxWriter(boxSize)
+    for boxFn, coords in boxes.items():
+        writer.open(os.path.join(boxDir, boxFn))
+        writer.writeCoordinate3DHeader()
+        zCoorList = []
+        for x, y, z, groupId in coords:
+            writer.writeBox3D(x, y, z, groupId)
+            if z not in zCoorList:
+                zCoorList.append(z)
+        writer.writeIncludeBlock(zCoorList)
+    writer.close()
+
 
+def writeTomogramCoordinates3D(boxDir, coord3DSet, tomo):
+    """ Convert the coordinates of a single tomogram to a Cryolo cbox file.
+    Only the coordinates of this tomogram are read from the set, so it is
+    much faster than writeSetOfCoordinates3D for a few tomograms of a big
+    set. The file is overwritten if it exists.
+    Return the number of coordinates written.
+    """
+    cboxFn = os.path.join(boxDir, getMicFn(tomo, "cbox"))
+    pwutils.cleanPath(cboxFn)
     writer = CoordBoxWriter(coord3DSet.getBoxSize())
-    lastTomoId = None
-    doWrite = True
+    writer.open(cboxFn)
+    writer.writeCoordinate3DHeader()
     zCoorList = []
-    for coord in coord3DSet.iterCoordinates():
-        tomoId = coord.getVolume().getObjId()
-        tomo = tomoSet[tomoId]
-
-        if tomoId != lastTomoId:
-            if lastTomoId is not None:
-                writer.writeIncludeBlock(zCoorList)
-            doWrite = tomoId in tomoIdSet
-            if doWrite:
-                zCoorList = []
-                writer.open(os.path.join(boxDir, getMicFn(tomo, "cbox")))
-                writer.writeCoordinate3DHeader()
-            lastTomoId = tomoId
-
-        if doWrite:
-            writer.writeCoord3D(coord)
-            zValue = coord.getZ(BOTTOM_LEFT_CORNER)
-            if zValue not in zCoorList:
-                zCoorList.append(zValue)
+    count = 0
+    for coord in coord3DSet.iterCoordinates(volume=tomo):
+        writer.writeCoord3D(coord)
+        zValue = coord.getZ(BOTTOM_LEFT_CORNER)
+        if zValue not in zCoorList:
+            zCoorList.append(zValue)
+        count += 1
 
     writer.writeIncludeBlock(zCoorList)
-
     writer.close()
 
+    return count
+
 
 def needToFlipOnY(filename):
     """ Returns true if we need to flip coordinates on Y"""
@@ -286,28 +521,48 @@ def getFlipYHeight(filename):
     return y if needToFlipOnY(filename) else None
 
 
-def convertMicrographs(micList, micDir):
+def convertMicrographs(micList, micDir, numberOfThreads=1):
     """ Convert (or simply link) input micrographs into the given directory
     in a format that is compatible with crYOLO.
+    Params:
+        micList: list of micrographs or any iterable over them (e.g. the
+            input set), items are not kept, so there is no need to clone.
+        micDir: output directory.
+        numberOfThreads: if greater than 1, images are converted
+            concurrently by this number of threads.
     """
     ih = ImageHandler()
-    ext = pwutils.getExt(micList[0].getFileName())
 
-    def _convert(mic, newName):
-        ih.convert(mic, os.path.join(micDir, newName))
+    def _convert(location, newName):
+        ih.convert(location, os.path.join(micDir, newName))
 
-    def _link(mic, newName):
-        pwutils.createAbsLink(os.path.abspath(mic.getFileName()),
+    def _link(location, newName):
+        pwutils.createAbsLink(os.path.abspath(location[1]),
                               os.path.join(micDir, newName))
 
-    if ext in constants.CRYOLO_SUPPORTED_FORMATS:
-        func = _link
+    func = ext = None
+
+    def _iterJobs():
+        nonlocal func, ext
+        for mic in micList:
+            if func is None:
+                ext = pwutils.getExt(mic.getFileName())
+                if ext in constants.CRYOLO_SUPPORTED_FORMATS:
+                    func = _link
+                else:
+                    func = _convert
+                    ext = '.mrc'
+            yield mic.getLocation(), getMicFn(mic, ext.lstrip("."))
+
+    if numberOfThreads > 1:
+        with ThreadPoolExecutor(max_workers=numberOfThreads) as executor:
+            futures = [executor.submit(func, loc, newName)
+                       for loc, newName in _iterJobs()]
+            for f in futures:
+                f.result()
     else:
-        func = _convert
-        ext = '.mrc'
-
-    for mic in micList:
-        func(mic, getMicFn(mic, ext.lstrip(".")))
+        for loc, newName in _iterJobs():
+            func(loc, newName)
 
 
 convertTomograms = convertMicrographs
@@ -0,0 +1,260 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Stand-in for the crYOLO and JANNI programs, used to load test the
+protocols without GPUs or a crYOLO installation. It accepts the same
+arguments used by the protocols and writes outputs with the same layout
+(CBOX, CBOX_3D, CBOX_FILAMENTS_TRACED, DISTR, trained model, denoised
+micrographs). The program to emulate is the first argument:
+
+    python fake_cryolo.py cryolo_predict.py -c config.json -w model.h5 -i ./ -o ./ -t 0.3
+
+Timing is configured with the environment variables CRYOLO_FAKE_STARTUP
+(seconds before processing any input) and CRYOLO_FAKE_LATENCY (seconds
+per image, or per image and epoch when training).
+
+Only the standard library is used, since the program runs in the crYOLO
+environment.
+"""
+
+import os
+import sys
+import json
+import time
+import struct
+import random
+import shutil
+import argparse
+
+CBOX_2D_HEADER = """
+data_cryolo
+
+loop_
+_CoordinateX #1
+_CoordinateY #2
+_Width #3
+_Height #4
+_EstWidth #5
+_EstHeight #6
+_Confidence #7
+_NumBoxes #8
+_filamentid #9
+"""
+CBOX_3D_HEADER = """
+data_cryolo
+
+loop_
+_CoordinateX #1
+_CoordinateY #2
+_CoordinateZ #3
+_Width #4
+_Height #5
+_Depth #6
+_filamentid #7
+_Confidence #8
+_EstWidth #9
+_EstHeight #10
+_NumBoxes #11
+"""
+IMAGE_EXTS = ('.mrc', '.mrcs', '.rec', '.tif', '.tiff', '.jpg')
+DEFAULT_DIMS = (4096, 4096, 1)
+DEFAULT_BOX_SIZE = 128
+BOXES_PER_IMAGE = 100
+
+
+def _getFloatEnv(varName, default=0.0):
+    return float(os.environ.get(varName, default))
+
+
+def _startup():
+    time.sleep(_getFloatEnv('CRYOLO_FAKE_STARTUP'))
+
+
+def _latency():
+    time.sleep(_getFloatEnv('CRYOLO_FAKE_LATENCY'))
+
+
+def _listImages(path):
+    if os.path.isfile(path):
+        return [path]
+    return sorted(os.path.join(path, fn) for fn in os.listdir(path)
+                  if fn.lower().endswith(IMAGE_EXTS))
+
+
+def _readDims(path):
+    """ Return (x, y, z) dimensions from the MRC header, or a
+    default micrograph size for other formats or invalid files. """
+    try:
+        with open(path, 'rb') as f:
+            dims = struct.unpack('<3i', f.read(12))
+        if all(0 < d < 100000 for d in dims):
+            return dims
+    except (OSError, struct.error):
+        pass
+    return DEFAULT_DIMS
+
+
+def _readConfig(configFn):
+    if configFn and os.path.exists(configFn):
+        with open(configFn) as f:
+            return json.load(f)
+    return {}
+
+
+def predict(args):
+    p = argparse.ArgumentParser(prog='cryolo_predict.py')
+    p.add_argument('-c', '--conf')
+    p.add_argument('-w', '--weights')
+    p.add_argument('-i', '--input', required=True)
+    p.add_argument('-o', '--output', required=True)
+    p.add_argument('-t', '--threshold', type=float, default=0.3)
+    p.add_argument('--tomogram', action='store_true')
+    p.add_argument('--filament', action='store_true')
+    opts, _ = p.parse_known_args(args)
+
+    # Like crYOLO, fail with models that can not be read
+    if opts.weights and os.path.isfile(opts.weights) and not os.path.getsize(opts.weights):
+        sys.exit(f"Unable to open the weights file {opts.weights}")
+
+    model = _readConfig(opts.conf).get('model', {})
+    boxSize = model.get('anchors', [DEFAULT_BOX_SIZE])[0]
+    maxBoxes = model.get('max_box_per_image', BOXES_PER_IMAGE)
+    threshold = min(max(opts.threshold, 0.0), 1.0)
+
+    if opts.filament:
+        cboxDir = 'CBOX_FILAMENTS_TRACED'
+    else:
+        cboxDir = 'CBOX_3D' if opts.tomogram else 'CBOX'
+    cboxDir = os.path.join(opts.output, cboxDir)
+    os.makedirs(cboxDir, exist_ok=True)
+
+    _startup()
+    images = _listImages(opts.input)
+    for image in images:
+        stem = os.path.splitext(os.path.basename(image))[0]
+        dims = _readDims(image)
+        # Same image always gets the same boxes
+        rand = random.Random(stem)
+        n = min(maxBoxes, rand.randint(BOXES_PER_IMAGE // 2, BOXES_PER_IMAGE))
+        with open(os.path.join(cboxDir, stem + '.cbox'), 'w') as f:
+            f.write(CBOX_3D_HEADER if opts.tomogram else CBOX_2D_HEADER)
+            for i in range(n):
+                x = rand.uniform(0, max(dims[0] - boxSize, 1))
+                y = rand.uniform(0, max(dims[1] - boxSize, 1))
+                score = rand.uniform(threshold, 1.0)
+                filamentId = i // 10 if opts.filament else 0
+                if opts.tomogram:
+                    z = rand.uniform(0, max(dims[2] - 1, 1))
+                    f.write("%0.2f\t%0.2f\t%0.2f\t%d\t%d\t%d\t%d\t%0.4f\t%d\t%d\t%d\n"
+                            % (x, y, z, boxSize, boxSize, boxSize, filamentId,
+                               score, boxSize, boxSize, 1))
+                else:
+                    f.write("%0.2f\t%0.2f\t%d\t%d\t%d\t%d\t%0.4f\t%d\t%d\n"
+                            % (x, y, boxSize, boxSize, boxSize, boxSize,
+                               score, 1, filamentId))
+        _latency()
+        print(f"Picked {n} particles in {image}", flush=True)
+
+    distrDir = os.path.join(opts.output, 'DISTR')
+    os.makedirs(distrDir, exist_ok=True)
+    distrFn = 'size_distribution_summary_%s.txt' % time.strftime('%Y%m%d-%H%M%S')
+    with open(os.path.join(distrDir, distrFn), 'w') as f:
+        f.write(f"MEAN,{boxSize}\nSD,0\nQ25,{boxSize}\n"
+                f"Q50,{boxSize}\nQ75,{boxSize}\n")
+
+
+def train(args):
+    p = argparse.ArgumentParser(prog='cryolo_train.py')
+    p.add_argument('-c', '--conf', required=True)
+    p.add_argument('-e', '--early', type=int, default=10)
+    opts, _ = p.parse_known_args(args)
+
+    config = _readConfig(opts.conf)
+    trainConfig = config.get('train', {})
+    nbEpoch = trainConfig.get('nb_epoch', 200)
+    imagesDir = trainConfig.get('train_image_folder', '')
+    steps = max(len(_listImages(imagesDir)) if os.path.isdir(imagesDir) else 0, 1)
+
+    _startup()
+    rand = random.Random(opts.conf)
+    best, wait = None, 0
+    for epoch in range(1, nbEpoch + 1):
+        t = time.time()
+        for _ in range(steps):
+            _latency()
+        # Loss decreases and then plateaus, so early stopping kicks in
+        loss = 1.0 / epoch + 0.2 + rand.uniform(0, 0.05)
+        valLoss = loss + rand.uniform(0, 0.1)
+        secs = round(time.time() - t)
+        print(f"Epoch {epoch}/{nbEpoch}")
+        print(f"{steps}/{steps} [==============================] - {secs}s "
+              f"- loss: {loss:0.4f} - val_loss: {valLoss:0.4f}", flush=True)
+        if best is None or valLoss < best - 0.01:
+            best, wait = valLoss, 0
+        else:
+            wait += 1
+            if wait >= opts.early:
+                print(f"Epoch {epoch:05d}: early stopping", flush=True)
+                break
+
+    with open(trainConfig.get('saved_weights_name', 'model.h5'), 'wb') as f:
+        f.write(os.urandom(1024))
+
+
+def denoise(args):
+    p = argparse.ArgumentParser(prog='janni_denoise.py')
+    p.add_argument('command', choices=['denoise'])
+    p.add_argument('-g', '--gpu')
+    p.add_argument('input')
+    p.add_argument('output')
+    p.add_argument('model')
+    opts, _ = p.parse_known_args(args)
+
+    # JANNI writes in a subfolder with the name of the input folder
+    outputDir = os.path.join(opts.output,
+                             os.path.basename(os.path.normpath(opts.input)))
+    os.makedirs(outputDir, exist_ok=True)
+
+    _startup()
+    for image in _listImages(opts.input):
+        shutil.copyfile(image, os.path.join(outputDir, os.path.basename(image)))
+        _latency()
+
+
+PROGRAMS = {
+    'cryolo_predict.py': predict,
+    'cryolo_train.py': train,
+    'janni_denoise.py': denoise
+}
+
+
+def main(argv):
+    if not argv or argv[0] not in PROGRAMS:
+        sys.exit(f"Usage: {os.path.basename(__file__)} "
+                 f"{{{','.join(PROGRAMS)}}} [args]")
+    PROGRAMS[argv[0]](argv[1:])
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -24,15 +24,29 @@
 # *
 # **************************************************************************
 
+import os
+import json
+
 import pyworkflow.object as pwobj
 from pwem import EMObject
 
 
 class CryoloModel(EMObject):
-    """ Simple class to store the Cryolo training model path. """
+    """ Simple class to store the Cryolo training model path.
+    It also keeps the content hash and size of the model file, the
+    architecture and input size used for training and the training
+    provenance, so models can be identified by their content.
+    """
     def __init__(self, path=None, **kwargs):
         EMObject.__init__(self, **kwargs)
         self._path = pwobj.String(path)
+        self._hash = pwobj.String()
+        self._size = pwobj.Integer()
+        self._mtime = pwobj.Float()
+        self._architecture = pwobj.String()
+        self._inputSize = pwobj.Integer()
+        self._provenance = pwobj.String()
+        self._benchmarks = pwobj.String()
 
     def getPath(self):
         return self._path.get()
@@ -40,5 +54,70 @@ class CryoloModel(EMObject):
     def setPath(self, path):
         self._path.set(path)
 
+    def getHash(self):
+        return self._hash.get()
+
+    def getFileSize(self):
+        return self._size.get()
+
+    def getArchitecture(self):
+        return self._architecture.get()
+
+    def setArchitecture(self, architecture):
+        self._architecture.set(architecture)
+
+    def getInputSize(self):
+        return self._inputSize.get()
+
+    def setInputSize(self, inputSize):
+        self._inputSize.set(inputSize)
+
+    def getProvenance(self):
+        """ Return a dict with the information about how the model
+        was obtained (e.g. imported file or training parameters). """
+        value = self._provenance.get()
+        return json.loads(value) if value else {}
+
+    def setProvenance(self, provenance):
+        self._provenance.set(json.dumps(provenance))
+
+    def getBenchmarks(self):
+        """ Return the list of speed measurements of this model, one dict
+        for each device and input size combination. """
+        value = self._benchmarks.get()
+        return json.loads(value) if value else []
+
+    def addBenchmark(self, benchmark):
+        """ Add a speed measurement, replacing the previous one with the
+        same device and input size. """
+        key = (benchmark.get('device'), benchmark.get('input_size'))
+        benchmarks = [b for b in self.getBenchmarks()
+                      if (b.get('device'), b.get('input_size')) != key]
+        benchmarks.append(benchmark)
+        self._benchmarks.set(json.dumps(benchmarks))
+
+    def setFileInfo(self, fileHash):
+        """ Store the content hash of the model file and its current
+        size and modification time. """
+        st = os.stat(self.getPath())
+        self._hash.set(fileHash)
+        self._size.set(st.st_size)
+        self._mtime.set(st.st_mtime)
+
+    def hasChanged(self):
+        """ Return True if the model file is not the one with the
+        stored hash, only checking the file size and modification time. """
+        if not self.getHash():
+            return True
+        try:
+            st = os.stat(self.getPath())
+        except OSError:
+            return True
+        return (st.st_size != self._size.get() or
+                st.st_mtime != self._mtime.get())
+
     def __str__(self):
-        return "CryoloModel(path=%s)" % self.getPath()
+        s = "CryoloModel(path=%s" % self.getPath()
+        if self.getHash():
+            s += ", hash=%s" % self.getHash()[:8]
+        return s + ")"
@@ -27,14 +27,18 @@
 from pyworkflow.utils import weakImport
 
 from .protocol_cryolo_training import SphireProtCRYOLOTraining
+from .protocol_cryolo_training_sweep import SphireProtCRYOLOTrainingSweep
 from .protocol_cryolo_picking import SphireProtCRYOLOPicking
 from .protocol_cryolo_import import SphireProtCryoloImport
+from .protocol_cryolo_benchmark import SphireProtCRYOLOBenchmark
 from .protocol_janni_denoise import SphireProtJanniDenoising
+from .protocol_janni_denoise_tasks import SphireProtJanniDenoisingTasks
 
 from .protocol_cryolo_picking_tasks import SphireProtCRYOLOPickingTasks
 
 with weakImport('tomo'):
     from .protocol_cryolo_tomo_picking import SphireProtCRYOLOTomoPicking
+    from .protocol_cryolo_tomo_picking_tasks import SphireProtCRYOLOTomoPickingTasks
     from .protocol_cryolo_napari_tomo_picking import SphireProtCRYOLONapariTomoPicker
     from .protocol_cryolo_tomo_training import SphireProtCRYOLOTomoTraining
 
@@ -156,16 +156,14 @@ class ProtCryoloBase(EMProtocol):
 
     # --------------------------- STEPS functions -----------------------------
     def createConfigStep(self, inputData):
+        with open(self._getExtraPath('config.json'), 'w') as fp:
+            json.dump(self.getConfigDict(inputData), fp, indent=4)
+
+    def getConfigDict(self, inputData):
+        """ Return the crYOLO configuration as a dict. """
         inputSize = convert.roundInputSize(self.input_size.get())
         maxBoxPerImage = self.max_box_per_image.get()
-        sampling = inputData.getSamplingRate()
-        nyquist = 2 * sampling
-        if self.absCutOffFreq.get() == -1:
-            absCutOfffreq = sampling / (sampling / 0.3)  # Recommended by cryolo
-        elif nyquist >= self.absCutOffFreq.get():
-            absCutOfffreq = 0.5
-        else:
-            absCutOfffreq = sampling/self.absCutOffFreq.get()
+        absCutOfffreq = self.getLowPassCutOff(inputData.getSamplingRate())
         model = {
             "architecture": "PhosaurusNet",
             "input_size": inputSize,
@@ -177,7 +175,8 @@ class ProtCryoloBase(EMProtocol):
             model.update({"anchors": [boxSize, boxSize]})
         if self.lowPassFilter:
             model.update({"filter": [absCutOfffreq, "filtered"]})
-        elif self.inputModelFrom == INPUT_MODEL_GENERAL_DENOISED:
+        elif (self.inputModelFrom == INPUT_MODEL_GENERAL_DENOISED and
+              not self.usingFusedDenoising()):
             model.update({"filter": [
                 Plugin.getModelFn(JANNI_GENMOD_VAR),
                 24,
@@ -213,8 +212,7 @@ class ProtCryoloBase(EMProtocol):
 
             jsonDict.update({"train": train, "valid": valid})
 
-        with open(self._getExtraPath('config.json'), 'w') as fp:
-            json.dump(jsonDict, fp, indent=4)
+        return jsonDict
 
     # --------------------------- INFO functions ------------------------------
     def _summary(self):
@@ -232,12 +230,17 @@ class ProtCryoloBase(EMProtocol):
             validateMsgs.append("Lowpass cannot be used with the JANNI-denoised model")
 
         if self.usingCpu():
-            if os.system(Plugin.getCondaActivationCmd() + Plugin.getVar(CRYOLO_ENV_ACTIVATION_CPU)):
+            probe = Plugin.probeCryoloEnv(useCpu=True,
+                                          timeout=Plugin.ENV_PROBE_FAST_TIMEOUT)
+            # Do not complain if activating it just took too long
+            if probe['exists'] is False:
                 validateMsgs.append("CPU implementation of crYOLO is not installed, "
                                     "install 'cryoloCPU' or use the GPU implementation.")
 
         else:
-            if self.getClassName() != "SphireProtCRYOLOTomoPicking" and self.numberOfThreads.get() < len(self.getGpuList()):
+            if (self.getClassName() not in ["SphireProtCRYOLOTomoPicking",
+                                            "SphireProtCRYOLOTomoPickingTasks"]
+                    and self.numberOfThreads.get() < len(self.getGpuList())):
                 validateMsgs.append("Multiple GPUs can not be used by a single process. "
                                     "Make sure you specify more threads than GPUs.")
 
@@ -294,6 +297,24 @@ class ProtCryoloBase(EMProtocol):
         else:
             return not self.useGpu.get()
 
+    def getLowPassCutOff(self, sampling):
+        """ Return the low-pass filter cut-off (digital frequency)
+        used by crYOLO for the given sampling rate. """
+        nyquist = 2 * sampling
+        if self.absCutOffFreq.get() == -1:
+            return sampling / (sampling / 0.3)  # Recommended by cryolo
+        elif nyquist >= self.absCutOffFreq.get():
+            return 0.5
+        else:
+            return sampling / self.absCutOffFreq.get()
+
+    def usingFusedDenoising(self):
+        """ Return True if the micrographs are denoised with JANNI by the
+        protocol before picking, instead of letting crYOLO filter them. """
+        return (not self._IS_TRAIN and
+                self.inputModelFrom == INPUT_MODEL_GENERAL_DENOISED and
+                self.getAttributeValue('fusedDenoising', False))
+
     def getInputModel(self):
         if self._IS_TRAIN:
             if self.inputModelFrom == INPUT_MODEL_GENERAL:
@@ -0,0 +1,150 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import json
+
+import pyworkflow.utils as pwutils
+import pyworkflow.protocol.params as params
+import pyworkflow.protocol.constants as cons
+from pwem.protocols import EMProtocol
+
+from .. import Plugin
+from ..utils import benchmarkPredictor
+import sphire.convert as convert
+
+
+class SphireProtCRYOLOBenchmark(EMProtocol):
+    """ Measure how fast a crYOLO model picks. The model runs over a fixed
+    sample of micrographs with the given input size and device, and the
+    startup time, per-micrograph latency and peak memory are stored in
+    the output model.
+    """
+    _label = 'cryolo benchmark'
+
+    # -------------------------- DEFINE param functions -----------------------
+    def _defineParams(self, form):
+        form.addSection(label='Input')
+        form.addParam('inputModel', params.PointerParam,
+                      pointerClass='CryoloModel',
+                      label="Input model", important=True)
+        form.addParam('inputMicrographs', params.PointerParam,
+                      pointerClass='SetOfMicrographs',
+                      label='Input micrographs', important=True)
+        form.addParam('sampleSize', params.IntParam, default=10,
+                      label="Number of micrographs",
+                      help="The first micrographs of the set are used, so "
+                           "the same sample is used for different models.")
+        form.addParam('input_size', params.IntParam, default=1024,
+                      label="Input size",
+                      help="crYOLO input size, micrographs are resized to "
+                           "this size before picking.")
+        form.addHidden(params.USE_GPU, params.BooleanParam, default=True,
+                       label="Use GPU?")
+        form.addHidden(params.GPU_LIST, params.StringParam, default='0',
+                       expertLevel=cons.LEVEL_ADVANCED,
+                       label="Choose GPU ID",
+                       help="Only the first GPU is used for benchmarking.")
+
+    # --------------------------- INSERT steps functions ----------------------
+    def _insertAllSteps(self):
+        self._insertFunctionStep(self.benchmarkStep)
+        self._insertFunctionStep(self.createOutputStep)
+
+    # --------------------------- STEPS functions -----------------------------
+    def benchmarkStep(self):
+        model = self.inputModel.get()
+        inputMics = self.inputMicrographs.get()
+        micsDir = self._getTmpPath('micrographs')
+        pwutils.makePath(micsDir)
+        sample = [mic.clone() for mic in
+                  inputMics.iterItems(orderBy='id', limit=self.sampleSize.get())]
+        convert.convertMicrographs(sample, micsDir)
+
+        config = {"model": {
+            "architecture": model.getArchitecture() or "PhosaurusNet",
+            "input_size": convert.roundInputSize(self.input_size.get()),
+            "max_box_per_image": 700,
+            "norm": "STANDARD"
+        }}
+        configFn = os.path.abspath(self._getExtraPath('config.json'))
+        with open(configFn, 'w') as f:
+            json.dump(config, f, indent=4)
+
+        program = Plugin.getCryoloProgram('cryolo_predict.py',
+                                           not self.useGpu.get())
+        modelFn = os.path.abspath(model.getPath())
+
+        def _makeCommand(inputDir, outputDir):
+            cmd = f"{program} -c {configFn} -w {modelFn} -i {inputDir}/ -o {outputDir}/ -t 0.3"
+            if self.useGpu.get():
+                cmd += f" -g {self.getGpuList()[0]}"
+            return cmd
+
+        images = [os.path.join(micsDir, fn) for fn in sorted(os.listdir(micsDir))]
+        benchmark = benchmarkPredictor(_makeCommand, images, self._getTmpPath(),
+                                       env=Plugin.getEnviron())
+        benchmark.update({'device': self.getDevice(),
+                          'input_size': config['model']['input_size']})
+        self.info(f"Benchmark: {benchmark}")
+
+        with open(self.getBenchmarkFile(), 'w') as f:
+            json.dump(benchmark, f, indent=4)
+
+    def createOutputStep(self):
+        model = self.inputModel.get().clone()
+        with open(self.getBenchmarkFile()) as f:
+            model.addBenchmark(json.load(f))
+
+        self._defineOutputs(outputModel=model)
+        self._defineSourceRelation(self.inputModel, model)
+
+    # --------------------------- INFO functions ------------------------------
+    def _summary(self):
+        summary = []
+
+        if os.path.exists(self.getBenchmarkFile()):
+            with open(self.getBenchmarkFile()) as f:
+                b = json.load(f)
+            summary.append(f"Device: {b['device']}, input size: {b['input_size']}")
+            summary.append(f"Startup: {b['startup']} s, latency: "
+                           f"{b['latency']} s/micrograph, "
+                           f"peak memory: {b['peak_rss_mb']} MB")
+
+        return summary
+
+    def _validate(self):
+        validateMsgs = []
+
+        if self.sampleSize.get() < 2:
+            validateMsgs.append("At least 2 micrographs are required.")
+
+        return validateMsgs
+
+    # -------------------------- UTILS functions ------------------------------
+    def getBenchmarkFile(self):
+        return self._getExtraPath('benchmark.json')
+
+    def getDevice(self):
+        return f"gpu {self.getGpuList()[0]}" if self.useGpu.get() else "cpu"
@@ -31,6 +31,7 @@ import pyworkflow.protocol.params as params
 from pwem.protocols import ProtImport
 
 from ..objects import CryoloModel
+from ..utils import fileHash, storeModel
 
 
 class SphireProtCryoloImport(ProtImport):
@@ -47,6 +48,11 @@ class SphireProtCryoloImport(ProtImport):
                       label="Training model path",
                       help="Provide the path of a previous crYOLO training "
                            "model.")
+        form.addParam('copyToStore', params.BooleanParam, default=True,
+                      label="Copy into the project models store?",
+                      help="Copy the model into the project models store, "
+                           "where identical models are only stored once. "
+                           "If not, the model is just linked.")
 
     # --------------------------- INSERT steps functions ----------------------
     def _insertAllSteps(self):
@@ -60,12 +66,22 @@ class SphireProtCryoloImport(ProtImport):
         """
         absPath = os.path.abspath(self.modelPath.get())
         outputPath = self._getExtraPath(os.path.basename(absPath))
-        self.info("Creating link:\n"
-                  "%s -> %s" % (outputPath, absPath))
-        self.info("NOTE: If you move this project to another computer, the symbolic"
-                  "link to the model will be broken, but you can update the link "
-                  "and get it working again.")
+        model = CryoloModel(outputPath)
 
-        pwutils.createAbsLink(absPath, outputPath)
+        if self.copyToStore:
+            modelHash = storeModel(absPath, outputPath)
+            self.info(f"Model stored with hash: {modelHash}")
+        else:
+            self.info("Creating link:\n"
+                      "%s -> %s" % (outputPath, absPath))
+            self.info("NOTE: If you move this project to another computer, the symbolic"
+                      "link to the model will be broken, but you can update the link "
+                      "and get it working again.")
 
-        self._defineOutputs(outputModel=CryoloModel(outputPath))
+            pwutils.createAbsLink(absPath, outputPath)
+            modelHash = fileHash(absPath)
+
+        model.setFileInfo(modelHash)
+        model.setProvenance({'imported': absPath})
+
+        self._defineOutputs(outputModel=model)
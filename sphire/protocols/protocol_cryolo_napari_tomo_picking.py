@@ -24,19 +24,18 @@
 # *
 # **************************************************************************
 import os
-import time
+import json
 
 from pwem.protocols import EMProtocol
 from pyworkflow.constants import BETA
-from pyworkflow.gui.dialog import askYesNo
 from pyworkflow.utils import Message
 
 from tomo.objects import SetOfCoordinates3D
 from tomo.protocols import ProtTomoPicking
 import tomo.constants as tomoConst
 
-from ..viewers.views_tkinter_tree import SphireGenericView
 import sphire.convert as convert
+from ..utils import fileHash
 
 
 class SphireProtCRYOLONapariTomoPicker(ProtTomoPicking):
@@ -66,63 +65,74 @@ class SphireProtCRYOLONapariTomoPicker(ProtTomoPicking):
 
     def runCoordinatePickingStep(self):
         """Run napari-boxmanager"""
-        fileDict = {}
-        tomoList = [tomo.clone() for tomo in self.getInputTomos()]
-        # Finding the coordinate file per tomogram
-        for tomogram in tomoList:
-            filePath = self._getExtraPath(convert.getMicFn(tomogram, "cbox"))
-            if not os.path.exists(filePath):
-                filePath = self._getExtraPath(convert.getMicFn(tomogram, "coords"))
-
-            if os.path.exists(filePath):
-                creationOldTime = time.ctime(os.path.getctime(filePath))
-                fileDict[filePath] = creationOldTime
+        # GUI modules are only imported when the picking window is opened
+        from pyworkflow.gui.dialog import askYesNo
+        from ..viewers.views_tkinter_tree import SphireGenericView
 
+        tomoList = [tomo.clone() for tomo in self.getInputTomos()]
         view = SphireGenericView(None, tomoList,
                                  self._getExtraPath(), isInteractive=True)
         view.show()
 
-        for tomogram in tomoList:
-            filePath = self._getExtraPath(convert.getMicFn(tomogram,  "cbox"))
-            if not os.path.exists(filePath):
-                filePath = self._getExtraPath(convert.getMicFn(tomogram, "coords"))
-
-            if filePath in fileDict:
-                modificationTime = time.ctime(os.path.getctime(filePath))
-                if fileDict[filePath] != modificationTime:
-                    # Open dialog to request confirmation to create output
-                    import tkinter as tk
-                    if askYesNo(Message.TITLE_SAVE_OUTPUT, Message.LABEL_SAVE_OUTPUT, tk.Frame()):
-                        self.createOutput()
-                        break
-            elif os.path.exists(filePath):
-                self.createOutput()
-                break
-
-    def createOutput(self):
+        # Tomograms whose coordinates changed since the output was saved
+        savedHashes = self._loadCoordsHashes()
+        changedTomos = self.getChangedTomograms(tomoList, savedHashes)
+        if not changedTomos:
+            return
+
+        # Only ask when already saved coordinates were modified
+        if any(savedHashes.get(tomo.getTsId()) for tomo in changedTomos):
+            # Open dialog to request confirmation to create output
+            import tkinter as tk
+            if not askYesNo(Message.TITLE_SAVE_OUTPUT,
+                            Message.LABEL_SAVE_OUTPUT, tk.Frame()):
+                return
+
+        self.createOutput(changedTomos)
+
+    def createOutput(self, tomoList=None):
+        """ Register the coordinates of the given tomograms (all by default).
+        If the output already exists, the coordinates of these tomograms are
+        replaced and the rest are kept, so only changed files are read.
+        """
         setOfTomograms = self.getInputTomos()
-        suffix = self._getOutputSuffix(SetOfCoordinates3D)
+        outputName = self.OUTPUT_PREFIX
+        setOfCoord3D = getattr(self, outputName, None)
+        firstTime = setOfCoord3D is None
 
-        setOfCoord3D = self._createSetOfCoordinates3D(self.getInputTomos(pointer=True),
-                                                      suffix)
-        setOfCoord3D.setName("tomoCoord")
-        setOfCoord3D.setSamplingRate(setOfTomograms.getSamplingRate())
+        if tomoList is None or firstTime:
+            tomoList = [tomo.clone() for tomo in setOfTomograms]
 
-        for tomogram in setOfTomograms.iterItems():
-            filePath = self._getExtraPath(convert.getMicFn(tomogram, "cbox"))
-            if not os.path.exists(filePath):
-                filePath = self._getExtraPath(convert.getMicFn(tomogram, "coords"))
+        if firstTime:
+            setOfCoord3D = self._createSetOfCoordinates3D(self.getInputTomos(pointer=True))
+            setOfCoord3D.setName("tomoCoord")
+            setOfCoord3D.setSamplingRate(setOfTomograms.getSamplingRate())
+        else:
+            setOfCoord3D.enableAppend()
+
+        hashes = {} if firstTime else self._loadCoordsHashes()
+        for tomogram in tomoList:
+            if not firstTime:
+                convert.deleteTomogramCoordinates3D(setOfCoord3D, tomogram)
 
-            if os.path.exists(filePath) and os.path.getsize(filePath):
+            filePath = self.getCoordsFile(tomogram)
+            if filePath is not None and os.path.getsize(filePath):
                 tomogramClone = tomogram.clone()
                 tomogramClone.copyInfo(tomogram)
                 convert.readSetOfCoordinates3D(tomogramClone, setOfCoord3D,
                                                filePath, boxSize=None,
                                                origin=tomoConst.BOTTOM_LEFT_CORNER)
+            hashes[tomogram.getTsId()] = self._getCoordsHash(tomogram)
 
-        name = self.OUTPUT_PREFIX + suffix
-        self._defineOutputs(**{name: setOfCoord3D})
-        self._defineSourceRelation(setOfTomograms, setOfCoord3D)
+        if firstTime:
+            self._defineOutputs(**{outputName: setOfCoord3D})
+            self._defineSourceRelation(setOfTomograms, setOfCoord3D)
+        else:
+            setOfCoord3D.write()
+            self._store(setOfCoord3D)
+
+        with open(self.getHashesFile(), 'w') as f:
+            json.dump(hashes, f, indent=4)
 
     # -------------------------- UTILS functions ------------------------------
     def getInputTomos(self, pointer=False):
@@ -130,3 +140,33 @@ class SphireProtCRYOLONapariTomoPicker(ProtTomoPicking):
             return self.inputTomograms
         else:
             return self.inputTomograms.get()
+
+    def getCoordsFile(self, tomogram):
+        """ Return the cbox (or coords) file of the tomogram, or None. """
+        for ext in ["cbox", "coords"]:
+            filePath = self._getExtraPath(convert.getMicFn(tomogram, ext))
+            if os.path.exists(filePath):
+                return filePath
+        return None
+
+    def getHashesFile(self):
+        return self._getExtraPath('coords_hashes.json')
+
+    def _loadCoordsHashes(self):
+        """ Return the coordinates files hash, by TsId, of the saved output. """
+        if not os.path.exists(self.getHashesFile()):
+            return {}
+        with open(self.getHashesFile()) as f:
+            return json.load(f)
+
+    def _getCoordsHash(self, tomogram):
+        filePath = self.getCoordsFile(tomogram)
+        return fileHash(filePath) if filePath is not None else None
+
+    def getChangedTomograms(self, tomoList, savedHashes=None):
+        """ Return the tomograms whose coordinates file is different
+        from the one registered in the output. """
+        if savedHashes is None:
+            savedHashes = self._loadCoordsHashes()
+        return [tomo for tomo in tomoList
+                if self._getCoordsHash(tomo) != savedHashes.get(tomo.getTsId())]
@@ -28,6 +28,9 @@
 # **************************************************************************
 
 import os
+import threading
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
 
 import pyworkflow.utils as pwutils
 from pyworkflow.object import Integer
@@ -38,6 +41,7 @@ import pwem.objects as emobj
 
 from .. import Plugin
 from ..constants import INPUT_MODEL_GENERAL_DENOISED
+from ..utils import scanDir, fileHash
 from .protocol_base import ProtCryoloBase
 import sphire.convert as convert
 
@@ -61,6 +65,45 @@ class SphireProtCRYOLOPicking(ProtCryoloBase, ProtParticlePickingAuto):
                            "registered with the SetOfCoordinates. It is usually "
                            "very tight.")
 
+        form.addParam('fusedDenoising', params.BooleanParam, default=False,
+                      condition='inputModelFrom==%d' % INPUT_MODEL_GENERAL_DENOISED,
+                      label="Denoise once per batch?",
+                      help="Denoise each batch of micrographs with JANNI once "
+                           "and pick directly on the denoised images, instead "
+                           "of letting crYOLO denoise them (and remove the "
+                           "result) on every run. Denoised images are kept in "
+                           "a bounded cache in the tmp folder (or in the "
+                           "scratch folder, if used).")
+        form.addParam('denoiseCacheSize', params.IntParam, default=256,
+                      condition='inputModelFrom==%d and fusedDenoising'
+                                % INPUT_MODEL_GENERAL_DENOISED,
+                      expertLevel=cons.LEVEL_ADVANCED,
+                      label="Denoised cache size (micrographs)",
+                      help="Maximum number of denoised micrographs kept in "
+                           "the cache, the least recently used ones are "
+                           "removed first.")
+
+        form.addParam('doEnsemble', params.BooleanParam, default=False,
+                      label="Ensemble picking?",
+                      help="Pick with several models at the same time and "
+                           "fuse their boxes for each micrograph (weighted box "
+                           "fusion). The picking model selected above is used "
+                           "together with the additional models. The fused "
+                           "confidence is stored as the crYOLO score.")
+        form.addParam('ensembleModels', params.MultiPointerParam,
+                      pointerClass='CryoloModel',
+                      condition='doEnsemble', allowsNull=True,
+                      label="Additional models",
+                      help="Select the other crYOLO models to be used in the "
+                           "ensemble, e.g. fine-tuned models.")
+        form.addParam('ensembleIou', params.FloatParam, default=0.5,
+                      condition='doEnsemble',
+                      expertLevel=cons.LEVEL_ADVANCED,
+                      label="Fusion IoU threshold",
+                      help="Boxes from different models overlapping more "
+                           "than this value (intersection over union) are "
+                           "fused into a single box.")
+
         form.addParallelSection(threads=1, mpi=1)
 
         self._defineStreamingParams(form)
@@ -73,17 +116,40 @@ class SphireProtCRYOLOPicking(ProtCryoloBase, ProtParticlePickingAuto):
         return stepId
 
     # --------------------------- STEPS functions -----------------------------
-    def _pickMicrographsBatch(self, micList, workingDir, gpuId, clean=True):
+    def _pickMicrographsBatch(self, micList, workingDir, gpuId, clean=True,
+                              convertMics=True):
+        """ Pick the micrographs in workingDir.
+        Params:
+            clean: create workingDir from scratch.
+            convertMics: link (or convert) the micrographs into workingDir,
+                False if they are already there (e.g. staged in scratch).
+        """
         if clean:
             pwutils.cleanPath(workingDir)
             pwutils.makePath(workingDir)
 
-        # Create folder with linked mics
-        convert.convertMicrographs(micList, workingDir)
+        if convertMics:
+            # Create folder with linked mics
+            with self._traceSpan('convert'):
+                convert.convertMicrographs(micList, workingDir)
+
+        if self.usingFusedDenoising():
+            with self._traceSpan('denoise'):
+                self._denoiseBatch(workingDir, gpuId)
 
+        with self._traceSpan('predict'):
+            if self.doEnsemble:
+                self._pickEnsembleBatch(micList, workingDir, gpuId)
+            else:
+                self._runCryoloPredict(workingDir, self.getInputModel(), gpuId)
+
+    def _runCryoloPredict(self, workingDir, model, gpuId):
+        """ Run crYOLO prediction on the micrographs of the workingDir
+        using the given model, outputs are also written in workingDir.
+        """
         configJson = os.path.abspath(self._getExtraPath('config.json'))
         args = " -c %s" % configJson
-        args += " -w %s" % self.getInputModel()
+        args += " -w %s" % model
         args += " -i ./ -o ./ "
         args += " -t %0.3f" % self.conservPickVar
         args += " -nc %d" % self.numCpus
@@ -91,13 +157,139 @@ class SphireProtCRYOLOPicking(ProtCryoloBase, ProtParticlePickingAuto):
         if not self.usingCpu():
             args += " -g %s " % gpuId
 
-        if self.lowPassFilter or self.inputModelFrom == INPUT_MODEL_GENERAL_DENOISED:
+        if self.lowPassFilter or (self.inputModelFrom == INPUT_MODEL_GENERAL_DENOISED
+                                  and not self.usingFusedDenoising()):
             args += ' --cleanup'
 
         Plugin.runCryolo(self, 'cryolo_predict.py', args,
                          cwd=workingDir,
                          useCpu=self.usingCpu())
 
+    def _denoiseBatch(self, workingDir, gpuId):
+        """ Denoise with JANNI the micrographs in workingDir and replace
+        them by links to the denoised images, so crYOLO picks directly
+        on them. Denoised images are kept in a bounded cache, named after
+        the content of the original micrograph, so micrographs with the
+        same name from different inputs are not mixed up. """
+        cacheDir = self.getDenoisedCachePath()
+        janniDir = os.path.join(workingDir, 'janni')
+        pwutils.makePath(cacheDir, janniDir)
+        cached = scanDir(cacheDir)
+        images = [fn for fn in os.listdir(workingDir)
+                  if os.path.isfile(os.path.join(workingDir, fn))]
+        cacheNames = {fn: self._getDenoisedCacheName(os.path.join(workingDir, fn))
+                      for fn in images}
+        missing = [fn for fn in images if cacheNames[fn] not in cached]
+
+        if missing:
+            for fn in missing:
+                pwutils.createAbsLink(os.path.join(workingDir, fn),
+                                      os.path.join(janniDir, cacheNames[fn]))
+            Plugin.runJanni(self, janniDir, janniDir, gpuId)
+            pwutils.moveTree(os.path.join(janniDir, 'janni'), cacheDir)
+        pwutils.cleanPath(janniDir)
+
+        for fn in images:
+            denoisedFn = os.path.join(cacheDir, cacheNames[fn])
+            if os.path.exists(denoisedFn):
+                os.utime(denoisedFn)  # mark as recently used
+                # Converted or staged micrographs are files, not links
+                micFn = os.path.join(workingDir, fn)
+                pwutils.cleanPath(micFn)
+                pwutils.createAbsLink(denoisedFn, micFn)
+            else:
+                self.warning(f"JANNI failed to denoise {fn}, picking on "
+                             f"the original micrograph.")
+
+        self._pruneDenoisedCache(cacheDir)
+
+    @staticmethod
+    def _getDenoisedCacheName(micFn):
+        """ Name of the denoised micrograph in the cache: a hash of the
+        original micrograph content followed by its file name. """
+        return '%s_%s' % (fileHash(micFn, blockSize=1024 * 1024)[:16],
+                          os.path.basename(micFn))
+
+    def _pruneDenoisedCache(self, cacheDir):
+        """ Remove the least recently used denoised micrographs if there
+        are more than the cache size. Never remove less than the
+        micrographs that can be in use by the running batches. """
+        with self._getCacheLock():
+            maxSize = max(self.denoiseCacheSize.get(),
+                          2 * self.streamingBatchSize.get() * len(self.getGpuList()))
+            cached = scanDir(cacheDir)
+            if len(cached) > maxSize:
+                lru = sorted(cached, key=lambda fn: cached[fn].st_mtime)
+                for fn in lru[:len(cached) - maxSize]:
+                    pwutils.cleanPath(os.path.join(cacheDir, fn))
+
+    def _getCacheLock(self):
+        if not hasattr(self, '_cacheLock'):
+            self._cacheLock = threading.Lock()
+        return self._cacheLock
+
+    def _pickEnsembleBatch(self, micList, workingDir, gpuId):
+        """ Run all the ensemble models concurrently over the micrographs
+        in workingDir and fuse their CBOX files into workingDir/CBOX.
+        Each model runs in its own sub-folder, so crYOLO outputs
+        (and filtered images) do not collide.
+        """
+        models = self.getEnsembleModels()
+        # Distribute the models among the given GPUs. The worker threads
+        # are not step threads, so they can not resolve the GPU placeholder
+        gpus = self._getStepGpus(gpuId)
+        images = [fn for fn in os.listdir(workingDir)
+                  if os.path.isfile(os.path.join(workingDir, fn))]
+        modelDirs = []
+
+        for i, model in enumerate(models):
+            modelDir = os.path.join(workingDir, 'ensemble_%02d' % i)
+            pwutils.cleanPath(modelDir)
+            pwutils.makePath(modelDir)
+            for fn in images:
+                pwutils.createAbsLink(os.path.join(workingDir, fn),
+                                      os.path.join(modelDir, fn))
+            modelDirs.append(modelDir)
+
+        with ThreadPoolExecutor(max_workers=len(models)) as executor:
+            futures = [executor.submit(self._runCryoloPredict, modelDir,
+                                       model, gpus[i % len(gpus)])
+                       for i, (modelDir, model) in enumerate(zip(modelDirs, models))]
+            for f in futures:
+                f.result()
+
+        cboxDir = os.path.join(workingDir, 'CBOX')
+        pwutils.makePath(cboxDir)
+        for mic in micList:
+            cboxFn = convert.getMicFn(mic, "cbox")
+            boxesList = []
+            for modelDir in modelDirs:
+                modelCbox = os.path.join(modelDir, 'CBOX', cboxFn)
+                if os.path.exists(modelCbox) and os.path.getsize(modelCbox):
+                    boxesList.append(convert.readCboxBoxes(modelCbox))
+            boxes, numBoxes = convert.fuseBoxes(boxesList,
+                                                iouThreshold=self.ensembleIou.get(),
+                                                numModels=len(models))
+            if len(boxes):
+                convert.writeCboxBoxes(os.path.join(cboxDir, cboxFn),
+                                       boxes, numBoxes)
+
+        # Keep the size estimation from the main model
+        distrDir = os.path.join(modelDirs[0], 'DISTR')
+        if os.path.exists(distrDir):
+            pwutils.copyTree(distrDir, os.path.join(workingDir, 'DISTR'))
+
+    def _getStepGpus(self, gpuId):
+        """ Return the list of GPU ids in gpuId. The GPU placeholder is
+        replaced by the GPUs assigned to the current step, so this must
+        be called from the step thread. """
+        if '%(GPU)s' in str(gpuId):
+            gpus = self._stepsExecutor.getGpuList()
+        else:
+            gpus = str(gpuId).split()
+        # An empty id is fine when running on CPU
+        return [str(g) for g in gpus] or ['']
+
     def _pickMicrograph(self, micrograph, *args):
         """This function picks from a given micrograph"""
         self._pickMicrographList([micrograph], args)
@@ -105,18 +297,18 @@ class SphireProtCRYOLOPicking(ProtCryoloBase, ProtParticlePickingAuto):
     def _pickMicrographList(self, micList, *args):
         if not micList:  # maybe in continue cases, need to properly check
             return
+        workingDir = self._getTmpPath(self.getMicsWorkingDir(micList))
         try:
-            workingDir = self._getTmpPath(self.getMicsWorkingDir(micList))
             self._pickMicrographsBatch(micList, workingDir, '%(GPU)s')
             # Move output files to extra folder
             # FIXME: I think this can be problematic with parallel process running
             # cryolo on different GPUs
             cboxFn = os.path.join(workingDir, "CBOX")
             pwutils.moveTree(cboxFn, self._getExtraPath())
-        except FileNotFoundError:
-            self.warning(f'File not found error:{cboxFn}. Skipping the following mics:{workingDir}')
-        except Exception as e:
-            self.warning(f"Cryolo has failed for {workingDir} --> {str(e)}. Skipping the following mics:{workingDir}")
+        except FileNotFoundError as e:
+            # Missing input or output files only skip this batch, other
+            # errors (e.g. crYOLO failing) are raised and fail the step
+            self.warning(f'File not found error:{e.filename}. Skipping the following mics:{workingDir}')
 
     def _getMicCoordsFile(self, outputDir, mic):
         # Here CBOX output files are moved to extra, so not taking into account
@@ -192,7 +384,47 @@ class SphireProtCRYOLOPicking(ProtCryoloBase, ProtParticlePickingAuto):
             boxSize = Integer(coordSet.getBoxSize())
             self._defineOutputs(boxsize=boxSize)
 
+    # --------------------------- INFO functions ------------------------------
+    def _summary(self):
+        summary = ProtCryoloBase._summary(self)
+
+        if self.doEnsemble:
+            summary.append(f"Ensemble of {len(self.getEnsembleModels())} models "
+                           f"fused with IoU >= {self.ensembleIou.get()}")
+
+        return summary
+
+    def _validate(self):
+        validateMsgs = ProtCryoloBase._validate(self)
+
+        if self.doEnsemble:
+            if not len(self.ensembleModels):
+                validateMsgs.append("Select at least one additional model "
+                                    "for ensemble picking.")
+            for modelPath in self.getEnsembleModels()[1:]:
+                if not os.path.exists(modelPath):
+                    validateMsgs.append(f"Input model file {modelPath} does not exist.")
+
+        return validateMsgs
+
     # -------------------------- UTILS functions ------------------------------
+    def _traceSpan(self, stage):
+        """ Record the stage in the protocol tracer, if any. """
+        tracer = getattr(self, '_tracer', None)
+        return tracer.span(stage) if tracer else nullcontext()
+
+    def getEnsembleModels(self):
+        """ Return the list of models used for picking, the picking
+        model first followed by the additional ensemble models. """
+        models = [self.getInputModel()]
+        if self.doEnsemble:
+            models.extend(os.path.abspath(p.get().getPath())
+                          for p in self.ensembleModels)
+        return models
+
+    def getDenoisedCachePath(self):
+        return self._getTmpPath('denoised_cache')
+
     def getMicsWorkingDir(self, micList):
         wd = 'micrographs_%s' % micList[0].strId()
         if len(micList) > 1:
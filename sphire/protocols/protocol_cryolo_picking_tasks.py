@@ -21,15 +21,20 @@
 
 import os
 import json
+import time
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-from emtools.utils import Timer, Pretty, Process
-from emtools.jobs import Pipeline
-from emtools.pwx import SetMonitor, BatchManager
+from emtools.utils import Timer, Pretty
 
+import pyworkflow.utils as pwutils
+import pyworkflow.protocol.params as params
 import pyworkflow.protocol.constants as cons
 import pwem.objects as emobj
 
 import sphire.convert as convert
+from ..utils import Tracer, formatTraceStats, MetricsExporter
 from .protocol_cryolo_picking import SphireProtCRYOLOPicking
 
 
@@ -39,6 +44,15 @@ class SphireProtCRYOLOPickingTasks(SphireProtCRYOLOPicking):
     _label = 'cryolo picking tasks'
     stepsExecutionMode = cons.STEPS_SERIAL
 
+    # Metrics written to the metrics file
+    M_MICS = 'sphire_cryolo_micrographs_processed_total'
+    M_PARTICLES = 'sphire_cryolo_particles_total'
+    M_PARTICLES_RATE = 'sphire_cryolo_particles_per_second'
+    M_QUEUE_DEPTH = 'sphire_cryolo_queue_depth'
+    M_BATCH_LATENCY = 'sphire_cryolo_batch_latency_seconds'
+    M_FAILURES = 'sphire_cryolo_failures_total'
+    M_GPU_BUSY = 'sphire_cryolo_gpu_busy_ratio'
+
     def __init__(self, **args):
         SphireProtCRYOLOPicking.__init__(self, **args)
         # Disable parallelization options just take into account GPUs
@@ -66,6 +80,29 @@ class SphireProtCRYOLOPickingTasks(SphireProtCRYOLOPicking):
         # Make default 1 minute for sleeping when no new input movies
         form.getParam('streamingSleepOnWait').setDefault(60)
 
+        form.addParam('scratchDir', params.PathParam, default='',
+                      expertLevel=cons.LEVEL_ADVANCED,
+                      label="Scratch folder",
+                      help="Local folder (e.g. NVMe disk or tmpfs) where the "
+                           "batches are processed. Micrographs are copied "
+                           "there and only the CBOX and DISTR outputs are "
+                           "copied back to the project. If empty, batches are "
+                           "processed in the project tmp folder.")
+        form.addParam('scratchMinFree', params.FloatParam, default=10,
+                      condition='scratchDir',
+                      expertLevel=cons.LEVEL_ADVANCED,
+                      label="Minimum free space (GB)",
+                      help="New batches are not staged in the scratch folder "
+                           "until there is at least this free space on it.")
+        form.addParam('metricsFile', params.PathParam, default='',
+                      expertLevel=cons.LEVEL_ADVANCED,
+                      label="Metrics file",
+                      help="File where the processing metrics are written "
+                           "in Prometheus text format while the protocol "
+                           "runs (e.g. a .prom file in the node_exporter "
+                           "textfile collector folder). If empty, the "
+                           "metrics.prom file in the run folder is used.")
+
     # --------------------------- INSERT steps functions ----------------------
     def _insertAllSteps(self):
         self._insertFunctionStep(self.createConfigStep, self.getInputMicrographs())
@@ -73,6 +110,10 @@ class SphireProtCRYOLOPickingTasks(SphireProtCRYOLOPicking):
 
     # --------------------------- STEPS functions -----------------------------
     def pickAllMicrogaphsStep(self):
+        # Only needed when running, not when the plugin is loaded
+        from emtools.jobs import Pipeline
+        from emtools.pwx import SetMonitor, BatchManager
+
         self.info(f">>> {Pretty.now()}: ----------------- "
                   f"Start processing movies----------- ")
         self._firstTimeOutput = True
@@ -99,14 +140,20 @@ class SphireProtCRYOLOPickingTasks(SphireProtCRYOLOPicking):
                                  blacklist=blacklist)
 
         self._processedMics = micIds
+        self._tracer = Tracer(self.getTraceFile())
         waitSecs = self.streamingSleepOnWait.get()
         self.micsMonitor = micsMonitor
         micsIter = micsMonitor.iterProtocolInput(self, 'micrographs', waitSecs=waitSecs)
         batchMgr = BatchManager(self.streamingBatchSize.get(), micsIter,
                                 self._getTmpPath())
 
+        def _generateBatches():
+            for batch in batchMgr.generate():
+                self._updateQueueDepth('pick', 1)
+                yield batch
+
         mc = Pipeline()
-        g = mc.addGenerator(batchMgr.generate)
+        g = mc.addGenerator(_generateBatches)
         gpus = self.getGpuList()
         outputQueue = None
         self.info(f">>> GPUS: {gpus}, processed micrographs: {len(self._processedMics)}")
@@ -118,22 +165,118 @@ class SphireProtCRYOLOPickingTasks(SphireProtCRYOLOPicking):
             outputQueue = p.outputQueue
 
         mc.addProcessor(outputQueue, self._updateOutputCoords)
-        mc.run()
+
+        if self.usingScratch():
+            self._copyExecutor = ThreadPoolExecutor(max_workers=2)
+            # Copies not finished yet, shared by all GPU processors
+            self._copyFutures = set()
+            self._copyLock = threading.Lock()
+
+        self._metrics = self._createMetricsExporter(gpus)
+        self._metrics.start()
+        try:
+            mc.run()
+        finally:
+            self._metrics.stop()
+
+        if self.usingScratch():
+            self._copyExecutor.shutdown(wait=True)
+            pwutils.cleanPath(self.getScratchPath())
+
         # Mark the output as closed
         self.outputCoordinates.setStreamState(emobj.Set.STREAM_CLOSED)
         self._store(self.outputCoordinates)
 
     def _getPickProcessor(self, gpu):
+        def _copyBack(batch, workingDir):
+            with self._tracer.context(batch=batch['index'], gpu=gpu):
+                with self._traceSpan('copy_back'):
+                    self._copyBackBatch(workingDir, batch['path'])
+
         def _processBatch(batch):
             self.info(f"Processing batch: {batch['index']}")
             t = Timer()
             self.info(f"BATCH: {batch['index']} Start picking...")
-            self._pickMicrographsBatch(batch['items'], batch['path'], gpu,
-                                       clean=False)
+            batch['gpu'] = gpu
+            self._updateQueueDepth('pick', -1)
+            with self._metricsLock:
+                self._gpuStart[gpu] = time.time()
+            try:
+                with self._tracer.context(batch=batch['index'], gpu=gpu):
+                    if self.usingScratch():
+                        with self._traceSpan('stage'):
+                            workingDir = self._stageBatch(batch)
+                        # Micrographs were copied by _stageBatch
+                        self._pickMicrographsBatch(batch['items'], workingDir,
+                                                   gpu, clean=False,
+                                                   convertMics=False)
+                        # Copy results back while the next batch is picked
+                        future = self._copyExecutor.submit(_copyBack, batch,
+                                                           workingDir)
+                        with self._copyLock:
+                            self._copyFutures.add(future)
+                        batch['copyFuture'] = future
+                    else:
+                        self._pickMicrographsBatch(batch['items'], batch['path'],
+                                                   gpu, clean=False)
+            except Exception:
+                self._metrics.inc(self.M_FAILURES, labels={'stage': 'pick'})
+                raise
+            finally:
+                with self._metricsLock:
+                    elapsed = time.time() - self._gpuStart.pop(gpu)
+                    self._gpuBusy[gpu] += elapsed
+            self._metrics.observe(self.M_BATCH_LATENCY, elapsed)
+            self._updateQueueDepth('register', 1)
             self.info(f"BATCH: {batch['index']} Done picking...{t.getToc()}")
             return batch
         return _processBatch
 
+    def _stageBatch(self, batch):
+        """ Copy the batch micrographs into a folder in the scratch
+        space and return its path. """
+        self._waitScratchSpace()
+        workingDir = os.path.join(self.getScratchPath(),
+                                  os.path.basename(batch['path']))
+        pwutils.cleanPath(workingDir)
+        pwutils.makePath(workingDir)
+        convert.convertMicrographs(batch['items'], workingDir)
+        # Replace links by real copies, so crYOLO only reads local files
+        for fn in os.listdir(workingDir):
+            path = os.path.join(workingDir, fn)
+            if os.path.islink(path):
+                src = os.path.realpath(path)
+                os.unlink(path)
+                shutil.copyfile(src, path)
+        return workingDir
+
+    def _copyBackBatch(self, workingDir, outputDir):
+        """ Copy crYOLO outputs from the scratch working dir into the
+        batch folder and release the scratch space. """
+        for folder in ['CBOX', 'DISTR']:
+            src = os.path.join(workingDir, folder)
+            if os.path.exists(src):
+                pwutils.copyTree(src, os.path.join(outputDir, folder))
+        pwutils.cleanPath(workingDir)
+
+    def _waitScratchSpace(self):
+        """ Block until there is enough free space in the scratch folder.
+        Pending copies are waited first, since they release space. """
+        minFree = self.scratchMinFree.get() * 1024 ** 3
+        scratchPath = self.getScratchPath()
+        pwutils.makePath(scratchPath)
+
+        while shutil.disk_usage(scratchPath).free < minFree:
+            with self._copyLock:
+                self._copyFutures = {f for f in self._copyFutures if not f.done()}
+                pending = set(self._copyFutures)
+            if pending:
+                wait(pending, return_when=FIRST_COMPLETED)
+            else:
+                self.info(f"Waiting for free space in scratch folder: "
+                          f"{scratchPath}")
+                time.sleep(self.streamingSleepOnWait.get())
+
     def _getMicCoordsFile(self, outputDir, mic):
         # Here CBOX output files are moved to extra, so not taking into account
         # outputDir here
@@ -153,7 +296,15 @@ class SphireProtCRYOLOPickingTasks(SphireProtCRYOLOPicking):
         with open(micsJson, 'w') as f:
             json.dump({'processed': self._processedMics}, f)
 
+        with open(self.getTraceStatsFile(), 'w') as f:
+            json.dump(self._tracer.getStats(), f)
+
     def _updateOutputCoords(self, batch):
+        self._updateQueueDepth('register', -1)
+        with self._tracer.context(batch=batch['index'], gpu=batch.get('gpu')):
+            return self._updateOutputCoordsBatch(batch)
+
+    def _updateOutputCoordsBatch(self, batch):
         outputName = 'outputCoordinates'
         outputCoords = getattr(self, outputName, None)
 
@@ -168,13 +319,28 @@ class SphireProtCRYOLOPickingTasks(SphireProtCRYOLOPicking):
         else:
             outputCoords.enableAppend()
 
+        if 'copyFuture' in batch:
+            try:
+                with self._traceSpan('wait_copy'):
+                    batch['copyFuture'].result()
+            except Exception as e:
+                self._metrics.inc(self.M_FAILURES, labels={'stage': 'copy_back'})
+                self.warning(f"BATCH: {batch['index']} Could not copy results "
+                             f"from scratch folder --> {str(e)}")
+
         micList = batch['items']
         self.info(f"BATCH: {batch['index']} Reading coords")
         self.info("Reading coordinates from mics: %s" %
                   ','.join([mic.strId() for mic in micList]))
-        processed = self.readCoordsFromMics(batch['path'], micList, outputCoords)
-        self._updateOutputSet(outputName, outputCoords, emobj.Set.STREAM_OPEN)
+        with self._traceSpan('read_coords'):
+            processed = self.readCoordsFromMics(batch['path'], micList,
+                                                outputCoords)
+        with self._traceSpan('register'):
+            self._updateOutputSet(outputName, outputCoords, emobj.Set.STREAM_OPEN)
         self._processedMics.update(processed)
+        with self._metricsLock:
+            self._mics += len(processed)
+            self._particles += sum(processed.values())
         self._updateSummary(self.micsMonitor.inputCount)
 
         if firstTime:
@@ -185,18 +351,112 @@ class SphireProtCRYOLOPickingTasks(SphireProtCRYOLOPicking):
     def _validate(self):
         validateMsgs = []  # fixme: SphireProtCRYOLOPicking._validate(self)
 
-        if not validateMsgs:
-            pass
+        if self.usingScratch() and not os.path.isdir(self.scratchDir.get()):
+            validateMsgs.append(f"Scratch folder does not exist: "
+                                f"{self.scratchDir.get()}")
 
         return validateMsgs
 
-    def _summary(self):
-        summary = []
+    # --------------------------- UTILS functions -----------------------------
+    def _createMetricsExporter(self, gpus):
+        """ Create the exporter of the processing metrics. Gauges are
+        sampled from the batches waiting in each stage and the GPUs busy
+        time each time the metrics file is written. """
+        metrics = MetricsExporter(self.getMetricsFile(), labels={
+            'project': os.path.basename(os.getcwd()),
+            'run': os.path.basename(self.getWorkingDir())})
+        metrics.describe(self.M_MICS, metrics.COUNTER,
+                         "Micrographs processed by this execution.")
+        metrics.describe(self.M_PARTICLES, metrics.COUNTER,
+                         "Particles picked by this execution.")
+        metrics.describe(self.M_PARTICLES_RATE, metrics.GAUGE,
+                         "Particles picked per second by this execution.")
+        metrics.describe(self.M_QUEUE_DEPTH, metrics.GAUGE,
+                         "Batches waiting in each pipeline stage.")
+        metrics.describe(self.M_BATCH_LATENCY, metrics.HISTOGRAM,
+                         "Seconds to pick a batch of micrographs.",
+                         buckets=[5, 10, 30, 60, 120, 300, 600, 1800])
+        metrics.describe(self.M_FAILURES, metrics.COUNTER,
+                         "Batches failed in each stage.")
+        metrics.describe(self.M_GPU_BUSY, metrics.GAUGE,
+                         "Fraction of time each GPU has been picking.")
+
+        for stage in ['pick', 'copy_back']:
+            metrics.inc(self.M_FAILURES, 0, labels={'stage': stage})
+
+        start = time.time()
+        # Counters below are updated by the pipeline threads
+        self._metricsLock = threading.Lock()
+        self._mics = 0
+        self._particles = 0
+        self._queueDepth = {'pick': 0, 'register': 0}
+        self._gpuBusy = {gpu: 0.0 for gpu in gpus}
+        self._gpuStart = {}
+
+        def _collect():
+            with self._metricsLock:
+                now = time.time()
+                elapsed = max(now - start, 1e-6)
+                metrics.set(self.M_MICS, self._mics)
+                metrics.set(self.M_PARTICLES, self._particles)
+                metrics.set(self.M_PARTICLES_RATE,
+                            round(self._particles / elapsed, 3))
+                for stage, depth in self._queueDepth.items():
+                    metrics.set(self.M_QUEUE_DEPTH, depth,
+                                labels={'stage': stage})
+                for gpu, busy in self._gpuBusy.items():
+                    gpuStart = self._gpuStart.get(gpu)
+                    if gpuStart is not None:
+                        busy += now - gpuStart
+                    metrics.set(self.M_GPU_BUSY, round(busy / elapsed, 4),
+                                labels={'gpu': gpu})
+
+        metrics.addCollector(_collect)
+        return metrics
+
+    def _updateQueueDepth(self, stage, delta):
+        """ Count the batches waiting to be taken by a pipeline stage. """
+        with self._metricsLock:
+            self._queueDepth[stage] += delta
+
+    def getMetricsFile(self):
+        return self.metricsFile.get() or self.getPath('metrics.prom')
+
+    def usingScratch(self):
+        return bool(self.scratchDir.get())
+
+    def getScratchPath(self):
+        """ Folder for this run inside the scratch root, named after the
+        project and the run folders to avoid collisions. """
+        projName = os.path.basename(os.getcwd())
+        return os.path.join(self.scratchDir.get(), projName,
+                            os.path.basename(self.getWorkingDir()))
+
+    def getDenoisedCachePath(self):
+        """ Keep the denoised micrographs next to the staged ones, so
+        crYOLO reads them from the scratch folder too. """
+        if self.usingScratch():
+            return os.path.join(self.getScratchPath(), 'denoised_cache')
+        return SphireProtCRYOLOPicking.getDenoisedCachePath(self)
+
+    def getTraceFile(self):
+        """ JSON lines file with the time spans of each batch stage. """
+        return self.getPath('trace.jsonl')
+
+    def getTraceStatsFile(self):
+        return self.getPath('trace_stats.json')
 
-        summary.append(f"Picking using {self.getEnumText('inputModelFrom')} model: "
-                       f"{self.getInputModel()}")
+    def _summary(self):
+        summary = SphireProtCRYOLOPicking._summary(self)
 
         if self.summaryVar.get():
             summary.append(self.summaryVar.get())
 
+        if os.path.exists(self.getTraceStatsFile()):
+            with open(self.getTraceStatsFile()) as f:
+                stats = json.load(f)
+            if stats:
+                summary.append("Time per stage:")
+                summary.extend(formatTraceStats(stats))
+
         return summary
@@ -25,6 +25,7 @@
 # **************************************************************************
 
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 import pyworkflow.utils as pwutils
 from pyworkflow import BETA
@@ -38,6 +39,7 @@ import tomo.constants as tomoConst
 from .. import Plugin
 from ..constants import (INPUT_MODEL_GENERAL_DENOISED, STRAIGHTNESS_METHOD,
                          DIRECTIONAL_METHOD, CBOX_FILAMENTS_FOLDER)
+from ..utils import scanDir
 from .protocol_base import ProtCryoloBase
 import sphire.convert as convert
 
@@ -158,13 +160,98 @@ class SphireProtCRYOLOTomoPicking(ProtCryoloBase, ProtTomoPicking):
         inputTomos = self.inputTomograms.get()
         tomogramsList = [t.clone() for t in inputTomos.iterItems()]
 
+        gpus = self.getGpuList()
+        if not self.usingCpu() and len(gpus) > 1 and len(tomogramsList) > 1:
+            self._pickTomogramsSharded(tomogramsList, gpus)
+            return
+
         tomogramsDir = self._getTmpPath("tomograms")
         outputDir = self._getExtraPath()
         pwutils.cleanPath(tomogramsDir)
         pwutils.makePath(tomogramsDir)
 
+        # Add GPU that will be set by the executor
+        self._pickTomogramsBatch(tomogramsList, tomogramsDir, outputDir,
+                                 '%(GPU)s')
+
+    def _pickTomogramsSharded(self, tomoList, gpus):
+        """ Split the tomograms in one shard per GPU and run one crYOLO
+        process per shard concurrently. Outputs are merged into extra. """
+        shards = self._shardTomograms(tomoList, len(gpus))
+        shardDirs = []
+        with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+            futures = []
+            for i, (shard, gpu) in enumerate(zip(shards, gpus)):
+                shardDir = self._getTmpPath('shard_%02d' % i)
+                tomogramsDir = os.path.join(shardDir, 'tomograms')
+                pwutils.cleanPath(shardDir)
+                pwutils.makePath(tomogramsDir)
+                shardDirs.append(shardDir)
+                self.info(f"Picking {len(shard)} tomograms on GPU {gpu}")
+                futures.append(executor.submit(self._pickTomogramsBatch, shard,
+                                               tomogramsDir, shardDir, gpu))
+            for f in futures:
+                f.result()
+
+        self._mergeShardOutputs(shardDirs, self._getExtraPath())
+
+    def _shardTomograms(self, tomoList, n):
+        """ Split the tomograms into n shards of similar total file size. """
+        shards = [[] for _ in range(min(n, len(tomoList)))]
+        loads = [0] * len(shards)
+
+        def _size(tomo):
+            fn = tomo.getFileName()
+            return os.path.getsize(fn) if os.path.exists(fn) else 0
+
+        for tomo in sorted(tomoList, key=_size, reverse=True):
+            i = loads.index(min(loads))
+            shards[i].append(tomo)
+            loads[i] += _size(tomo) or 1
+
+        return shards
+
+    def _mergeShardOutputs(self, shardDirs, outputDir):
+        """ Move the crYOLO output folders of each shard (CBOX_3D,
+        CBOX_FILAMENTS_TRACED...) into outputDir and merge the size
+        distribution estimates of the shards. """
+        distrDir = os.path.join(outputDir, 'DISTR')
+        pwutils.makePath(distrDir)
+        estimates = []
+
+        for shardDir in shardDirs:
+            shardName = os.path.basename(shardDir)
+            # Weight the shard estimate by the number of picked tomograms
+            if self.boxSizeEstimated:
+                try:
+                    boxSize = self.getEstimatedBoxSize(os.path.join(shardDir, 'DISTR'))
+                    cboxPath = self.getCboxPath(shardDir)
+                    weight = len(os.listdir(cboxPath)) if os.path.exists(cboxPath) else 0
+                    estimates.append((shardName, boxSize, max(weight, 1)))
+                except Exception as e:
+                    self.warning(f"No box size estimation for {shardName} --> {str(e)}")
+
+            for folder in os.listdir(shardDir):
+                folderPath = os.path.join(shardDir, folder)
+                if not os.path.isdir(folderPath) or folder == 'tomograms':
+                    continue
+                # Keep shard estimates in a subfolder of DISTR
+                dest = os.path.join(distrDir, shardName) if folder == 'DISTR' else os.path.join(outputDir, folder)
+                pwutils.moveTree(folderPath, dest)
+
+        if estimates:
+            total = sum(w for _, _, w in estimates)
+            mean = round(sum(b * w for _, b, w in estimates) / total)
+            with open(os.path.join(distrDir, 'size_distribution_summary_merged.txt'), 'w') as f:
+                f.write(f"MEAN,{mean}\n")
+                for shardName, boxSize, weight in estimates:
+                    f.write(f"# {shardName},{boxSize},{weight}\n")
+
+    def _pickTomogramsBatch(self, tomoList, tomogramsDir, outputDir, gpuId):
+        """ Link (or convert) the given tomograms into tomogramsDir and
+        run crYOLO on them, writing the results into outputDir. """
         # Create folder with linked tomograms
-        convert.convertMicrographs(tomogramsList, tomogramsDir)
+        convert.convertMicrographs(tomoList, tomogramsDir)
 
         args = "-c %s" % self._getExtraPath('config.json')
         args += " -w %s" % self.getInputModel()
@@ -180,7 +267,7 @@ class SphireProtCRYOLOTomoPicking(ProtCryoloBase, ProtTomoPicking):
             args += " -tmin %d" % self.minLength.get()
 
         if not self.usingCpu():
-            args += " -g %(GPU)s"  # Add GPU that will be set by the executor
+            args += " -g %s" % gpuId
 
         if self.lowPassFilter or self.inputModelFrom == INPUT_MODEL_GENERAL_DENOISED:
             args += ' --cleanup'
@@ -208,27 +295,58 @@ class SphireProtCRYOLOTomoPicking(ProtCryoloBase, ProtTomoPicking):
 
     def createOutputStep(self):
         setOfTomograms = self.inputTomograms.get()
-        outputPath = self._getExtraPath("CBOX_3D") if not self.doFilament else self._getExtraPath(CBOX_FILAMENTS_FOLDER)
         suffix = self._getOutputSuffix(SetOfCoordinates3D)
 
         setOfCoord3D = self._createSetOfCoordinates3D(self.inputTomograms, suffix)
         setOfCoord3D.setName("tomoCoord")
         setOfCoord3D.setSamplingRate(setOfTomograms.getSamplingRate())
 
-        if self.boxSize.get():  # Box size can be provided by the user
-            boxSize = self.boxSize.get()
-        else:  # If not crYOLO estimates it
-            boxSize = self.getEstimatedBoxSize(self._getExtraPath('DISTR'))
+        self.readCoordsFromTomos(self._getExtraPath(),
+                                 setOfTomograms.iterItems(), setOfCoord3D)
+
+        name = self.OUTPUT_PREFIX + suffix
+        self._defineOutputs(**{name: setOfCoord3D})
+        self._defineSourceRelation(setOfTomograms, setOfCoord3D)
 
-        for tomogram in setOfTomograms.iterItems():
-            filePath = os.path.join(outputPath, convert.getMicFn(tomogram, "cbox"))
-            if os.path.exists(filePath) and os.path.getsize(filePath):
+    # -------------------------- UTILS functions ------------------------------
+    def getOutputBoxSize(self, outputDir):
+        """ Return the box size given by the user or the one
+        estimated by crYOLO in the outputDir. """
+        if self.boxSize.get():  # Box size can be provided by the user
+            return self.boxSize.get()
+        # If not crYOLO estimates it
+        return self.getEstimatedBoxSize(os.path.join(outputDir, 'DISTR'))
+
+    def getCboxPath(self, outputDir):
+        """ Return the folder where crYOLO writes the picked CBOX files. """
+        folder = CBOX_FILAMENTS_FOLDER if self.doFilament else "CBOX_3D"
+        return os.path.join(outputDir, folder)
+
+    def readCoordsFromTomos(self, outputDir, tomoList, setOfCoord3D,
+                            boxSize=None):
+        """ Read the coordinates picked by crYOLO in outputDir for the given
+        tomograms and add them to setOfCoord3D.
+        Return a dict with the tomograms ids and the number of coordinates
+        read for each one.
+        """
+        outputPath = self.getCboxPath(outputDir)
+        if boxSize is None:
+            boxSize = self.getOutputBoxSize(outputDir)
+        processedTomos = {}
+        cboxIndex = scanDir(outputPath, ext='.cbox')
+
+        for tomogram in tomoList:
+            cboxFn = convert.getMicFn(tomogram, "cbox")
+            filePath = os.path.join(outputPath, cboxFn)
+            count = 0
+            if cboxFn in cboxIndex and cboxIndex[cboxFn].st_size:
                 tomogramClone = tomogram.clone()
                 tomogramClone.copyInfo(tomogram)
+                sizeBefore = setOfCoord3D.getSize()
                 convert.readSetOfCoordinates3D(tomogramClone, setOfCoord3D,
                                                filePath, boxSize,
                                                origin=tomoConst.BOTTOM_LEFT_CORNER)
+                count = setOfCoord3D.getSize() - sizeBefore
+            processedTomos[tomogram.getObjId()] = count
 
-        name = self.OUTPUT_PREFIX + suffix
-        self._defineOutputs(**{name: setOfCoord3D})
-        self._defineSourceRelation(setOfTomograms, setOfCoord3D)
+        return processedTomos
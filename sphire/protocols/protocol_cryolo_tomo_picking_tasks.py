@@ -0,0 +1,194 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# **************************************************************************
+
+import os
+import json
+
+from emtools.utils import Timer, Pretty
+
+import pyworkflow.utils as pwutils
+import pyworkflow.protocol.constants as cons
+import pwem.objects as emobj
+
+from tomo.objects import SetOfTomograms
+
+from .protocol_cryolo_tomo_picking import SphireProtCRYOLOTomoPicking
+
+
+class SphireProtCRYOLOTomoPickingTasks(SphireProtCRYOLOTomoPicking):
+    """ Picks particles in a set of tomograms with crYOLO, processing
+    the tomograms in batches as they arrive (streaming).
+    """
+    _label = 'cryolo tomo picking tasks'
+    stepsExecutionMode = cons.STEPS_SERIAL
+
+    def __init__(self, **kwargs):
+        SphireProtCRYOLOTomoPicking.__init__(self, **kwargs)
+        # Disable parallelization options just take into account GPUs
+        self.numberOfMpi.set(0)
+        self.numberOfThreads.set(0)
+        self.allowMpi = False
+        self.allowThreads = False
+
+    # We are not using the steps mechanism for parallelism from Scipion
+    def _stepsCheck(self):
+        pass
+
+    @classmethod
+    def worksInStreaming(cls):
+        return True
+
+    # --------------------------- DEFINE param functions ----------------------
+    def _defineParams(self, form):
+        SphireProtCRYOLOTomoPicking._defineParams(self, form)
+
+        self._defineStreamingParams(form)
+        # Default batch size --> 4 tomograms
+        form.getParam('streamingBatchSize').setDefault(4)
+        # Make default 1 minute for sleeping when no new input tomograms
+        form.getParam('streamingSleepOnWait').setDefault(60)
+
+    # --------------------------- INSERT steps functions ----------------------
+    def _insertAllSteps(self):
+        self._insertFunctionStep(self.createConfigStep, self.inputTomograms.get())
+        self._insertFunctionStep(self.pickAllTomogramsStep)
+
+    # --------------------------- STEPS functions -----------------------------
+    def pickAllTomogramsStep(self):
+        # Only needed when running, not when the plugin is loaded
+        from emtools.jobs import Pipeline
+        from emtools.pwx import SetMonitor, BatchManager
+
+        self.info(f">>> {Pretty.now()}: ----------------- "
+                  f"Start processing tomograms----------- ")
+        inputTomos = self.inputTomograms.get()
+        tomosJson = self.getPath('tomograms.json')
+        # Tomograms without particles are missing from the output set,
+        # so we keep a json file with the processed ones
+        if os.path.exists(tomosJson):
+            with open(tomosJson) as f:
+                tomoIds = {int(k): v for k, v in json.load(f)['processed'].items()}
+        elif hasattr(self, 'output3DCoordinates'):
+            tomoAggr = self.output3DCoordinates.aggregate(
+                ["COUNT"], "_volId", ["_volId"])
+            tomoIds = {t["_volId"]: t['COUNT'] for t in tomoAggr}
+        else:
+            tomoIds = {}
+
+        blacklist = [tomo.clone() for tomo in inputTomos if tomo.getObjId() in tomoIds]
+        tomosMonitor = SetMonitor(SetOfTomograms,
+                                  inputTomos.getFileName(),
+                                  blacklist=blacklist)
+
+        self._processedTomos = tomoIds
+        self.tomosMonitor = tomosMonitor
+        tomosIter = tomosMonitor.iterProtocolInput(
+            self, 'tomograms', waitSecs=self.streamingSleepOnWait.get())
+        batchMgr = BatchManager(self.streamingBatchSize.get(), tomosIter,
+                                self._getTmpPath())
+
+        mc = Pipeline()
+        g = mc.addGenerator(batchMgr.generate)
+        gpus = self.getGpuList()
+        outputQueue = None
+        self.info(f">>> GPUS: {gpus}, processed tomograms: {len(self._processedTomos)}")
+        self._updateSummary(inputTomos.getSize())
+
+        for gpu in gpus:
+            p = mc.addProcessor(g.outputQueue, self._getPickProcessor(gpu),
+                                outputQueue=outputQueue)
+            outputQueue = p.outputQueue
+
+        mc.addProcessor(outputQueue, self._updateOutputCoords)
+        mc.run()
+
+        # Mark the output as closed
+        if hasattr(self, 'output3DCoordinates'):
+            self.output3DCoordinates.setStreamState(emobj.Set.STREAM_CLOSED)
+            self._store(self.output3DCoordinates)
+
+    def _getPickProcessor(self, gpu):
+        def _processBatch(batch):
+            t = Timer()
+            self.info(f"BATCH: {batch['index']} Start picking...")
+            # BatchManager links the tomograms into the batch folder,
+            # but they may need conversion for crYOLO
+            tomogramsDir = os.path.join(batch['path'], 'tomograms')
+            pwutils.makePath(tomogramsDir)
+            self._pickTomogramsBatch(batch['items'], tomogramsDir,
+                                     batch['path'], gpu)
+            self.info(f"BATCH: {batch['index']} Done picking...{t.getToc()}")
+            return batch
+        return _processBatch
+
+    def _updateOutputCoords(self, batch):
+        outputName = 'output3DCoordinates'
+        outputCoords = getattr(self, outputName, None)
+        firstTime = outputCoords is None
+
+        if firstTime:
+            outputCoords = self._createSetOfCoordinates3D(self.inputTomograms)
+            outputCoords.setName("tomoCoord")
+            outputCoords.setSamplingRate(self.inputTomograms.get().getSamplingRate())
+            boxSize = None
+        else:
+            outputCoords.enableAppend()
+            boxSize = outputCoords.getBoxSize() or None
+
+        tomoList = batch['items']
+        self.info(f"BATCH: {batch['index']} Reading coords from tomograms: "
+                  f"{','.join(tomo.strId() for tomo in tomoList)}")
+        try:
+            processed = self.readCoordsFromTomos(batch['path'], tomoList,
+                                                 outputCoords, boxSize=boxSize)
+        except Exception as e:
+            self.warning(f"BATCH: {batch['index']} Could not read coordinates "
+                         f"--> {str(e)}. Skipping tomograms: {batch['path']}")
+            processed = {tomo.getObjId(): 0 for tomo in tomoList}
+
+        self._updateOutputSet(outputName, outputCoords, emobj.Set.STREAM_OPEN)
+        self._processedTomos.update(processed)
+        self._updateSummary(self.tomosMonitor.inputCount)
+
+        if firstTime:
+            self._defineSourceRelation(self.inputTomograms, outputCoords)
+        return batch
+
+    def _updateSummary(self, total):
+        """ Update the summary variable based on total processed tomograms. """
+        done = len(self._processedTomos)
+        per = done / total * 100 if total else 0
+        self.summaryVar.set(f"Processed: *{done}* tomograms, "
+                            f"out of {total} ({per:0.2f}%)")
+        self._store(self.summaryVar)
+
+        # Write JSON file with processed tomograms
+        with open(self.getPath('tomograms.json'), 'w') as f:
+            json.dump({'processed': self._processedTomos}, f)
+
+    # --------------------------- INFO functions ------------------------------
+    def _summary(self):
+        summary = SphireProtCRYOLOTomoPicking._summary(self)
+
+        if self.summaryVar.get():
+            summary.append(self.summaryVar.get())
+
+        return summary
@@ -68,9 +68,13 @@ class SphireProtCRYOLOTomoTraining(SphireProtCRYOLOTraining):
             paths.append(self._getExtraPath(d))
             pwutils.makePath(paths[-1])
 
-        tomoList = [tomo.clone() for tomo in inputTomos]
-        convert.writeSetOfCoordinates3D(paths[0], coordSet, tomoList)
-        convert.convertTomograms(tomoList, paths[1])
+        boxes = convert.readCoordBoxes3D(coordSet)
+        boxSize = coordSet.getBoxSize()
+
+        def _writeBoxes():
+            convert.writeCoordBoxes3D(paths[0], boxes, boxSize)
+
+        self._prepareTrainingData(_writeBoxes, inputTomos, paths[1])
 
     # -------------------------- UTILS functions ------------------------------
     def getInputMicrographs(self):
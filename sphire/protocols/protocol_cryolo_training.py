@@ -25,13 +25,25 @@
 # *
 # **************************************************************************
 
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from emtools.utils import Timer
+
 from pwem.protocols import ProtParticlePicking
 import pyworkflow.protocol.params as params
 import pyworkflow.utils as pwutils
 from pyworkflow.object import Integer
+from pyworkflow.project.project import PROJECT_TMP
 
 from .. import Plugin
 from ..objects import CryoloModel
+from ..constants import INPUT_MODEL_GENERAL
+from ..utils import (fileHash, TrainingLogTailer, readTrainingMetrics,
+                     storeModel)
 from .protocol_base import ProtCryoloBase
 import sphire.convert as convert
 
@@ -41,12 +53,24 @@ class SphireProtCRYOLOTraining(ProtCryoloBase, ProtParticlePicking):
     _label = 'cryolo training'
     MODEL = 'model.h5'
     TRAIN = ['train_annotations', 'train_images']
+    FILTERED = 'filtered'
+    TRAIN_LOG = 'training.log'
+    METRICS = 'training_metrics.jsonl'
     _IS_TRAIN = True
 
     # -------------------------- DEFINE param functions -----------------------
     def _defineTrainParams(self, form):
         ProtCryoloBase._defineParams(self, form)
 
+        form.addParam('useFilteredCache', params.BooleanParam, default=True,
+                      condition='lowPassFilter',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label="Reuse filtered images?",
+                      help="Keep the low-pass filtered training images in a "
+                           "cache shared by the training protocols of the "
+                           "project. Next trainings with the same micrographs, "
+                           "cut-off and input size will not filter them again.")
+
         form.addSection(label="Training")
         form.addParam('eFlagParam', params.IntParam, default=10,
                       label="Early stop patience",
@@ -85,8 +109,28 @@ class SphireProtCRYOLOTraining(ProtCryoloBase, ProtParticlePicking):
                            "a good start.")
         self._defineTrainParams(form)
 
+        form.addSection(label="Subset")
+        form.addParam('doSubset', params.BooleanParam, default=False,
+                      label="Train on a subset of micrographs?",
+                      help="Select a subset of the micrographs with "
+                           "coordinates to bound the training time. "
+                           "Micrographs are chosen to be as diverse as "
+                           "possible in number of particles, picking "
+                           "confidence and defocus (if CTFs are provided).")
+        form.addParam('subsetSize', params.IntParam, default=40,
+                      condition='doSubset',
+                      label="Number of micrographs")
+        form.addParam('inputCtfs', params.PointerParam,
+                      pointerClass='SetOfCTF', allowsNull=True,
+                      condition='doSubset',
+                      label="CTFs (optional)",
+                      help="If provided, the defocus of the micrographs is "
+                           "also used to select a diverse subset.")
+
     # --------------------------- INSERT steps functions ----------------------
     def _insertAllSteps(self):
+        if self.getAttributeValue('doSubset', False):
+            self._insertFunctionStep(self.selectSubsetStep)
         self._insertFunctionStep(self.convertInputStep)
         self._insertFunctionStep(self.createConfigStep,
                                  self.getInputMicrographs())
@@ -100,6 +144,45 @@ class SphireProtCRYOLOTraining(ProtCryoloBase, ProtParticlePicking):
         self._insertFunctionStep(self.createOutputStep)
 
     # --------------------------- STEPS functions -----------------------------
+    def selectSubsetStep(self):
+        """ Select the micrographs used for training from aggregated
+        values of the coordinates (and CTFs) and store their ids in
+        the subset json file. """
+        coordSet = self.inputCoordinates.get()
+        inputIds = self.getInputMicrographs().getIdSet()
+        counts = {row['_micId']: row['COUNT']
+                  for row in coordSet.aggregate(['COUNT'], '_micId', ['_micId'])
+                  if row['_micId'] in inputIds}
+        micIds = sorted(counts)
+        features = [[np.log1p(counts[micId]) for micId in micIds]]
+
+        try:  # Only coordinates from crYOLO have a score
+            scoreAggr = coordSet.aggregate(['AVG', 'MIN', 'MAX'],
+                                           '_cryoloScore', ['_micId'])
+            scores = {row['_micId']: row for row in scoreAggr}
+            features.append([scores[micId]['AVG'] for micId in micIds])
+            features.append([scores[micId]['MAX'] - scores[micId]['MIN']
+                             for micId in micIds])
+        except KeyError:
+            self.info("Input coordinates do not have score, "
+                      "not using it for the subset selection.")
+
+        if self.inputCtfs.get() is not None:
+            defocus = {ctf.getMicrograph().getObjId(): ctf.getDefocusU() + ctf.getDefocusV()
+                       for ctf in self.inputCtfs.get().iterItems()}
+            values = np.array([defocus.get(micId, np.nan) for micId in micIds]) / 2
+            values[np.isnan(values)] = np.nanmean(values) if np.isfinite(values).any() else 0
+            features.append(values)
+
+        selected = convert.selectDiverseSubset(np.array(features).T,
+                                               self.subsetSize.get())
+        subsetIds = sorted(micIds[i] for i in selected)
+        self.info(f"Selected {len(subsetIds)} micrographs out of {len(micIds)} "
+                  f"with coordinates.")
+
+        with open(self.getSubsetFile(), 'w') as f:
+            json.dump({'micIds': subsetIds}, f)
+
     def convertInputStep(self):
         """ Converts a set of coordinates to box files and binaries to mrc.
         It generates 2 folders: one for the box files and another for
@@ -113,29 +196,104 @@ class SphireProtCRYOLOTraining(ProtCryoloBase, ProtParticlePicking):
             paths.append(self._getExtraPath(d))
             pwutils.makePath(paths[-1])
 
-        micList = [mic.clone() for mic in inputMics]
-        convert.writeSetOfCoordinates(paths[0], coordSet, micList)
-        convert.convertMicrographs(micList, paths[1])
+        micIds = self.getSubsetIds()
+        boxes = convert.readCoordBoxes(coordSet, micIds=micIds)
+        boxSize = coordSet.getBoxSize()
+        mic = coordSet.getMicrographs().getFirstItem()
+        yFlipHeight = convert.getFlipYHeight(mic.getFileName())
+
+        def _writeBoxes():
+            convert.writeCoordBoxes(paths[0], boxes, boxSize, yFlipHeight)
+
+        self._prepareTrainingData(_writeBoxes, inputMics, paths[1],
+                                  imageIds=micIds)
+
+    def _prepareTrainingData(self, writeBoxesFunc, inputImages, imagesDir,
+                             imageIds=None):
+        """ Write the coordinate files in a separate thread, while the
+        input images are converted (or linked) into imagesDir by a pool
+        of threads, iterating the input set without cloning its items.
+        Sets are only read from the calling thread, so writeBoxesFunc
+        must write coordinates already read from the input set.
+        If imageIds is not None, only these images are used.
+        """
+        t = Timer("Training data prepared in")
+        if imageIds is not None:
+            inputImages = (img for img in inputImages
+                           if img.getObjId() in imageIds)
+
+        def _runStage(label, func, *args, **kwargs):
+            tStage = Timer(f"{label} done in")
+            func(*args, **kwargs)
+            self.info(tStage.getToc())
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            boxesFuture = executor.submit(_runStage, "Coordinate files",
+                                          writeBoxesFunc)
+            _runStage("Images conversion", convert.convertMicrographs,
+                      inputImages, imagesDir,
+                      numberOfThreads=max(1, self.numberOfThreads.get()))
+            boxesFuture.result()
+
+        self.info(t.getToc())
 
     def cryoloTrainingStep(self, extraArgs=''):
+        cacheKeys = self._getFilteredCacheKeys() if self.usingFilteredCache() else None
+        self._runCryoloTrain(self._getExtraPath(), '%(GPU)s',
+                             patience=self.eFlagParam.get(),
+                             batchSize=self.batchSize.get(),
+                             extraArgs=extraArgs, cacheKeys=cacheKeys)
+
+        pwutils.moveFile(self._getExtraPath(self.MODEL),
+                         self.getOutputModelPath())
+
+    def _runCryoloTrain(self, workingDir, gpuId, patience, batchSize,
+                        extraArgs='', cacheKeys=None, echo=None):
+        """ Run crYOLO training with the config.json file in workingDir.
+        The output is parsed while training to write the epochs metrics
+        in the same folder.
+        """
         params = " -c config.json"
         params += " -w %d" % (0 if self.doFineTune else 5)
-        params += " -g %(GPU)s"
+        params += " -g %s" % gpuId
         params += " -nc %d" % self.numCpus.get()
-        params += " -e %d" % self.eFlagParam
-        if self.lowPassFilter:
+        params += " -e %d" % patience
+        if cacheKeys is not None:
+            self._restoreFilteredImages(cacheKeys, workingDir)
+        elif self.lowPassFilter:
             params += " --cleanup"
         params += extraArgs
 
-        Plugin.runCryolo(self, 'cryolo_train.py', params,
-                         cwd=self._getExtraPath())
+        logFile = os.path.join(workingDir, self.TRAIN_LOG)
+        metricsFile = os.path.join(workingDir, self.METRICS)
+        pwutils.cleanPath(logFile, metricsFile)
+        params += f" > {self.TRAIN_LOG} 2>&1"
+        tailer = TrainingLogTailer(logFile, metricsFile, batchSize=batchSize,
+                                   echo=echo or self.info)
+        tailer.start()
 
-        pwutils.moveFile(self._getExtraPath(self.MODEL),
-                         self.getOutputModelPath())
+        try:
+            Plugin.runCryolo(self, 'cryolo_train.py', params, cwd=workingDir)
+        finally:
+            tailer.stop()
+
+        if cacheKeys is not None:
+            self._storeFilteredImages(cacheKeys, workingDir)
 
     def createOutputStep(self):
-        """ Register the output model. """
-        self._defineOutputs(outputModel=CryoloModel(self.getOutputModelPath()))
+        """ Register the output model, the weights are added to the
+        project models store. """
+        outputPath = self.getOutputModelPath()
+        model = CryoloModel(outputPath)
+        model.setFileInfo(storeModel(outputPath, outputPath, move=True))
+
+        with open(self._getExtraPath('config.json')) as f:
+            config = json.load(f)['model']
+        model.setArchitecture(config['architecture'])
+        model.setInputSize(config['input_size'])
+        model.setProvenance(self.getModelProvenance())
+
+        self._defineOutputs(outputModel=model)
 
     # --------------------------- INFO functions ------------------------------
     def _summary(self):
@@ -148,6 +306,25 @@ class SphireProtCRYOLOTraining(ProtCryoloBase, ProtParticlePicking):
         else:
             summary.append("Training a new model from scratch")
 
+        metrics = readTrainingMetrics(self.getMetricsFile())
+        if metrics:
+            last = metrics[-1]
+            best = min(metrics, key=lambda r: r.get('val_loss', float('inf')))
+            epochTime = sum(r['time'] for r in metrics) / len(metrics)
+            summary.append(f"Epochs: {last['epoch']}/{last['epochs']}, "
+                           f"loss: {last.get('loss')}, "
+                           f"val_loss: {last.get('val_loss')} "
+                           f"(best {best.get('val_loss')} at epoch {best['epoch']})")
+            line = f"Mean epoch time: {epochTime:0.1f} s"
+            if 'images_per_sec' in last:
+                rate = sum(r.get('images_per_sec', 0) for r in metrics) / len(metrics)
+                line += f" ({rate:0.2f} images/s)"
+            summary.append(line)
+
+        subsetIds = self.getSubsetIds()
+        if subsetIds is not None:
+            summary.append(f"Trained on a subset of {len(subsetIds)} micrographs")
+
         return summary
 
     def _methods(self):
@@ -156,5 +333,116 @@ class SphireProtCRYOLOTraining(ProtCryoloBase, ProtParticlePicking):
         return methods
 
     # -------------------------- UTILS functions ------------------------------
+    def getMetricsFile(self):
+        return self._getExtraPath(self.METRICS)
+
+    def getSubsetFile(self):
+        return self._getExtraPath('subset.json')
+
+    def getSubsetIds(self):
+        """ Return the ids of the selected micrographs for training,
+        or None if all of them are used. """
+        if not os.path.exists(self.getSubsetFile()):
+            return None
+
+        with open(self.getSubsetFile()) as f:
+            return set(json.load(f)['micIds'])
+
+    def usingFilteredCache(self):
+        return bool(self.lowPassFilter and
+                    self.getAttributeValue('useFilteredCache', True))
+
+    def getFilteredCachePath(self, *paths):
+        """ Cache of filtered images shared by all protocols of the project
+        (protocols are executed from the project folder). """
+        return os.path.join(PROJECT_TMP, 'cryolo_filtered_cache', *paths)
+
+    def _getFilteredCacheKeys(self):
+        """ Return a dict with the cache key of each training image,
+        indexed by its name without extension. The key identifies the
+        image content, the filter cut-off and crYOLO input size. """
+        imagesDir = self._getExtraPath(self.TRAIN[1])
+        cutOff = self.getLowPassCutOff(self.getInputMicrographs().getSamplingRate())
+        inputSize = convert.roundInputSize(self.input_size.get())
+        keys = {}
+
+        for fn in os.listdir(imagesDir):
+            imgHash = fileHash(os.path.join(imagesDir, fn), blockSize=1024 * 1024)
+            keys[pwutils.removeExt(fn)] = f"{imgHash}_{cutOff:0.4f}_{inputSize}"
+
+        return keys
+
+    def _restoreFilteredImages(self, cacheKeys, workingDir):
+        """ Link the cached filtered images where crYOLO expects them,
+        it will skip filtering the images that already exist. """
+        filteredDir = os.path.join(workingDir, self.FILTERED)
+        restored = 0
+
+        for key in cacheKeys.values():
+            entryDir = self.getFilteredCachePath(key)
+            if not os.path.isdir(entryDir):
+                continue
+            for root, _, files in os.walk(entryDir):
+                relRoot = os.path.relpath(root, entryDir)
+                for fn in files:
+                    dest = os.path.join(filteredDir, relRoot, fn)
+                    pwutils.makePath(os.path.dirname(dest))
+                    pwutils.createAbsLink(os.path.abspath(os.path.join(root, fn)),
+                                          dest)
+            restored += 1
+
+        self.info(f"Filtered images found in cache: {restored} "
+                  f"out of {len(cacheKeys)}")
+
+    def _storeFilteredImages(self, cacheKeys, workingDir):
+        """ Move the new filtered images from crYOLO into the cache and
+        remove the filtered folder, as done by crYOLO with --cleanup. """
+        filteredDir = os.path.join(workingDir, self.FILTERED)
+
+        for root, _, files in os.walk(filteredDir):
+            relRoot = os.path.relpath(root, filteredDir)
+            for fn in files:
+                path = os.path.join(root, fn)
+                key = cacheKeys.get(pwutils.removeExt(fn))
+                if key is None or os.path.islink(path):
+                    continue
+                entryDir = self.getFilteredCachePath(key)
+                if os.path.exists(entryDir):
+                    continue
+                # Other training could be storing the same image, so
+                # write in a temporary folder and then rename it
+                tmpDir = f"{entryDir}.{os.getpid()}"
+                pwutils.makePath(os.path.join(tmpDir, relRoot))
+                pwutils.moveFile(path, os.path.join(tmpDir, relRoot, fn))
+                try:
+                    os.rename(tmpDir, entryDir)
+                except OSError:
+                    pwutils.cleanPath(tmpDir)
+
+        pwutils.cleanPath(filteredDir)
+
+    def getModelProvenance(self, metricsFile=None):
+        """ Return a dict describing how the output model was trained. """
+        metrics = readTrainingMetrics(metricsFile or self.getMetricsFile())
+        provenance = {
+            'protocol': self.getObjId(),
+            'images': len(os.listdir(self._getExtraPath(self.TRAIN[1]))),
+            'learning_rate': self.learning_rates.get(),
+            'batch_size': self.batchSize.get(),
+            'patience': self.eFlagParam.get(),
+            'epochs': len(metrics),
+            'val_loss': metrics[-1].get('val_loss') if metrics else None,
+            'pretrained': None
+        }
+
+        if self.doFineTune:
+            if self.inputModelFrom == INPUT_MODEL_GENERAL:
+                provenance['pretrained'] = os.path.basename(self.getInputModel())
+            else:
+                inputModel = self.inputModel.get()
+                provenance['pretrained'] = inputModel.getHash() or inputModel.getPath()
+
+        return provenance
+
     def getOutputModelPath(self):
         return self._getPath(self.MODEL)
@@ -0,0 +1,227 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import copy
+import json
+import queue
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+import pyworkflow.protocol.params as params
+import pyworkflow.utils as pwutils
+
+from ..utils import readTrainingMetrics
+from .protocol_cryolo_training import SphireProtCRYOLOTraining
+
+
+class SphireProtCRYOLOTrainingSweep(SphireProtCRYOLOTraining):
+    """ Train several crYOLO models combining different learning rates,
+    batch sizes and early stop patience values. The training data is
+    prepared only once and trainings run concurrently on the selected
+    GPUs. The model with the lowest final validation loss is registered.
+    """
+    _label = 'cryolo training sweep'
+    SWEEP_PARAMS = ['learning_rates', 'batchSize', 'eFlagParam']
+
+    # -------------------------- DEFINE param functions -----------------------
+    def _defineParams(self, form):
+        SphireProtCRYOLOTraining._defineParams(self, form)
+
+        # Single values are replaced by the lists below
+        for paramName in self.SWEEP_PARAMS:
+            form.getParam(paramName).condition.set('False')
+
+        form.addSection(label="Sweep")
+        form.addParam('sweepLearningRates', params.StringParam,
+                      default='1e-4 5e-5',
+                      label="Learning rates",
+                      help="List of learning rates (separated by spaces) "
+                           "to be tried.")
+        form.addParam('sweepBatchSizes', params.StringParam, default='4',
+                      label="Batch sizes",
+                      help="List of batch sizes (separated by spaces) "
+                           "to be tried.")
+        form.addParam('sweepPatience', params.StringParam, default='10',
+                      label="Early stop patience values",
+                      help="List of early stop patience values (separated "
+                           "by spaces) to be tried.")
+        form.addParam('runsPerGpu', params.IntParam, default=1,
+                      label="Trainings per GPU",
+                      help="Maximum number of trainings running at the "
+                           "same time on each GPU.")
+
+    # --------------------------- INSERT steps functions ----------------------
+    def _insertAllSteps(self):
+        if self.doSubset:
+            self._insertFunctionStep(self.selectSubsetStep)
+        self._insertFunctionStep(self.convertInputStep)
+        self._insertFunctionStep(self.createConfigStep,
+                                 self.getInputMicrographs())
+        self._insertFunctionStep(self.sweepStep)
+        self._insertFunctionStep(self.createOutputStep)
+
+    # --------------------------- STEPS functions -----------------------------
+    def sweepStep(self):
+        with open(self._getExtraPath('config.json')) as f:
+            config = json.load(f)
+
+        cacheKeys = self._getFilteredCacheKeys() if self.usingFilteredCache() else None
+        runs = self.getSweepRuns()
+        # Each GPU is available for a number of concurrent trainings
+        slots = queue.Queue()
+        for gpu in self.getGpuList():
+            for _ in range(self.runsPerGpu.get()):
+                slots.put(gpu)
+
+        def _train(run):
+            runDir = self._getExtraPath(run['name'])
+            pwutils.cleanPath(runDir)
+            pwutils.makePath(runDir)
+            for d in self.TRAIN:
+                pwutils.createAbsLink(os.path.abspath(self._getExtraPath(d)),
+                                      os.path.join(runDir, d))
+            runConfig = copy.deepcopy(config)
+            runConfig['train'].update({'learning_rate': run['learning_rate'],
+                                       'batch_size': run['batch_size']})
+            with open(os.path.join(runDir, 'config.json'), 'w') as f:
+                json.dump(runConfig, f, indent=4)
+
+            gpu = slots.get()
+            try:
+                self.info(f"{run['name']}: training on GPU {gpu}")
+                self._runCryoloTrain(
+                    runDir, gpu, patience=run['patience'],
+                    batchSize=run['batch_size'],
+                    extraArgs=' --fine_tune -lft 2' if self.doFineTune else '',
+                    cacheKeys=cacheKeys,
+                    echo=lambda line: self.info(f"{run['name']}: {line}"))
+            except Exception as e:
+                self.warning(f"{run['name']}: training failed --> {str(e)}")
+            finally:
+                slots.put(gpu)
+
+        with ThreadPoolExecutor(max_workers=slots.qsize()) as executor:
+            for f in [executor.submit(_train, run) for run in runs]:
+                f.result()
+
+        results = [self._getRunResult(run) for run in runs]
+        with open(self.getSweepFile(), 'w') as f:
+            json.dump(results, f, indent=4)
+
+        trained = [r for r in results if r['model'] and r['val_loss'] is not None]
+        if not trained:
+            raise Exception("No model could be trained, check the log "
+                            "files of each run.")
+
+        best = min(trained, key=lambda r: r['val_loss'])
+        self.info(f"Best model: {best['name']} (epoch: {best['best_epoch']}, "
+                  f"val_loss: {best['val_loss']})")
+        pwutils.copyFile(best['model'], self.getOutputModelPath())
+        pwutils.copyFile(os.path.join(os.path.dirname(best['model']), self.METRICS),
+                         self.getMetricsFile())
+        with open(self._getExtraPath('best_run.json'), 'w') as f:
+            json.dump(best, f, indent=4)
+
+    def _getRunResult(self, run):
+        runDir = self._getExtraPath(run['name'])
+        metrics = readTrainingMetrics(os.path.join(runDir, self.METRICS))
+        modelFn = os.path.join(runDir, self.MODEL)
+        # crYOLO saves the weights of the epoch with the lowest val_loss,
+        # so runs are compared by that epoch and not by the last one
+        validated = [m for m in metrics if m.get('val_loss') is not None]
+        bestEpoch = min(validated, key=lambda m: m['val_loss']) if validated else {}
+        result = dict(run)
+        result.update({
+            'epochs': len(metrics),
+            'best_epoch': bestEpoch.get('epoch'),
+            'loss': bestEpoch.get('loss'),
+            'val_loss': bestEpoch.get('val_loss'),
+            'epoch_time': (sum(r['time'] for r in metrics) / len(metrics)
+                           if metrics else None),
+            'model': modelFn if os.path.exists(modelFn) else None
+        })
+        return result
+
+    # --------------------------- INFO functions ------------------------------
+    def _summary(self):
+        summary = []
+
+        if not os.path.exists(self.getSweepFile()):
+            summary.append(f"Trainings to run: {len(self.getSweepRuns())}")
+            return summary
+
+        with open(self.getSweepFile()) as f:
+            results = json.load(f)
+
+        summary.append("Run | learning rate | batch size | patience | "
+                       "epochs | best epoch | loss | val_loss | epoch time (s)")
+        for r in results:
+            epochTime = '-' if r['epoch_time'] is None else f"{r['epoch_time']:0.1f}"
+            summary.append(f"{r['name']} | {r['learning_rate']} | "
+                           f"{r['batch_size']} | {r['patience']} | "
+                           f"{r['epochs']} | {r.get('best_epoch', '-')} | "
+                           f"{r['loss']} | {r['val_loss']} | {epochTime}")
+
+        return summary
+
+    def _validate(self):
+        validateMsgs = SphireProtCRYOLOTraining._validate(self)
+
+        try:
+            if not self.getSweepRuns():
+                validateMsgs.append("At least one value should be provided "
+                                    "for each of the sweep parameters.")
+        except ValueError:
+            validateMsgs.append("Sweep parameters should be lists of numbers "
+                                "separated by spaces.")
+
+        return validateMsgs
+
+    # -------------------------- UTILS functions ------------------------------
+    def getModelProvenance(self, metricsFile=None):
+        provenance = SphireProtCRYOLOTraining.getModelProvenance(self, metricsFile)
+
+        with open(self._getExtraPath('best_run.json')) as f:
+            best = json.load(f)
+        provenance.update({'learning_rate': best['learning_rate'],
+                           'batch_size': best['batch_size'],
+                           'patience': best['patience'],
+                           'sweep_run': best['name'],
+                           'best_epoch': best.get('best_epoch')})
+        return provenance
+
+    def getSweepFile(self):
+        return self._getExtraPath('sweep_results.json')
+
+    def getSweepRuns(self):
+        """ Return the list of trainings for all parameter combinations. """
+        combinations = itertools.product(
+            [float(v) for v in self.sweepLearningRates.get('').split()],
+            [int(v) for v in self.sweepBatchSizes.get('').split()],
+            [int(v) for v in self.sweepPatience.get('').split()])
+
+        return [{'name': 'run_%03d' % (i + 1), 'learning_rate': lr,
+                 'batch_size': bs, 'patience': patience}
+                for i, (lr, bs, patience) in enumerate(combinations)]
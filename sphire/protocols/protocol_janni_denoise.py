@@ -26,16 +26,18 @@
 
 import os
 from os.path import basename, exists
+from concurrent.futures import ThreadPoolExecutor
 import logging
 logger = logging.getLogger(__name__)
 
 
 from pyworkflow.protocol import params, ValidationException
-from pyworkflow.utils import moveTree, createLink, Message
+from pyworkflow.utils import moveTree, createLink, makePath, Message
 from pwem.protocols import ProtMicrographs
 
 from .. import Plugin
 from ..constants import JANNI_GENMOD_VAR, JANNI_GENMOD
+from ..utils import scanDir
 
 
 class SphireProtJanniDenoising(ProtMicrographs):
@@ -51,8 +53,10 @@ class SphireProtJanniDenoising(ProtMicrographs):
         form.addSection(label=Message.LABEL_INPUT)
         form.addHidden(params.GPU_LIST, params.StringParam,
                        default='0',
-                       label="Choose GPU ID",
-                       help="JANNI works on a single GPU.")
+                       label="Choose GPU IDs",
+                       help="JANNI works on a single GPU, if several GPUs "
+                            "are given, the micrographs will be split and "
+                            "one JANNI process will run on each GPU.")
         form.addParam('inputMicrographs',
                       params.PointerParam,
                       pointerClass='SetOfMicrographs',
@@ -65,22 +69,36 @@ class SphireProtJanniDenoising(ProtMicrographs):
 
     def denoisingStep(self):
         input_mics = self.inputMicrographs.get()
-        # Create links to the movies desired to denoise in tmp folder
-        # janni only accepts directories
-        for mic in input_mics:
+        # Do not start JANNI on GPUs without micrographs
+        gpus = self.getGpuList()[:max(input_mics.getSize(), 1)]
+        # Create links to the micrographs desired to denoise in one
+        # tmp folder per GPU, janni only accepts directories
+        shardDirs = [self._getTmpPath('mics_%02d' % i) for i in range(len(gpus))]
+        for shardDir in shardDirs:
+            makePath(shardDir)
+
+        for i, mic in enumerate(input_mics):
             micName = mic.getFileName()
-            createLink(micName, self._getTmpPath(basename(micName)))
-
-        args = [
-            f"denoise -g {self.gpuList.get()}",
-            f"{self._getTmpPath()}/",
-            f"{self._getTmpPath()}/",
-            f"{self.getInputModel()}"
-        ]
-        Plugin.runCryolo(self, 'janni_denoise.py', " ".join(args))
-
-        # Move the output to the extra folder
-        moveTree(self._getTmpPath("tmp"), self._getExtraPath())
+            createLink(micName, os.path.join(shardDirs[i % len(gpus)],
+                                             basename(micName)))
+
+        with ThreadPoolExecutor(max_workers=len(gpus)) as executor:
+            futures = [executor.submit(self._denoiseDir, shardDir, gpu)
+                       for shardDir, gpu in zip(shardDirs, gpus)]
+            for f in futures:
+                f.result()
+
+        # Move the output to the extra folder, each process wrote
+        # in its own folder and micrograph names are unique
+        for shardDir in shardDirs:
+            outputDir = os.path.join(shardDir, basename(shardDir))
+            if exists(outputDir):
+                moveTree(outputDir, self._getExtraPath())
+
+    def _denoiseDir(self, micDir, gpu):
+        """ Run JANNI over all micrographs in micDir using the given GPU.
+        JANNI writes the results in a subfolder with the name of micDir. """
+        Plugin.runJanni(self, micDir, micDir, gpu, model=self.getInputModel())
 
     def createOutputStep(self):
         in_mics = self.inputMicrographs.get()
@@ -88,10 +106,11 @@ class SphireProtJanniDenoising(ProtMicrographs):
         out_mics.copyInfo(in_mics)
 
         n_failed_mics = 0
+        outputIndex = scanDir(self._getExtraPath())
         for mic in in_mics:
-            current_out_mic = self._getExtraPath(basename(mic.getFileName()))
-            if exists(current_out_mic):
-                mic.setFileName(current_out_mic)
+            micName = basename(mic.getFileName())
+            if micName in outputIndex:
+                mic.setFileName(self._getExtraPath(micName))
                 out_mics.append(mic)
             else:
                 n_failed_mics += 1
@@ -125,9 +144,6 @@ class SphireProtJanniDenoising(ProtMicrographs):
         validateMsgs = []
         modelPath = self.getInputModel()
 
-        if len(self.getGpuList()) > 1:
-            validateMsgs.append("Multiple GPUs cannot be used by JANNI.")
-
         if not os.path.exists(modelPath):
             validateMsgs.append(f"Input model file {modelPath} does not exist."
                                 f"Check your config or scipion installb {JANNI_GENMOD}")
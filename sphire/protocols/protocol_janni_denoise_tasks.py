@@ -0,0 +1,190 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# **************************************************************************
+
+import os
+import json
+
+from emtools.utils import Timer, Pretty
+
+import pyworkflow.protocol.constants as cons
+from pyworkflow.utils import moveTree
+import pwem.objects as emobj
+
+from ..utils import scanDir
+from .protocol_janni_denoise import SphireProtJanniDenoising
+
+
+class SphireProtJanniDenoisingTasks(SphireProtJanniDenoising):
+    """ Protocol to denoise a set of micrographs in streaming.
+    New input micrographs are denoised in batches and the output
+    micrographs are updated after each batch.
+    """
+    _label = 'janni denoising tasks'
+    stepsExecutionMode = cons.STEPS_SERIAL
+
+    def __init__(self, **kwargs):
+        SphireProtJanniDenoising.__init__(self, **kwargs)
+        # Disable parallelization options just take into account GPUs
+        self.numberOfMpi.set(0)
+        self.numberOfThreads.set(0)
+        self.allowMpi = False
+        self.allowThreads = False
+
+    # We are not using the steps mechanism for parallelism from Scipion
+    def _stepsCheck(self):
+        pass
+
+    @classmethod
+    def worksInStreaming(cls):
+        return True
+
+    # -------------------------- DEFINE param functions -----------------------
+    def _defineParams(self, form):
+        SphireProtJanniDenoising._defineParams(self, form)
+
+        self._defineStreamingParams(form)
+        # Default batch size --> 16
+        form.getParam('streamingBatchSize').setDefault(16)
+        # Make default 1 minute for sleeping when no new input micrographs
+        form.getParam('streamingSleepOnWait').setDefault(60)
+
+    # --------------------------- INSERT steps functions ----------------------
+    def _insertAllSteps(self):
+        self._insertFunctionStep(self.denoiseAllMicrographsStep)
+
+    # --------------------------- STEPS functions -----------------------------
+    def denoiseAllMicrographsStep(self):
+        # Only needed when running, not when the plugin is loaded
+        from emtools.jobs import Pipeline
+        from emtools.pwx import SetMonitor, BatchManager
+
+        self.info(f">>> {Pretty.now()}: ----------------- "
+                  f"Start processing micrographs----------- ")
+        inputMics = self.inputMicrographs.get()
+        micsJson = self.getPath('micrographs.json')
+
+        if os.path.exists(micsJson):
+            with open(micsJson) as f:
+                micIds = set(json.load(f)['processed'])
+        elif hasattr(self, 'outputMicrographs'):
+            micIds = set(self.outputMicrographs.getIdSet())
+        else:
+            micIds = set()
+
+        blacklist = [mic.clone() for mic in inputMics if mic.getObjId() in micIds]
+        micsMonitor = SetMonitor(emobj.SetOfMicrographs,
+                                 inputMics.getFileName(),
+                                 blacklist=blacklist)
+
+        self._processedMics = micIds
+        self.micsMonitor = micsMonitor
+        micsIter = micsMonitor.iterProtocolInput(
+            self, 'micrographs', waitSecs=self.streamingSleepOnWait.get())
+        batchMgr = BatchManager(self.streamingBatchSize.get(), micsIter,
+                                self._getTmpPath())
+
+        mc = Pipeline()
+        g = mc.addGenerator(batchMgr.generate)
+        gpus = self.getGpuList()
+        outputQueue = None
+        self.info(f">>> GPUS: {gpus}, processed micrographs: {len(self._processedMics)}")
+        self._updateSummary(inputMics.getSize())
+
+        for gpu in gpus:
+            p = mc.addProcessor(g.outputQueue, self._getDenoiseProcessor(gpu),
+                                outputQueue=outputQueue)
+            outputQueue = p.outputQueue
+
+        mc.addProcessor(outputQueue, self._updateOutputMics)
+        mc.run()
+
+        # Mark the output as closed
+        if hasattr(self, 'outputMicrographs'):
+            self.outputMicrographs.setStreamState(emobj.Set.STREAM_CLOSED)
+            self._store(self.outputMicrographs)
+
+    def _getDenoiseProcessor(self, gpu):
+        def _processBatch(batch):
+            t = Timer()
+            self.info(f"BATCH: {batch['index']} Start denoising...")
+            # BatchManager already links the micrographs in the batch folder
+            self._denoiseDir(batch['path'], gpu)
+            outputDir = os.path.join(batch['path'], os.path.basename(batch['path']))
+            # Keep the names of the denoised micrographs of this batch
+            batch['outputs'] = scanDir(outputDir)
+            if batch['outputs']:
+                moveTree(outputDir, self._getExtraPath())
+            self.info(f"BATCH: {batch['index']} Done denoising...{t.getToc()}")
+            return batch
+        return _processBatch
+
+    def _updateOutputMics(self, batch):
+        outputName = 'outputMicrographs'
+        outputMics = getattr(self, outputName, None)
+        firstTime = outputMics is None
+
+        if firstTime:
+            outputMics = self._createSetOfMicrographs()
+            outputMics.copyInfo(self.inputMicrographs.get())
+        else:
+            outputMics.enableAppend()
+
+        failed = []
+        for mic in batch['items']:
+            micName = os.path.basename(mic.getFileName())
+            if micName in batch['outputs']:
+                mic.setFileName(self._getExtraPath(micName))
+                outputMics.append(mic)
+            else:
+                failed.append(mic.getFileName())
+            self._processedMics.add(mic.getObjId())
+
+        if failed:
+            self.warning(f"BATCH: {batch['index']} Failed to process the "
+                         f"micrographs: {', '.join(failed)}")
+
+        self._updateOutputSet(outputName, outputMics, emobj.Set.STREAM_OPEN)
+        self._updateSummary(self.micsMonitor.inputCount)
+
+        if firstTime:
+            self._defineTransformRelation(self.inputMicrographs, outputMics)
+        return batch
+
+    def _updateSummary(self, total):
+        """ Update the summary variable based on total processed micrographs. """
+        done = len(self._processedMics)
+        per = done / total * 100 if total else 0
+        self.summaryVar.set(f"Processed: *{done}* micrographs, "
+                            f"out of {total} ({per:0.2f}%)")
+        self._store(self.summaryVar)
+
+        # Write JSON file with processed micrographs
+        with open(self.getPath('micrographs.json'), 'w') as f:
+            json.dump({'processed': sorted(self._processedMics)}, f)
+
+    # --------------------------- INFO functions ------------------------------
+    def _summary(self):
+        summary = [f"Denoising using model: {self.getInputModel()}"]
+
+        if self.summaryVar.get():
+            summary.append(self.summaryVar.get())
+
+        return summary
@@ -0,0 +1,204 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+
+import numpy as np
+
+import pyworkflow.utils as pwutils
+from pyworkflow.utils import magentaStr
+import pwem.objects as emobj
+from pwem.protocols import ProtImportMicrographs
+from pwem.emlib.image import ImageHandler
+
+from .. import Plugin, convert
+from ..constants import CRYOLO_FAKE, CRYOLO_CUDA_LIB, JANNI_GENMOD_VAR
+
+
+def setupFakeCryolo(cls):
+    """ Run the crYOLO and JANNI programs of the test case cls with the
+    stand-in programs, which need neither CUDA, a GPU nor the general
+    models. The environment is restored by restoreEnviron(cls).
+    Call it after setupTestProject(cls) or setupTestOutput(cls).
+    """
+    cls._environ = dict(os.environ)
+    os.environ[CRYOLO_FAKE] = 'True'
+    # Only validation checks these paths, point them to dummy ones
+    tmpDir = os.path.abspath(cls.proj.getTmpPath() if hasattr(cls, 'proj')
+                             else cls.getOutputPath())
+    pwutils.makePath(tmpDir)
+    cudaLib = os.environ.get(CRYOLO_CUDA_LIB, Plugin.getVar(CRYOLO_CUDA_LIB))
+    if not cudaLib or not os.path.isdir(cudaLib):
+        os.environ[CRYOLO_CUDA_LIB] = tmpDir
+    janniModel = os.environ.get(JANNI_GENMOD_VAR, Plugin.getVar(JANNI_GENMOD_VAR))
+    if not janniModel or not os.path.exists(janniModel):
+        modelFn = os.path.join(tmpDir, 'janni_model.h5')
+        open(modelFn, 'w').close()
+        os.environ[JANNI_GENMOD_VAR] = modelFn
+    Plugin._defineVariables()
+
+
+def restoreEnviron(cls):
+    """ Restore the environment saved by setupFakeCryolo(cls). """
+    os.environ.clear()
+    os.environ.update(cls._environ)
+    Plugin._defineVariables()
+
+
+def importSyntheticMics(cls, nMics, dim):
+    """ Import nMics empty micrographs of dim x dim pixels. """
+    micsDir = os.path.abspath(cls.proj.getTmpPath('synthetic_mics'))
+    pwutils.makePath(micsDir)
+    for i in range(nMics):
+        ImageHandler().createEmptyImage(
+            os.path.join(micsDir, 'mic_%02d.mrc' % (i + 1)), dim, dim)
+
+    protImport = cls.newProtocol(
+        ProtImportMicrographs,
+        filesPath=micsDir,
+        filesPattern='mic_*.mrc',
+        samplingRate=1.0)
+    print(magentaStr(f"\n==> Importing data - synthetic micrographs:"))
+    cls.launchProtocol(protImport)
+    return protImport
+
+
+def getOutputDir(test, name):
+    """ Return the folder name in the test output, created empty. """
+    path = test.getOutputPath(name)
+    pwutils.cleanPath(path)
+    os.makedirs(path)
+    return path
+
+
+# ---------------------- Synthetic data generators ----------------------------
+CBOX_3D_HEADER = """
+data_cryolo
+
+loop_
+_CoordinateX #1
+_CoordinateY #2
+_CoordinateZ #3
+_Width #4
+_Height #5
+_Depth #6
+_filamentid #7
+_Confidence #8
+_EstWidth #9
+_EstHeight #10
+_NumBoxes #11
+"""
+
+
+def randomPositions(n, dim=4096, seed=0):
+    """ Return a (n, 3) array with random x, y, z positions. """
+    return np.random.default_rng(seed).uniform(0, dim, size=(n, 3)).round()
+
+
+def writeSyntheticCbox(filename, n, box=64, is3D=False, seed=0):
+    pos = randomPositions(n, seed=seed)
+    conf = np.random.default_rng(seed).uniform(0.3, 1, size=n)
+    if is3D:
+        rows = np.column_stack([pos, np.full((n, 3), box), np.zeros(n), conf,
+                                np.full((n, 2), box), np.full(n, 10)])
+        with open(filename, 'w') as f:
+            f.write(CBOX_3D_HEADER)
+            np.savetxt(f, rows, fmt='%g', delimiter='\t')
+    else:
+        boxes = np.column_stack([pos[:, :2], np.full((n, 2), box), conf])
+        convert.writeCboxBoxes(filename, boxes)
+
+
+def writeSyntheticCoords(filename, n, seed=0):
+    np.savetxt(filename, randomPositions(n, seed=seed), fmt='%d')
+
+
+def createSyntheticMics(outputDir, nMics, dim=64):
+    """ Create a set of micrographs (in memory), their files are links
+    to the same small image. """
+    micFn = os.path.join(outputDir, 'synthetic_mic.mrc')
+    ImageHandler().createEmptyImage(micFn, dim, dim)
+    mics = emobj.SetOfMicrographs(filename=':memory:')
+    mics.setSamplingRate(1.0)
+    for i in range(nMics):
+        linkFn = os.path.join(outputDir, 'mic_%06d.mrc' % (i + 1))
+        if not os.path.exists(linkFn):
+            os.symlink(os.path.basename(micFn), linkFn)
+        mics.append(emobj.Micrograph(location=linkFn))
+    mics.write()
+    return mics
+
+
+def createSyntheticCoords(mics, perMic, box=64, seed=0):
+    """ Create a set of coordinates (in memory) with perMic random
+    coordinates for each micrograph. """
+    coordSet = emobj.SetOfCoordinates(filename=':memory:')
+    coordSet.setMicrographs(mics)
+    coordSet.setBoxSize(box)
+    coord = emobj.Coordinate()
+    for i, mic in enumerate(mics):
+        for x, y, _ in randomPositions(perMic, seed=seed + i):
+            coord.setObjId(None)
+            coord.setMicrograph(mic)
+            coord.setPosition(int(x), int(y))
+            coordSet.append(coord)
+    coordSet.write()
+    return coordSet
+
+
+def createSyntheticCoords3D(outputDir, nTomos, perTomo, box=64, seed=0,
+                            filename=':memory:'):
+    """ Create a set of tomograms and a set of 3D coordinates (in memory,
+    unless filename is given) with perTomo random coordinates for each
+    tomogram. """
+    from tomo.objects import SetOfTomograms, Tomogram, SetOfCoordinates3D, Coordinate3D
+    from tomo.constants import BOTTOM_LEFT_CORNER
+
+    tomoFn = os.path.join(outputDir, 'synthetic_tomo.mrc')
+    ImageHandler().createEmptyImage(tomoFn, 64, 64)
+    tomos = SetOfTomograms(filename=os.path.join(outputDir, 'synthetic_tomos.sqlite'))
+    tomos.setSamplingRate(1.0)
+    for i in range(nTomos):
+        linkFn = os.path.join(outputDir, 'tomo_%04d.mrc' % (i + 1))
+        if not os.path.exists(linkFn):
+            os.symlink(os.path.basename(tomoFn), linkFn)
+        tomo = Tomogram(location=linkFn)
+        tomo.setTsId('TS_%04d' % (i + 1))
+        tomo.setSamplingRate(1.0)
+        tomos.append(tomo)
+    tomos.write()
+
+    coordSet = SetOfCoordinates3D(filename=filename)
+    coordSet.setPrecedents(tomos)
+    coordSet.setBoxSize(box)
+    coordSet.setSamplingRate(1.0)
+    coord = Coordinate3D()
+    for i, tomo in enumerate(tomos):
+        for x, y, z in randomPositions(perTomo, seed=seed + i):
+            coord.setObjId(None)
+            coord.setVolume(tomo)
+            coord.setPosition(x, y, z, BOTTOM_LEFT_CORNER)
+            coordSet.append(coord)
+    coordSet.write()
+    return tomos, coordSet
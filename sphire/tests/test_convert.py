@@ -0,0 +1,248 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import time
+import json
+import platform
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+from pyworkflow.utils import magentaStr, weakImport
+import pwem.objects as emobj
+
+from .. import convert
+from ..utils import fileHash
+from .helpers import (getOutputDir, writeSyntheticCbox, writeSyntheticCoords,
+                      createSyntheticMics, createSyntheticCoords,
+                      createSyntheticCoords3D)
+
+
+class TestConvertBenchmark(BaseTest):
+    """ Measure the coordinates conversion functions with synthetic data.
+    Sizes (number of particles) are given by SPHIRE_BENCHMARK_SIZES
+    (e.g. 1000,100000,10000000), with 1000 particles per micrograph or
+    tomogram. Results are written to SPHIRE_BENCHMARK_JSON (or to the
+    test output folder) and, if SPHIRE_BENCHMARK_BASELINE points to a
+    previous results file, compared with it.
+    """
+    PER_MIC = 1000
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+        cls.sizes = [int(float(s)) for s in
+                     os.environ.get('SPHIRE_BENCHMARK_SIZES', '1000').split(',')]
+        cls.results = []
+
+    @classmethod
+    def tearDownClass(cls):
+        resultsFn = os.environ.get('SPHIRE_BENCHMARK_JSON',
+                                   cls.getOutputPath('benchmark_convert.json'))
+        with open(resultsFn, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'node': platform.node(),
+                       'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                       'results': cls.results}, f, indent=4)
+        print(magentaStr(f"\n==> Benchmark results: {resultsFn}"))
+
+        baselineFn = os.environ.get('SPHIRE_BENCHMARK_BASELINE')
+        if baselineFn:
+            with open(baselineFn) as f:
+                baseline = {(r['name'], r['particles']): r['seconds']
+                            for r in json.load(f)['results']}
+            for r in cls.results:
+                old = baseline.get((r['name'], r['particles']))
+                if old:
+                    print(f"    {r['name']} ({r['particles']}): "
+                          f"{r['seconds'] / old:0.2f}x baseline")
+
+    def _measure(self, name, particles, func, *args, **kwargs):
+        t = time.perf_counter()
+        result = func(*args, **kwargs)
+        elapsed = time.perf_counter() - t
+        self.results.append({'name': name, 'particles': particles,
+                             'seconds': round(elapsed, 4),
+                             'particles_per_sec': round(particles / elapsed)})
+        print(f"    {name} ({particles} particles): {elapsed:0.3f} secs")
+        return result
+
+    def _getDir(self, name, n):
+        return getOutputDir(self, '%s_%d' % (name, n))
+
+    def _nFiles(self, n):
+        return max(1, n // self.PER_MIC), min(n, self.PER_MIC)
+
+    def test_readers(self):
+        reader = convert.CoordBoxReader(64)
+
+        def _readAll(files):
+            return sum(1 for fn in files for _ in reader.iterCoords(fn))
+
+        for n in self.sizes:
+            nFiles, perFile = self._nFiles(n)
+            path = self._getDir('readers', n)
+            files = {'cbox': [], 'cbox3D': [], 'coords': []}
+            for i in range(nFiles):
+                for key, ext in [('cbox', 'cbox'), ('cbox3D', 'cbox'),
+                                 ('coords', 'coords')]:
+                    files[key].append(os.path.join(path, f"{key}_{i:06d}.{ext}"))
+                writeSyntheticCbox(files['cbox'][-1], perFile, seed=i)
+                writeSyntheticCbox(files['cbox3D'][-1], perFile, is3D=True, seed=i)
+                writeSyntheticCoords(files['coords'][-1], perFile, seed=i)
+
+            for key, fileList in files.items():
+                count = self._measure(f'iterCoords_{key}', n, _readAll, fileList)
+                self.assertEqual(count, nFiles * perFile)
+
+    def test_readCoordsFromMics(self):
+        from ..protocols import SphireProtCRYOLOPickingTasks
+
+        for n in self.sizes:
+            nMics, perMic = self._nFiles(n)
+            path = self._getDir('readCoordsFromMics', n)
+            mics = createSyntheticMics(path, nMics)
+            micList = [mic.clone() for mic in mics]
+            cboxDir = os.path.join(path, 'CBOX')
+            os.makedirs(cboxDir, exist_ok=True)
+            for i, mic in enumerate(micList):
+                writeSyntheticCbox(os.path.join(cboxDir, convert.getMicFn(mic, 'cbox')),
+                                   perMic, seed=i)
+
+            prot = SphireProtCRYOLOPickingTasks()
+            prot.boxSize.set(64)
+            prot.yFlipHeight = None
+            outputCoords = emobj.SetOfCoordinates(filename=':memory:')
+            outputCoords.setMicrographs(mics)
+            outputCoords.setBoxSize(64)
+            processed = self._measure('readCoordsFromMics', n,
+                                      prot.readCoordsFromMics,
+                                      path, micList, outputCoords)
+            self.assertEqual(sum(processed.values()), nMics * perMic)
+
+    def test_writeSetOfCoordinates(self):
+        # .box files are only written (training data), never read back
+        for n in self.sizes:
+            nMics, perMic = self._nFiles(n)
+            path = self._getDir('writeSetOfCoordinates', n)
+            coordSet = createSyntheticCoords(createSyntheticMics(path, nMics), perMic)
+            boxDir = os.path.join(path, 'box')
+            os.makedirs(boxDir, exist_ok=True)
+            self._measure('writeSetOfCoordinates', n,
+                          convert.writeSetOfCoordinates, boxDir, coordSet)
+            boxFiles = os.listdir(boxDir)
+            self.assertEqual(len(boxFiles), nMics)
+            self.assertTrue(all(fn.endswith('.box') for fn in boxFiles))
+            with open(os.path.join(boxDir, boxFiles[0])) as f:
+                self.assertEqual(len(f.readlines()), perMic)
+
+    def test_readCoordBoxes(self):
+        # Training reads the coordinates before writing them from a thread
+        path = self._getDir('readCoordBoxes', 0)
+        coordSet = createSyntheticCoords(createSyntheticMics(path, 4), 10)
+        micIds = [2, 4]
+        boxes = convert.readCoordBoxes(coordSet, micIds=micIds)
+        self.assertEqual(sorted(boxes), ['mic_000002.box', 'mic_000004.box'])
+        self.assertTrue(all(len(coords) == 10 for coords in boxes.values()))
+
+        boxDirs = [os.path.join(path, d) for d in ['plain', 'set']]
+        for boxDir in boxDirs:
+            os.makedirs(boxDir)
+        convert.writeCoordBoxes(boxDirs[0], boxes, coordSet.getBoxSize())
+        convert.writeSetOfCoordinates(boxDirs[1], coordSet, micIds=micIds)
+        for boxFn in boxes:
+            with open(os.path.join(boxDirs[0], boxFn)) as f1, \
+                    open(os.path.join(boxDirs[1], boxFn)) as f2:
+                self.assertEqual(f1.read(), f2.read())
+
+    def test_coordinates3D(self):
+        with weakImport('tomo'):
+            for n in self.sizes:
+                nTomos, perTomo = self._nFiles(n)
+                path = self._getDir('coordinates3D', n)
+                tomos, coordSet = createSyntheticCoords3D(path, nTomos, perTomo)
+                cboxDir = os.path.join(path, 'cbox')
+                os.makedirs(cboxDir, exist_ok=True)
+                self._measure('writeSetOfCoordinates3D', n,
+                              convert.writeSetOfCoordinates3D, cboxDir, coordSet)
+
+                from tomo.objects import SetOfCoordinates3D
+                from tomo.constants import BOTTOM_LEFT_CORNER
+                outputSet = SetOfCoordinates3D(filename=':memory:')
+                outputSet.setPrecedents(tomos)
+                outputSet.setSamplingRate(1.0)
+                cboxFiles = [(tomo.clone(), os.path.join(cboxDir, convert.getMicFn(tomo, 'cbox')))
+                             for tomo in tomos]
+
+                def _readAll():
+                    for tomo, cboxFn in cboxFiles:
+                        convert.readSetOfCoordinates3D(tomo, outputSet, cboxFn, 64,
+                                                       origin=BOTTOM_LEFT_CORNER)
+
+                self._measure('readSetOfCoordinates3D', n, _readAll)
+                self.assertEqual(outputSet.getSize(), nTomos * perTomo)
+
+
+class TestReplaceTomogramCoordinates(BaseTest):
+    """ Replace the coordinates of a single tomogram in an existing set,
+    as done by the napari picker when only some files were modified. """
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def test_replace(self):
+        with weakImport('tomo'):
+            from tomo.objects import SetOfCoordinates3D, Coordinate3D
+            from tomo.constants import BOTTOM_LEFT_CORNER
+            path = getOutputDir(self, 'replace_coords')
+            tomos, coordSet = createSyntheticCoords3D(
+                path, 3, 20, filename=os.path.join(path, 'coordinates.sqlite'))
+            tomoList = [tomo.clone() for tomo in tomos]
+            convert.writeTomogramCoordinates3D(path, coordSet, tomoList[1])
+            cboxFn = os.path.join(path, convert.getMicFn(tomoList[1], 'cbox'))
+            hashBefore = fileHash(cboxFn)
+            # Remove the first 5 coordinates of the tomogram, as in napari
+            with open(cboxFn) as f:
+                lines = f.readlines()
+            first = next(i for i, line in enumerate(lines)
+                         if line.strip() and line.split()[0][0].isdigit())
+            with open(cboxFn, 'w') as f:
+                f.writelines(lines[:first] + lines[first + 5:])
+            self.assertNotEqual(fileHash(cboxFn), hashBefore)
+
+            coordSet.close()
+            coordSet = SetOfCoordinates3D(filename=os.path.join(path, 'coordinates.sqlite'))
+            coordSet.enableAppend()
+            self.assertEqual(convert.deleteTomogramCoordinates3D(coordSet, tomoList[1]), 20)
+            # TsId values are quoted in the query
+            quotedTomo = tomoList[2].clone()
+            quotedTomo.setTsId("TS_'0003")
+            self.assertEqual(convert.deleteTomogramCoordinates3D(coordSet, quotedTomo), 0)
+            convert.readSetOfCoordinates3D(tomoList[1], coordSet, cboxFn,
+                                           boxSize=None, origin=BOTTOM_LEFT_CORNER)
+            coordSet.write()
+            self.assertEqual(coordSet.getSize(), 55)
+            counts = {r[Coordinate3D.TOMO_ID_ATTR]: r['COUNT'] for r in
+                      coordSet.aggregate(['COUNT'], Coordinate3D.TOMO_ID_ATTR,
+                                         [Coordinate3D.TOMO_ID_ATTR])}
+            self.assertEqual(counts, {'TS_0001': 20, 'TS_0002': 15, 'TS_0003': 20})
@@ -0,0 +1,141 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import time
+import json
+import subprocess
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+from pyworkflow.utils import magentaStr
+import pwem.objects as emobj
+from pwem.emlib.image import ImageHandler
+
+from .. import Plugin, convert
+from ..constants import CBOX_FILAMENTS_FOLDER
+from ..utils import Tracer, summarizeTrace, formatTraceStats
+from .helpers import (setupFakeCryolo, restoreEnviron, getOutputDir,
+                      createSyntheticMics)
+
+
+class TestFakeCryolo(BaseTest):
+    """ Run the stand-in crYOLO programs used for load tests.
+    The number of micrographs picked is given by SPHIRE_FAKE_MICS and the
+    picking rate (micrographs per hour) is printed, including the reading
+    of the output coordinates.
+    """
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+        cls.nMics = int(float(os.environ.get('SPHIRE_FAKE_MICS', '100')))
+        setupFakeCryolo(cls)
+
+    @classmethod
+    def tearDownClass(cls):
+        restoreEnviron(cls)
+
+    def _run(self, program, args, cwd=None):
+        subprocess.check_call(f"{Plugin.getCryoloProgram(program)} {args}",
+                              shell=True, cwd=cwd, env=Plugin.getEnviron())
+
+    def test_predict(self):
+        from ..protocols import SphireProtCRYOLOPickingTasks
+
+        self.assertTrue(Plugin.usingFakeCryolo())
+        path = getOutputDir(self, 'fake_predict')
+        mics = createSyntheticMics(path, self.nMics, dim=512)
+        micList = [mic.clone() for mic in mics]
+        configFn = os.path.join(path, 'config.json')
+        with open(configFn, 'w') as f:
+            json.dump({'model': {'anchors': [48, 48]}}, f)
+
+        traceFile = os.path.join(path, 'trace.jsonl')
+        tracer = Tracer(traceFile)
+        prot = SphireProtCRYOLOPickingTasks()
+        prot.boxSize.set(48)
+        prot.yFlipHeight = None
+        prot._tracer = tracer
+        outputCoords = emobj.SetOfCoordinates(filename=':memory:')
+        outputCoords.setMicrographs(mics)
+        outputCoords.setBoxSize(48)
+
+        t = time.perf_counter()
+        with tracer.context(batch=1, gpu='0'):
+            with prot._traceSpan('predict'):
+                self._run('cryolo_predict.py',
+                          f"-c {configFn} -w model.h5 -i ./ -o ./ -t 0.5 -g 0 -nc 4",
+                          cwd=path)
+            with prot._traceSpan('read_coords'):
+                processed = prot.readCoordsFromMics(path, micList, outputCoords)
+        elapsed = time.perf_counter() - t
+        print(magentaStr(f"\n==> Picked {self.nMics} micrographs: "
+                         f"{self.nMics / elapsed * 3600:0.0f} micrographs/hour"))
+        print('\n'.join(formatTraceStats(tracer.getStats())))
+
+        stats = summarizeTrace(traceFile)
+        self.assertEqual(list(stats), ['predict', 'read_coords'])
+        self.assertEqual(stats, tracer.getStats())
+        with open(traceFile) as f:
+            span = json.loads(f.readline())
+        self.assertEqual((span['batch'], span['gpu']), (1, '0'))
+
+        self.assertEqual(len(processed), self.nMics)
+        self.assertEqual(outputCoords.getSize(), sum(processed.values()))
+        self.assertEqual(prot.getEstimatedBoxSize(os.path.join(path, 'DISTR')), 48)
+        for coord in outputCoords.iterItems(limit=100):
+            self.assertGreaterEqual(coord.getAttributeValue('_cryoloScore'), 0.5)
+            self.assertLess(coord.getX(), 512)
+
+    def test_predictTomograms(self):
+        path = getOutputDir(self, 'fake_predict_tomo')
+        tomoFn = os.path.join(path, 'tomo_001.mrc')
+        ImageHandler().createEmptyImage(tomoFn, 64, 64, 32)
+        self._run('cryolo_predict.py', f"-i {path}/ -o {path}/out/ --tomogram")
+        self._run('cryolo_predict.py', f"-i {path}/ -o {path}/out/ --tomogram --filament")
+
+        reader = convert.CoordBoxReader(None)
+        for folder in ['CBOX_3D', CBOX_FILAMENTS_FOLDER]:
+            coords = list(reader.iterCoords(os.path.join(path, 'out', folder,
+                                                         'tomo_001.cbox')))
+            self.assertTrue(coords)
+            self.assertTrue(all(z < 32 for _, _, z, _, _, _ in coords))
+
+    def test_trainAndDenoise(self):
+        path = getOutputDir(self, 'fake_train')
+        with open(os.path.join(path, 'config.json'), 'w') as f:
+            json.dump({'train': {'nb_epoch': 50, 'saved_weights_name': 'model.h5',
+                                 'train_image_folder': 'train_image/'}}, f)
+        log = os.path.join(path, 'training.log')
+        self._run('cryolo_train.py', f"-c config.json -w 5 -g 0 -e 3 > {log}",
+                  cwd=path)
+        self.assertTrue(os.path.exists(os.path.join(path, 'model.h5')))
+        with open(log) as f:
+            self.assertIn('val_loss:', f.read())
+
+        micsDir = os.path.join(path, 'mics')
+        os.makedirs(micsDir)
+        createSyntheticMics(micsDir, 3)
+        self._run('janni_denoise.py', f"denoise -g 0 {micsDir}/ {micsDir}/ model.h5")
+        # The synthetic image and the 3 micrographs linked to it
+        self.assertEqual(len(os.listdir(os.path.join(micsDir, 'mics'))), 4)
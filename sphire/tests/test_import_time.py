@@ -0,0 +1,71 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import re
+import sys
+import subprocess
+
+from pyworkflow.tests import BaseTest
+from pyworkflow.utils import magentaStr
+
+
+class TestImportTime(BaseTest):
+    """ Check the time needed to import the plugin protocols and viewers,
+    as Scipion does when it starts, with `python -X importtime`.
+    Modules shared with other plugins (pwem, tomo) are imported first,
+    so only the plugin own cost is measured. The budget (in ms) can be
+    changed with SPHIRE_IMPORT_BUDGET_MS.
+    """
+    SCRIPT = """
+import sys
+import pwem.protocols, pwem.objects, pwem.viewers
+from pyworkflow.utils import weakImport
+with weakImport('tomo'):
+    import tomo.objects, tomo.protocols, tomo.viewers
+import sphire.protocols, sphire.viewers
+print(','.join(m for m in sys.modules if m.startswith(('emtools.jobs', 'emtools.pwx'))))
+"""
+    LINE_RE = re.compile(r'^import time:\s+\d+ \|\s+(\d+) \| (\S+)$')
+
+    def test_importTime(self):
+        budget = float(os.environ.get('SPHIRE_IMPORT_BUDGET_MS', 100))
+        # The first import could include writing the .pyc files
+        subprocess.run([sys.executable, '-c', self.SCRIPT], check=True,
+                       capture_output=True)
+        p = subprocess.run([sys.executable, '-X', 'importtime', '-c', self.SCRIPT],
+                           check=True, capture_output=True, text=True)
+        times = {}
+        for line in p.stderr.splitlines():
+            m = self.LINE_RE.match(line)  # only top level imports
+            if m and m.group(2).startswith('sphire'):
+                times[m.group(2)] = int(m.group(1)) / 1000
+
+        total = sum(times.values())
+        print(magentaStr(f"\n==> Import time: {total:0.1f} ms "
+                         f"(budget {budget:0.0f} ms) {times}"))
+        self.assertIn('sphire.protocols', times)
+        self.assertEqual(p.stdout.strip(), '',
+                         "Streaming modules should be imported when running")
+        self.assertLess(total, budget)
@@ -26,6 +26,7 @@
 # **************************************************************************
 
 import os
+import json
 
 import pyworkflow.utils as pwutils
 from pyworkflow.tests import BaseTest, setupTestProject, DataSet, setupTestOutput
@@ -38,8 +39,11 @@ from pwem.convert import Ccp4Header
 
 import sphire.convert as convert
 import sphire.protocols as protocols
+from .. import Plugin
 from ..constants import (INPUT_MODEL_OTHER, INPUT_MODEL_GENERAL_NS,
-                         INPUT_MODEL_GENERAL)
+                         INPUT_MODEL_GENERAL, INPUT_MODEL_GENERAL_DENOISED,
+                         CRYOLO_ENV_ACTIVATION, CRYOLO_ENV_ACTIVATION_CPU)
+from .helpers import setupFakeCryolo, restoreEnviron, importSyntheticMics
 
 
 class TestSphireConvert(BaseTest):
@@ -93,6 +97,40 @@ _Confidence #5
             self.assertNotEqual(c1, c2)
             self.assertEqual(yFlipHeight - c1[1], c2[1])
 
+    def testFuseBoxes(self):
+        import numpy as np
+        boxes1 = np.array([[100, 100, 50, 50, 0.9], [300, 300, 50, 50, 0.5]])
+        boxes2 = np.array([[104, 102, 52, 52, 0.8], [600, 600, 50, 50, 0.4]])
+
+        fused, numBoxes = convert.fuseBoxes([boxes1, boxes2], iouThreshold=0.5)
+        # First boxes of both models are fused, the others are kept
+        self.assertEqual(len(fused), 3)
+        self.assertEqual(list(numBoxes), [2, 1, 1])
+        self.assertAlmostEqual(fused[0, 4], 0.85)
+        self.assertAlmostEqual(fused[1, 4], 0.25)
+        self.assertTrue(100 < fused[0, 0] < 104)
+
+        # Fused boxes can be written and read back as cbox
+        cboxFile = self.getOutputPath('fused.cbox')
+        convert.writeCboxBoxes(cboxFile, fused, numBoxes)
+        boxesOut = convert.readCboxBoxes(cboxFile)
+        self.assertEqual(boxesOut.shape, (3, 5))
+        self.assertTrue(np.allclose(boxesOut[:, 4], fused[:, 4]))
+
+    def testSelectDiverseSubset(self):
+        import numpy as np
+        # Two clusters of micrographs (e.g. by defocus) and one outlier
+        features = np.array([[10, 1.0], [11, 1.1], [12, 0.9],
+                             [10, 3.0], [11, 3.1], [30, 2.0]])
+        selected = convert.selectDiverseSubset(features, 3)
+        self.assertEqual(selected[0], 5)  # highest density first
+        self.assertEqual(len(set(selected)), 3)
+        # One micrograph from each cluster
+        defocus = features[selected, 1]
+        self.assertTrue(any(defocus < 1.5) and any(defocus > 2.5))
+
+        self.assertEqual(len(convert.selectDiverseSubset(features, 10)), 6)
+
     def testConvertMic(self):
         """Check extension of the input micrographs"""
         micDir = self.getOutputPath('micDir')
@@ -215,6 +253,64 @@ _Confidence #5
         self.assertEqual(rounded, 320, msg)
 
 
+class TestCryoloEnvProbe(BaseTest):
+    """ Check the cache of crYOLO environment probes, using shell
+    commands as activation commands. """
+    def setUp(self):
+        self.activation = os.environ.get(CRYOLO_ENV_ACTIVATION_CPU)
+        Plugin.invalidateEnvProbes()
+
+    def tearDown(self):
+        if self.activation is None:
+            os.environ.pop(CRYOLO_ENV_ACTIVATION_CPU, None)
+        else:
+            os.environ[CRYOLO_ENV_ACTIVATION_CPU] = self.activation
+        Plugin._defineVariables()
+        Plugin.invalidateEnvProbes()
+
+    def _setActivation(self, cmd):
+        os.environ[CRYOLO_ENV_ACTIVATION_CPU] = cmd
+        Plugin._defineVariables()
+
+    def testProbe(self):
+        self._setActivation("echo 'Version: 1.9.9'")
+        probe = Plugin.probeCryoloEnv(useCpu=True)
+        self.assertTrue(probe['exists'])
+        self.assertEqual(probe['version'], '1.9.9')
+        # Cached until the TTL expires or it is invalidated
+        self.assertEqual(Plugin.probeCryoloEnv(useCpu=True), probe)
+        self.assertNotEqual(Plugin.probeCryoloEnv(useCpu=True, ttl=0)['time'],
+                            probe['time'])
+
+        self._setActivation("false")
+        self.assertIs(Plugin.probeCryoloEnv(useCpu=True)['exists'], False)
+
+        # Unknown if the activation takes longer than the timeout
+        self._setActivation("sleep 5")
+        probe = Plugin.probeCryoloEnv(useCpu=True, timeout=0.5)
+        self.assertIsNone(probe['exists'])
+
+    def testActiveVersion(self):
+        activation = os.environ.get(CRYOLO_ENV_ACTIVATION)
+        try:
+            # Unsupported versions fall back to the env name version
+            os.environ[CRYOLO_ENV_ACTIVATION] = "echo 'Version: 1.9.10.dev0'; true cryolo-1.9.7"
+            Plugin._defineVariables()
+            self.assertEqual(Plugin.getActiveVersion(), '1.9.7')
+            self.assertTrue(Plugin.versionGE('1.9.6'))
+            self.assertFalse(Plugin.versionGE('1.9.9'))
+
+            Plugin.invalidateEnvProbes()
+            os.environ[CRYOLO_ENV_ACTIVATION] = "echo 'Version: 1.9.9'; true cryolo-1.9.7"
+            Plugin._defineVariables()
+            self.assertEqual(Plugin.getActiveVersion(), '1.9.9')
+        finally:
+            if activation is None:
+                os.environ.pop(CRYOLO_ENV_ACTIVATION, None)
+            else:
+                os.environ[CRYOLO_ENV_ACTIVATION] = activation
+
+
 class TestCryolo(BaseTest):
     @classmethod
     def setUpClass(cls):
@@ -432,3 +528,181 @@ class TestCryoloTomo(BaseTest):
         self.assertTrue(sphireProtCRYOLOTomoPicking.output3DCoordinates.getSize() > 0,
                         "There was a problem with tomo picking protocol")
         return sphireProtCRYOLOTomoPicking
+
+
+class TestCryoloPickingTasksScratch(BaseTest):
+    """ Run the streaming picking protocol with a scratch folder, using
+    the stand-in crYOLO programs and synthetic micrographs, so no GPU or
+    dataset is required. """
+    N_MICS = 5
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestProject(cls)
+        setupFakeCryolo(cls)
+        cls.protImport = importSyntheticMics(cls, cls.N_MICS, dim=512)
+
+    @classmethod
+    def tearDownClass(cls):
+        restoreEnviron(cls)
+
+    def _runPicking(self, objLabel, **kwargs):
+        scratchDir = os.path.abspath(self.proj.getTmpPath('scratch_%s' % objLabel))
+        pwutils.makePath(scratchDir)
+        prot = self.newProtocol(
+            protocols.SphireProtCRYOLOPickingTasks,
+            objLabel=objLabel,
+            inputMicrographs=self.protImport.outputMicrographs,
+            boxSize=50,
+            streamingBatchSize=2,
+            streamingSleepOnWait=1,
+            scratchDir=scratchDir,
+            scratchMinFree=0,
+            **kwargs)
+
+        print(magentaStr(f"\n==> Testing sphire - cryolo picking tasks ({objLabel}):"))
+        self.launchProtocol(prot)
+        self.assertSetSize(prot.outputCoordinates,
+                           msg="There was a problem picking with crYOLO")
+        micIds = prot.outputCoordinates.getUniqueValues('_micId')
+        self.assertEqual(len(micIds), self.N_MICS)
+        # Scratch space is released when the protocol finishes
+        self.assertFalse(os.path.exists(prot.getScratchPath()))
+
+        with open(self.proj.getPath(prot.getMetricsFile())) as f:
+            lines = f.readlines()
+
+        def _metric(name):
+            return [float(line.split()[-1]) for line in lines
+                    if line.startswith(name + '{')]
+
+        self.assertEqual(_metric(prot.M_MICS), [self.N_MICS])
+        self.assertEqual(_metric(prot.M_QUEUE_DEPTH), [0, 0])
+        return prot
+
+    def testPickingScratch(self):
+        self._runPicking('scratch')
+
+    def testPickingScratchDenoised(self):
+        prot = self._runPicking('scratch_denoised',
+                                inputModelFrom=INPUT_MODEL_GENERAL_DENOISED,
+                                fusedDenoising=True)
+        # Denoised micrographs are cached in scratch, removed at the end
+        self.assertTrue(prot.getDenoisedCachePath().startswith(
+            prot.getScratchPath()))
+
+    def testDenoisedCacheName(self):
+        # Micrographs with the same name but different content
+        micsDir = os.path.abspath(self.proj.getTmpPath('same_name'))
+        micFns = [os.path.join(micsDir, d, 'mic.mrc') for d in ['a', 'b']]
+        for i, micFn in enumerate(micFns):
+            pwutils.makePath(os.path.dirname(micFn))
+            ImageHandler().createEmptyImage(micFn, 64 * (i + 1), 64)
+
+        getName = protocols.SphireProtCRYOLOPicking._getDenoisedCacheName
+        names = [getName(micFn) for micFn in micFns]
+        self.assertNotEqual(names[0], names[1])
+        self.assertTrue(names[0].endswith('_mic.mrc'))
+        self.assertEqual(getName(micFns[0]), names[0])
+
+
+class TestCryoloEnsemble(BaseTest):
+    """ Run ensemble picking with the stand-in crYOLO program and
+    synthetic micrographs, so no GPU or dataset is required. """
+    N_MICS = 4
+    BATCH_SIZE = 2
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestProject(cls)
+        setupFakeCryolo(cls)
+        cls.protImport = importSyntheticMics(cls, cls.N_MICS, dim=512)
+        cls.models = [cls._importModel('model_%d.h5' % i) for i in range(3)]
+
+    @classmethod
+    def tearDownClass(cls):
+        restoreEnviron(cls)
+
+    @classmethod
+    def _importModel(cls, name, size=1024):
+        modelFn = os.path.abspath(cls.proj.getTmpPath(name))
+        with open(modelFn, 'wb') as f:
+            f.write(os.urandom(size))
+        protModel = cls.newProtocol(protocols.SphireProtCryoloImport,
+                                    objLabel='import %s' % name,
+                                    modelPath=modelFn)
+        cls.launchProtocol(protModel)
+        return protModel.outputModel
+
+    def _newEnsemblePicking(self, objLabel, models, **kwargs):
+        prot = self.newProtocol(
+            protocols.SphireProtCRYOLOPicking,
+            objLabel=objLabel,
+            inputMicrographs=self.protImport.outputMicrographs,
+            inputModelFrom=INPUT_MODEL_OTHER,
+            inputModel=models[0],
+            doEnsemble=True,
+            boxSize=50,
+            streamingBatchSize=self.BATCH_SIZE,
+            **kwargs)
+        for model in models[1:]:
+            prot.ensembleModels.append(model)
+        return prot
+
+    def testEnsembleThreads(self):
+        prot = self._newEnsemblePicking('ensemble threads', self.models,
+                                        numberOfThreads=3, gpuList='0 1')
+        print(magentaStr("\n==> Testing sphire - cryolo ensemble picking (2 threads):"))
+        self.launchProtocol(prot)
+        self.assertSetSize(prot.outputCoordinates,
+                           msg="There was a problem with ensemble picking")
+        micIds = prot.outputCoordinates.getUniqueValues('_micId')
+        self.assertEqual(len(micIds), self.N_MICS)
+
+        # Every model picked every batch on one of the step GPUs
+        with open(self.proj.getPath(prot.getStdoutLog())) as f:
+            commands = [line for line in f if 'cryolo_predict.py' in line]
+        nBatches = self.N_MICS // self.BATCH_SIZE
+        self.assertEqual(len(commands), nBatches * len(self.models))
+        for line in commands:
+            self.assertRegex(line, r' -g [01] ')
+
+    def testEnsembleModelFails(self):
+        # The stand-in crYOLO can not read an empty model
+        badModel = self._importModel('model_empty.h5', size=0)
+        prot = self._newEnsemblePicking('ensemble failure',
+                                        self.models[:2] + [badModel])
+        print(magentaStr("\n==> Testing sphire - cryolo ensemble picking (failing model):"))
+        with self.assertRaises(Exception):
+            self.launchProtocol(prot)
+        self.assertTrue(prot.isFailed())
+        self.assertIn('model_empty.h5', prot.getErrorMessage())
+
+
+class TestCryoloTrainingSweep(BaseTest):
+    """ Check how the runs of a training sweep are compared. """
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def testRunResult(self):
+        prot = protocols.SphireProtCRYOLOTrainingSweep()
+        prot.setWorkingDir(self.getOutputPath('sweep'))
+        run = {'name': 'run_001', 'learning_rate': 1e-4,
+               'batch_size': 4, 'patience': 3}
+        runDir = prot._getExtraPath(run['name'])
+        pwutils.makePath(runDir)
+        # Best epoch is the second one, then early stopping waits 3 epochs
+        valLosses = [0.50, 0.30, 0.35, 0.40, 0.45]
+        with open(os.path.join(runDir, prot.METRICS), 'w') as f:
+            for i, valLoss in enumerate(valLosses):
+                f.write(json.dumps({'epoch': i + 1, 'epochs': 10, 'time': 2,
+                                    'loss': 1.0 / (i + 1),
+                                    'val_loss': valLoss}) + '\n')
+
+        result = prot._getRunResult(run)
+        self.assertEqual(result['epochs'], 5)
+        self.assertEqual(result['best_epoch'], 2)
+        self.assertEqual(result['val_loss'], 0.30)
+        self.assertEqual(result['loss'], 0.5)
+        self.assertIsNone(result['model'])
@@ -32,6 +32,7 @@ from pyworkflow.utils import magentaStr
 from pwem.protocols import ProtImportMicrographs
 
 from ..protocols import SphireProtJanniDenoising
+from .helpers import setupFakeCryolo, restoreEnviron, importSyntheticMics
 
 
 class TestJanni(BaseTest):
@@ -93,3 +94,31 @@ class TestJanni(BaseTest):
             self.runImportMicrograph(key, dataDict[key])
             self.runMicPreprocessing(key)
             self.runJanni(key)
+
+
+class TestJanniFake(BaseTest):
+    """ Run JANNI denoising with the stand-in JANNI program and synthetic
+    micrographs, so no GPU or dataset is required. """
+    @classmethod
+    def setUpClass(cls):
+        setupTestProject(cls)
+        setupFakeCryolo(cls)
+        cls.protImport = importSyntheticMics(cls, nMics=2, dim=256)
+
+    @classmethod
+    def tearDownClass(cls):
+        restoreEnviron(cls)
+
+    def test_moreGpusThanMics(self):
+        protJanni = self.newProtocol(
+            SphireProtJanniDenoising,
+            inputMicrographs=self.protImport.outputMicrographs,
+            gpuList='0 1 2')
+
+        print(magentaStr(f"\n==> Testing sphire - janni denoising (3 GPUs, 2 mics):"))
+        self.launchProtocol(protJanni)
+        self.assertSetSize(protJanni.outputMicrographs, size=2)
+
+        # Only the GPUs with micrographs run JANNI
+        with open(self.proj.getPath(protJanni.getStdoutLog())) as f:
+            self.assertEqual(f.read().count('janni_denoise.py'), 2)
@@ -0,0 +1,146 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import time
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+from pyworkflow.utils import magentaStr
+
+from ..utils import scanDir, benchmarkPredictor, MetricsExporter
+from ..objects import CryoloModel
+
+
+class TestScanDirBenchmark(BaseTest):
+    """ Compare output registration based on a single directory scan
+    with the exists/getsize call per expected file. """
+    N_FILES = 50000
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+        cls.outputDir = cls.getOutputPath('scan_dir')
+        os.makedirs(cls.outputDir, exist_ok=True)
+        # One expected file every 10 is missing and other one is empty
+        cls.expected = ['mic_%06d.cbox' % i for i in range(cls.N_FILES)]
+        for i, fn in enumerate(cls.expected):
+            if i % 10:
+                with open(os.path.join(cls.outputDir, fn), 'w') as f:
+                    f.write('' if i % 10 == 1 else 'data')
+
+    def test_scanDir(self):
+        print(magentaStr(f"\n==> Registering {self.N_FILES} files:"))
+        t = time.time()
+        found1 = [fn for fn in self.expected
+                  if os.path.exists(os.path.join(self.outputDir, fn))
+                  and os.path.getsize(os.path.join(self.outputDir, fn))]
+        tStat = time.time() - t
+
+        t = time.time()
+        index = scanDir(self.outputDir, ext='.cbox')
+        found2 = [fn for fn in self.expected
+                  if fn in index and index[fn].st_size]
+        tScan = time.time() - t
+
+        print(f"    exists + getsize: {tStat:0.3f} secs")
+        print(f"    scanDir: {tScan:0.3f} secs")
+        self.assertEqual(found1, found2)
+        self.assertEqual(len(found2), self.N_FILES * 8 // 10)
+
+        self.assertEqual(scanDir(os.path.join(self.outputDir, 'missing')), {})
+
+
+class TestPredictorBenchmark(BaseTest):
+    """ Check the predictor benchmark with a stub predictor that takes
+    a fixed startup time and then some time per image. """
+    STUB = ("python -c \"import os, sys, time; time.sleep(0.5); "
+            "[time.sleep(0.1) for fn in os.listdir(sys.argv[1])]; "
+            "x = bytearray(50 * 1024 * 1024)\" %s")
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def test_benchmarkPredictor(self):
+        workingDir = self.getOutputPath('predictor')
+        os.makedirs(workingDir, exist_ok=True)
+        images = []
+        for i in range(6):
+            images.append(os.path.join(workingDir, 'mic_%02d.mrc' % i))
+            open(images[-1], 'w').close()
+
+        benchmark = benchmarkPredictor(
+            lambda inputDir, outputDir: self.STUB % inputDir,
+            images, workingDir)
+        print(magentaStr(f"\n==> Benchmark: {benchmark}"))
+
+        self.assertEqual(benchmark['images'], 6)
+        self.assertAlmostEqual(benchmark['latency'], 0.1, delta=0.05)
+        self.assertGreater(benchmark['startup'], 0.4)
+        self.assertGreater(benchmark['peak_rss_mb'], 50)
+
+        # Measurements are kept in the model, one per device and input size
+        model = CryoloModel('model.h5')
+        benchmark.update({'device': 'cpu', 'input_size': 1024})
+        model.addBenchmark(benchmark)
+        model.addBenchmark(dict(benchmark, latency=0.2))
+        model.addBenchmark(dict(benchmark, input_size=512))
+        self.assertEqual(len(model.getBenchmarks()), 2)
+        self.assertEqual(model.getBenchmarks()[0]['latency'], 0.2)
+
+        with self.assertRaises(Exception):
+            benchmarkPredictor(lambda i, o: 'exit 1', images, workingDir)
+
+
+class TestMetricsExporter(BaseTest):
+    """ Check the Prometheus text file written by MetricsExporter. """
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def test_write(self):
+        metricsFile = self.getOutputPath('metrics.prom')
+        metrics = MetricsExporter(metricsFile, labels={'run': 'run_001'},
+                                  interval=0.1)
+        metrics.describe('mics_total', metrics.COUNTER, "Micrographs.")
+        metrics.describe('queue_depth', metrics.GAUGE, "Queue depth.")
+        metrics.describe('latency_seconds', metrics.HISTOGRAM, "Latency.",
+                         buckets=[1, 10])
+        metrics.addCollector(lambda: metrics.set('queue_depth', 3,
+                                                 labels={'stage': 'pick'}))
+        metrics.start()
+        for value in [0.5, 5, 50]:
+            metrics.inc('mics_total', 16)
+            metrics.observe('latency_seconds', value)
+        metrics.stop()
+
+        with open(metricsFile) as f:
+            lines = f.read().splitlines()
+        print('\n'.join(lines))
+        self.assertIn('# TYPE latency_seconds histogram', lines)
+        self.assertIn('mics_total{run="run_001"} 48', lines)
+        self.assertIn('queue_depth{run="run_001",stage="pick"} 3', lines)
+        self.assertIn('latency_seconds_bucket{run="run_001",le="10"} 2', lines)
+        self.assertIn('latency_seconds_bucket{run="run_001",le="+Inf"} 3', lines)
+        self.assertIn('latency_seconds_sum{run="run_001"} 55.5', lines)
@@ -0,0 +1,138 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import time
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+from pyworkflow.utils import magentaStr, weakImport
+
+from .. import convert
+from ..utils import DirWatcher
+from .helpers import getOutputDir, createSyntheticCoords3D
+
+
+class TestNapariViewerFiles(BaseTest):
+    """ Check that the napari viewer generates the files of each tomogram
+    when needed and keeps them while the coordinates are not modified. """
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def test_prepareTomogram(self):
+        with weakImport('tomo'):
+            from ..viewers.viewer_napari import NapariViewer
+            path = getOutputDir(self, 'napari_viewer')
+            tomos, coordSet = createSyntheticCoords3D(
+                path, 100, 100, filename=os.path.join(path, 'coordinates.sqlite'))
+            viewer = NapariViewer(project='project',
+                                  tmpPath=os.path.join(path, 'Tmp'))
+            coordSet.setName('coordinates')
+
+            t = time.perf_counter()
+            tmpDir = viewer.getCboxDir(coordSet)
+            tOpen = time.perf_counter() - t
+            self.assertEqual(os.listdir(tmpDir), [viewer.STATE_FILE])
+
+            tomo = tomos[50].clone()
+            t = time.perf_counter()
+            viewer.prepareTomogram(tmpDir, coordSet, tomo)
+            tPrepare = time.perf_counter() - t
+            print(magentaStr(f"\n==> Open: {tOpen:0.3f} secs, "
+                             f"prepare tomogram: {tPrepare:0.3f} secs"))
+
+            cboxFn = os.path.join(tmpDir, convert.getMicFn(tomo, 'cbox'))
+            reader = convert.CoordBoxReader(64)
+            self.assertEqual(len(list(reader.iterCoords(cboxFn))), 100)
+            self.assertTrue(os.path.exists(os.path.join(tmpDir, 'tomo_0050.mrc')))
+
+            # Files are kept (not appended) while the set is not modified
+            viewer.prepareTomogram(tmpDir, coordSet, tomo)
+            self.assertEqual(viewer.getCboxDir(coordSet), tmpDir)
+            self.assertEqual(len(list(reader.iterCoords(cboxFn))), 100)
+
+            coordSet.enableAppend()
+            coord = coordSet.getFirstItem().clone()
+            coord.setObjId(None)
+            coordSet.append(coord)
+            coordSet.write()
+            viewer.getCboxDir(coordSet)
+            self.assertFalse(os.path.exists(cboxFn))
+
+
+class TestTomogramProvider(BaseTest):
+    """ Measure the refresh of the tomograms list used by the napari
+    picker and viewer, the second refresh should not read the files. """
+    N_TOMOS = 500
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def test_refresh(self):
+        with weakImport('tomo'):
+            from ..viewers.views_tkinter_tree import SphireTomogramProvider
+            path = getOutputDir(self, 'tomo_provider')
+            tomos, coordSet = createSyntheticCoords3D(path, self.N_TOMOS, 20)
+            tomoList = [tomo.clone() for tomo in tomos]
+            convert.writeSetOfCoordinates3D(path, coordSet)
+            provider = SphireTomogramProvider(tomoList, path)
+
+            def _refresh():
+                return [provider.getObjectInfo(tomo)['values'] for tomo in tomoList]
+
+            t = time.perf_counter()
+            values = _refresh()
+            tFirst = time.perf_counter() - t
+            t = time.perf_counter()
+            self.assertEqual(_refresh(), values)
+            tSecond = time.perf_counter() - t
+            print(magentaStr(f"\n==> Refresh {self.N_TOMOS} tomograms: "
+                             f"{tFirst:0.3f} secs, cached: {tSecond:0.3f} secs"))
+            self.assertEqual(values[0], ('20', 'Done'))
+
+            # Modified files are counted again
+            coordsFn = os.path.join(path, convert.getMicFn(tomoList[0], 'coords'))
+            os.remove(os.path.join(path, convert.getMicFn(tomoList[0], 'cbox')))
+            with open(coordsFn, 'w') as f:
+                f.write('1 2 3\n4 5 6\n')
+            self.assertEqual(provider.getObjectInfo(tomoList[0])['values'], ('2', 'Done'))
+
+            # Only the tomograms of the changed files are refreshed
+            watcher = DirWatcher(path, ext=('.cbox', '.coords'))
+            self.assertEqual(watcher.poll(), set())
+            time.sleep(0.01)
+            with open(coordsFn, 'a') as f:
+                f.write('7 8 9\n')
+            cboxFn = os.path.join(path, convert.getMicFn(tomoList[1], 'cbox'))
+            os.remove(cboxFn)
+            changed = watcher.poll()
+            self.assertEqual(changed, {os.path.basename(coordsFn),
+                                       os.path.basename(cboxFn)})
+            self.assertEqual(watcher.poll(), set())
+            changedTomos = provider.getObjectsByFiles(changed)
+            self.assertEqual({t.getTsId() for t in changedTomos},
+                             {tomoList[0].getTsId(), tomoList[1].getTsId()})
+            self.assertEqual([provider.getObjectInfo(t)['values'] for t in changedTomos
+                              if t.getTsId() == tomoList[0].getTsId()], [('3', 'Done')])
@@ -0,0 +1,507 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+import subprocess
+from contextlib import contextmanager
+
+import pyworkflow.utils as pwutils
+from pyworkflow.project.project import PROJECT_UPLOAD
+
+
+def scanDir(path, ext=None):
+    """ Scan a folder only once and return a dict with the file names
+    as keys and their os.stat_result as values.
+    This avoids one exists/getsize call per expected file, which is
+    slow on network file systems.
+    Params:
+        path: folder to scan, if it does not exist an empty dict is returned.
+        ext: if not None, only files with this extension are indexed.
+    """
+    index = {}
+    if not os.path.isdir(path):
+        return index
+
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if ext is not None and not entry.name.endswith(ext):
+                continue
+            try:
+                index[entry.name] = entry.stat()
+            except FileNotFoundError:  # broken links
+                pass
+
+    return index
+
+
+def fileHash(path, blockSize=None):
+    """ Return the sha1 hex digest of the file content.
+    Params:
+        path: file to be hashed.
+        blockSize: if not None, only the file size and the first and last
+            blocks of this size are hashed. This is much faster for big
+            images and enough to identify the same file.
+    """
+    h = hashlib.sha1()
+    size = os.path.getsize(path)
+
+    with open(path, 'rb') as f:
+        if blockSize is None:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                h.update(chunk)
+        else:
+            h.update(str(size).encode())
+            h.update(f.read(blockSize))
+            if size > 2 * blockSize:
+                f.seek(-blockSize, os.SEEK_END)
+                h.update(f.read(blockSize))
+
+    return h.hexdigest()
+
+
+class DirWatcher:
+    """ Detect the files created, modified or removed in a folder by
+    comparing the size and modification time of consecutive scans.
+    Only the folder entries are read, never the files content.
+    Params:
+        path: folder to watch.
+        ext: if not None, only files with this extension (or tuple of
+            extensions) are watched.
+    """
+    def __init__(self, path, ext=None):
+        self._path = path
+        self._ext = ext
+        self._snapshot = self._scan()
+
+    def _scan(self):
+        return {fn: (st.st_size, st.st_mtime_ns)
+                for fn, st in scanDir(self._path, ext=self._ext).items()}
+
+    def poll(self):
+        """ Return the set of file names that changed since the last poll. """
+        snapshot = self._scan()
+        changed = {fn for fn in snapshot.keys() | self._snapshot.keys()
+                   if snapshot.get(fn) != self._snapshot.get(fn)}
+        self._snapshot = snapshot
+        return changed
+
+
+class TrainingLogTailer(threading.Thread):
+    """ Follow the output of crYOLO training while it is running and
+    write one JSON line per finished epoch into the metrics file, with
+    the losses reported by Keras, the epoch duration and throughput.
+    """
+    EPOCH_RE = re.compile(r'^Epoch (\d+)/(\d+)')
+    STEPS_RE = re.compile(r'^\s*(\d+)/(\d+) \[')
+    SECS_RE = re.compile(r' - (\d+)s ')
+    METRIC_RE = re.compile(r'(\w+): ([-+]?\d*\.?\d+(?:[eE][-+]?\d+)?)')
+
+    def __init__(self, logFile, metricsFile, batchSize=None, echo=None,
+                 interval=5):
+        """
+        Params:
+            logFile: file where crYOLO output is being written.
+            metricsFile: JSON lines output file.
+            batchSize: if not None, used to compute images per second.
+            echo: if not None, function called with each output line
+                (excluding progress bar updates).
+            interval: seconds between checks for new output.
+        """
+        threading.Thread.__init__(self, daemon=True)
+        self.logFile = logFile
+        self.metricsFile = metricsFile
+        self.batchSize = batchSize
+        self.echo = echo
+        self.interval = interval
+        self._stopEvent = threading.Event()
+        self._offset = 0
+        self._pending = ''
+        self._epoch = None
+
+    def run(self):
+        while not self._stopEvent.wait(self.interval):
+            self.update()
+        self.update()
+        if self._pending:
+            self.parseLine(self._pending)
+            self._pending = ''
+
+    def stop(self):
+        self._stopEvent.set()
+        self.join()
+
+    def update(self):
+        """ Parse the new output since the last call. """
+        if not os.path.exists(self.logFile):
+            return
+
+        with open(self.logFile, errors='replace') as f:
+            f.seek(self._offset)
+            data = f.read()
+            self._offset = f.tell()
+
+        # Keras progress bar updates are separated by carriage returns
+        lines = (self._pending + data).replace('\r', '\n').split('\n')
+        self._pending = lines.pop()
+        for line in lines:
+            self.parseLine(line)
+
+    def parseLine(self, line):
+        m = self.EPOCH_RE.match(line)
+        if m:
+            self._epoch = {'epoch': int(m.group(1)),
+                           'epochs': int(m.group(2)),
+                           'start': time.time()}
+        elif self._epoch is not None and 'val_loss:' in line:
+            self._writeEpoch(line)
+        elif 'ETA:' in line or not line.strip():
+            return  # progress bar update
+
+        if self.echo:
+            self.echo(line)
+
+    def _writeEpoch(self, line):
+        epoch = self._epoch
+        self._epoch = None
+        record = {'epoch': epoch['epoch'], 'epochs': epoch['epochs']}
+        record.update((k, float(v)) for k, v in self.METRIC_RE.findall(line))
+        m = self.SECS_RE.search(line)
+        record['time'] = int(m.group(1)) if m else round(time.time() - epoch['start'], 2)
+        m = self.STEPS_RE.match(line)
+        if m and record['time']:
+            record['steps'] = int(m.group(2))
+            record['steps_per_sec'] = round(record['steps'] / record['time'], 3)
+            if self.batchSize:
+                record['images_per_sec'] = round(record['steps_per_sec'] * self.batchSize, 3)
+        record['timestamp'] = time.time()
+
+        with open(self.metricsFile, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+def readTrainingMetrics(metricsFile):
+    """ Read the epochs records written by TrainingLogTailer. """
+    if not os.path.exists(metricsFile):
+        return []
+
+    with open(metricsFile) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+MODEL_STORE = os.path.join(PROJECT_UPLOAD, 'cryolo_models')
+
+
+def storeModel(modelPath, outputPath, move=False):
+    """ Add the model file to the project models store and make
+    outputPath a link to it. Models are stored by the hash of their
+    content, so the same weights are only stored once.
+    Protocols are executed from the project folder, so the store path
+    is relative to it.
+    Params:
+        modelPath: model file to be stored.
+        outputPath: link that will point to the stored model.
+        move: if True, modelPath is moved (or removed if already stored),
+            otherwise it is copied.
+    Return the hash of the model.
+    """
+    modelHash = fileHash(modelPath)
+    storedPath = os.path.join(MODEL_STORE, modelHash + pwutils.getExt(modelPath))
+
+    if not os.path.exists(storedPath):
+        pwutils.makePath(MODEL_STORE)
+        tmpPath = f"{storedPath}.{os.getpid()}"
+        if move:
+            pwutils.moveFile(modelPath, tmpPath)
+        else:
+            pwutils.copyFile(modelPath, tmpPath)
+        os.replace(tmpPath, storedPath)
+    elif move:
+        pwutils.cleanPath(modelPath)
+
+    pwutils.cleanPath(outputPath)
+    pwutils.createAbsLink(os.path.abspath(storedPath), outputPath)
+
+    return modelHash
+
+
+def runMeasured(command, env=None, cwd=None, logFile=None):
+    """ Run the command (in a shell) and return the elapsed time
+    (in seconds) and the peak resident memory (in MB) of the process,
+    including its children. Raise an exception if the command fails.
+    """
+    out = open(logFile, 'a') if logFile else subprocess.DEVNULL
+    try:
+        t = time.time()
+        p = subprocess.Popen(command, shell=True, env=env, cwd=cwd,
+                             stdout=out, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(p.pid, 0)
+        elapsed = time.time() - t
+    finally:
+        if logFile:
+            out.close()
+
+    if os.waitstatus_to_exitcode(status):
+        raise Exception(f"Command failed: {command}")
+
+    return elapsed, usage.ru_maxrss / 1024  # ru_maxrss is in KB
+
+
+def benchmarkPredictor(makeCommand, images, workingDir, env=None):
+    """ Measure the startup time and the per-image latency of a
+    predictor that processes all images in a folder. The predictor runs
+    once with a single image and once with all images, so the startup
+    cost (e.g. loading the model) can be separated from the latency.
+    Params:
+        makeCommand: function receiving the input and output folders
+            and returning the command to run.
+        images: list of images paths (at least 2).
+        workingDir: folder where inputs, outputs and log are written.
+        env: environment to run the command.
+    Return a dict with the measurements.
+    """
+    if len(images) < 2:
+        raise ValueError("At least two images are required for benchmarking.")
+
+    logFile = os.path.join(workingDir, 'benchmark.log')
+    results = []
+
+    for n in [1, len(images)]:
+        inputDir = os.path.join(workingDir, 'input_%d' % n)
+        outputDir = os.path.join(workingDir, 'output_%d' % n)
+        pwutils.cleanPath(inputDir, outputDir)
+        pwutils.makePath(inputDir, outputDir)
+        for img in images[:n]:
+            pwutils.createAbsLink(os.path.abspath(img),
+                                  os.path.join(inputDir, os.path.basename(img)))
+        results.append(runMeasured(makeCommand(inputDir, outputDir),
+                                   env=env, logFile=logFile))
+
+    (t1, rss1), (tN, rssN) = results
+    latency = max(tN - t1, 0) / (len(images) - 1)
+
+    return {
+        'images': len(images),
+        'startup': round(max(t1 - latency, 0), 3),
+        'latency': round(latency, 3),
+        'total': round(tN, 3),
+        'peak_rss_mb': round(max(rss1, rssN), 1)
+    }
+
+
+class Tracer:
+    """ Record the processing stages (spans) of a streaming protocol
+    into a JSON lines file, one line per span with the stage name, its
+    start and end time and attributes as the batch index or the GPU.
+    Attributes set with the context method are added to all spans
+    recorded from the same thread. The total time per stage is also
+    accumulated, including the spans already in the file when resuming.
+    """
+    def __init__(self, traceFile):
+        self._traceFile = traceFile
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._stats = summarizeTrace(traceFile)
+
+    @contextmanager
+    def context(self, **attrs):
+        """ Add attrs to the spans recorded by this thread inside the
+        with block. """
+        old = getattr(self._local, 'attrs', {})
+        self._local.attrs = dict(old, **attrs)
+        try:
+            yield
+        finally:
+            self._local.attrs = old
+
+    @contextmanager
+    def span(self, stage, **attrs):
+        """ Record the time spent in the with block as the given stage. """
+        span = {'stage': stage}
+        span.update(getattr(self._local, 'attrs', {}))
+        span.update(attrs)
+        span['start'] = time.time()
+        try:
+            yield span
+        except Exception:
+            span['error'] = True
+            raise
+        finally:
+            span['end'] = time.time()
+            self._write(span)
+
+    def _write(self, span):
+        line = json.dumps(span) + '\n'
+        with self._lock:
+            with open(self._traceFile, 'a') as f:
+                f.write(line)
+            _addSpanStats(self._stats, span)
+
+    def getStats(self):
+        """ Return a copy of the stages stats (see summarizeTrace). """
+        with self._lock:
+            return {k: dict(v) for k, v in self._stats.items()}
+
+
+def _addSpanStats(stats, span):
+    s = stats.setdefault(span['stage'], {'count': 0, 'total': 0.0, 'max': 0.0})
+    elapsed = span['end'] - span['start']
+    s['count'] += 1
+    s['total'] += elapsed
+    s['max'] = max(s['max'], elapsed)
+
+
+def summarizeTrace(traceFile):
+    """ Return a dict with the number of spans, the total and the maximum
+    time (in seconds) of each stage in the trace file. Stages are kept
+    in the order they first appear. """
+    stats = {}
+    if os.path.exists(traceFile):
+        with open(traceFile) as f:
+            for line in f:
+                if line.strip():
+                    _addSpanStats(stats, json.loads(line))
+    return stats
+
+
+def formatTraceStats(stats):
+    """ Return one line per stage with its total time, percentage of
+    the total and mean time per span. """
+    total = sum(s['total'] for s in stats.values()) or 1
+    return [f"{stage}: {s['total']:0.1f} s ({s['total'] / total * 100:0.1f}%), "
+            f"mean {s['total'] / s['count']:0.2f} s, max {s['max']:0.2f} s"
+            for stage, s in stats.items()]
+
+
+class MetricsExporter(threading.Thread):
+    """ Keep counters, gauges and histograms of a running protocol and
+    periodically rewrite them into a text file in the Prometheus
+    exposition format, so they can be collected by monitoring tools
+    (e.g. node_exporter textfile collector).
+    """
+    COUNTER = 'counter'
+    GAUGE = 'gauge'
+    HISTOGRAM = 'histogram'
+
+    def __init__(self, metricsFile, labels=None, interval=15):
+        """
+        Params:
+            metricsFile: output file, it is replaced atomically.
+            labels: dict with labels added to all metrics (e.g. run).
+            interval: seconds between file updates.
+        """
+        threading.Thread.__init__(self, daemon=True)
+        self.metricsFile = metricsFile
+        self.labels = labels or {}
+        self.interval = interval
+        self._stopEvent = threading.Event()
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._collectors = []
+
+    def describe(self, name, mtype, description, buckets=None):
+        """ Register a new metric, histograms need the buckets upper bounds. """
+        self._metrics[name] = {'type': mtype, 'help': description, 'values': {},
+                               'buckets': sorted(buckets or [])}
+
+    def addCollector(self, func):
+        """ Add a function to be called before each update of the file,
+        e.g. to set gauges that are sampled. """
+        self._collectors.append(func)
+
+    def _key(self, labels):
+        return tuple(sorted((labels or {}).items()))
+
+    def inc(self, name, value=1, labels=None):
+        with self._lock:
+            values = self._metrics[name]['values']
+            key = self._key(labels)
+            values[key] = values.get(key, 0) + value
+
+    def set(self, name, value, labels=None):
+        with self._lock:
+            self._metrics[name]['values'][self._key(labels)] = value
+
+    def observe(self, name, value, labels=None):
+        with self._lock:
+            metric = self._metrics[name]
+            key = self._key(labels)
+            if key not in metric['values']:
+                metric['values'][key] = {'buckets': [0] * len(metric['buckets']),
+                                         'sum': 0.0, 'count': 0}
+            h = metric['values'][key]
+            for i, le in enumerate(metric['buckets']):
+                if value <= le:
+                    h['buckets'][i] += 1
+            h['sum'] += value
+            h['count'] += 1
+
+    def _formatLabels(self, key, **extra):
+        labels = dict(self.labels)
+        labels.update(key)
+        labels.update(extra)
+        if not labels:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('"', '\\"'))
+                                 for k, v in labels.items())
+
+    def render(self):
+        """ Return the metrics in the Prometheus text format. """
+        lines = []
+        with self._lock:
+            for name, metric in self._metrics.items():
+                lines.append(f"# HELP {name} {metric['help']}")
+                lines.append(f"# TYPE {name} {metric['type']}")
+                for key, value in metric['values'].items():
+                    if metric['type'] != self.HISTOGRAM:
+                        lines.append(f"{name}{self._formatLabels(key)} {value}")
+                        continue
+                    for le, count in zip(metric['buckets'], value['buckets']):
+                        lines.append(f"{name}_bucket{self._formatLabels(key, le=le)} {count}")
+                    lines.append(f"{name}_bucket{self._formatLabels(key, le='+Inf')} {value['count']}")
+                    lines.append(f"{name}_sum{self._formatLabels(key)} {value['sum']}")
+                    lines.append(f"{name}_count{self._formatLabels(key)} {value['count']}")
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        for collector in self._collectors:
+            collector()
+        # Write and rename, so the file is never read half written
+        tmpFile = f"{self.metricsFile}.{os.getpid()}.tmp"
+        with open(tmpFile, 'w') as f:
+            f.write(self.render())
+        os.replace(tmpFile, self.metricsFile)
+
+    def run(self):
+        while not self._stopEvent.wait(self.interval):
+            self.write()
+
+    def stop(self):
+        self._stopEvent.set()
+        self.join()
+        self.write()
@@ -24,6 +24,10 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # *
 # **************************************************************************
+import os
+import json
+import threading
+
 import pyworkflow.viewer as pwviewer
 import pyworkflow.utils as pwutils
 
@@ -37,10 +41,12 @@ class NapariViewer(pwviewer.Viewer):
     _environments = [pwviewer.DESKTOP_TKINTER]
     _targets = [tomo.objects.SetOfCoordinates3D]
     _name = "Open with Napari"
+    STATE_FILE = 'viewer_state.json'
 
     def __init__(self, **kwargs):
         pwviewer.Viewer.__init__(self, **kwargs)
         self._views = []
+        self._lock = threading.Lock()
 
     def _visualize(self, obj, **kwargs):
         views = []
@@ -49,19 +55,64 @@ class NapariViewer(pwviewer.Viewer):
         if issubclass(cls, tomo.objects.SetOfCoordinates3D):
             from .views_tkinter_tree import SphireGenericView
             tomoList = [tomo.clone() for tomo in obj.getPrecedents()]
-            tmpDir = self.generateCboxFiles(tomoList, obj)
-            setCoord3DView = SphireGenericView(self.getTkRoot(), tomoList, tmpDir)
+            tmpDir = self.getCboxDir(obj)
+            # Counts are taken from the set, files are generated when needed
+            tomoIdAttr = tomo.objects.Coordinate3D.TOMO_ID_ATTR
+            counts = {r[tomoIdAttr]: r['COUNT'] for r in
+                      obj.aggregate(['COUNT'], tomoIdAttr, [tomoIdAttr])}
+
+            def _prepareTomogram(tomogram):
+                self.prepareTomogram(tmpDir, obj, tomogram)
+
+            setCoord3DView = SphireGenericView(self.getTkRoot(), tomoList, tmpDir,
+                                               coordCounts=counts,
+                                               prepareItem=_prepareTomogram)
             views.append(setCoord3DView)
 
         return views
 
-    def generateCboxFiles(self, tomoList, coordinates3D):
-        """ Converts a set of coordinates to cbox files and tomograms to mrc. """
+    def getCboxDir(self, coordinates3D):
+        """ Return the folder with the tomograms and CBOX files of the set.
+        Files are kept between openings while the set is not modified. """
         tmpDir = self._getTmpPath(coordinates3D.getName())
-        pwutils.cleanPath(tmpDir)
-        pwutils.makePath(tmpDir)
+        key = self._getSetState(coordinates3D)
 
-        sphire.convert.convertMicrographs(tomoList, tmpDir)
-        sphire.convert.writeSetOfCoordinates3D(tmpDir, coordinates3D, tomoList)
+        with self._lock:
+            if self._readState(tmpDir).get('key') != key:
+                pwutils.cleanPath(tmpDir)
+                pwutils.makePath(tmpDir)
+                self._writeState(tmpDir, {'key': key, 'tomograms': []})
 
         return tmpDir
+
+    def prepareTomogram(self, tmpDir, coordinates3D, tomogram):
+        """ Link (or convert) the tomogram and write its CBOX file in
+        tmpDir, if not done before. """
+        with self._lock:
+            state = self._readState(tmpDir)
+            tsId = tomogram.getTsId()
+            if tsId in state['tomograms']:
+                return
+
+            sphire.convert.convertMicrographs([tomogram], tmpDir)
+            sphire.convert.writeTomogramCoordinates3D(tmpDir, coordinates3D,
+                                                      tomogram)
+            state['tomograms'].append(tsId)
+            self._writeState(tmpDir, state)
+
+    def _getSetState(self, coordinates3D):
+        """ Key identifying the modification state of the set. """
+        fn = os.path.abspath(coordinates3D.getFileName())
+        st = os.stat(fn)
+        return [fn, st.st_mtime_ns, st.st_size, coordinates3D.getSize()]
+
+    def _readState(self, tmpDir):
+        stateFn = os.path.join(tmpDir, self.STATE_FILE)
+        if not os.path.exists(stateFn):
+            return {}
+        with open(stateFn) as f:
+            return json.load(f)
+
+    def _writeState(self, tmpDir, state):
+        with open(os.path.join(tmpDir, self.STATE_FILE), 'w') as f:
+            json.dump(state, f)
@@ -35,12 +35,32 @@ import pyworkflow.utils as pwutils
 from tomo.viewers.views_tkinter_tree import TomogramsTreeProvider
 
 from sphire.constants import CRYOLO_SUPPORTED_FORMATS
+from sphire.utils import DirWatcher
+
+COORDS_EXTS = ('.cbox', '.coords')
 
 
 class SphireTomogramProvider(TomogramsTreeProvider):
-    def __init__(self, tomoList, path, mode=None, isInteractive=False):
+    def __init__(self, tomoList, path, mode=None, isInteractive=False,
+                 coordCounts=None):
+        """
+        Params:
+            coordCounts: optional dict with the number of coordinates by
+                TsId, used for tomograms without coordinates file yet.
+        """
         super().__init__(tomoList, path, mode)
         self.isInteractive = isInteractive
+        self.coordCounts = coordCounts
+        # Tomograms by TsId, so the status of each one is found directly
+        self._tomosIndex = {}
+        # Tomograms by the base name of their coordinates files
+        self._tomosByName = {}
+        for item in tomoList:
+            self._tomosIndex.setdefault(item.getTsId(), item)
+            self._tomosByName.setdefault(
+                pwutils.removeBaseExt(item.getFileName()), []).append(item)
+        # Number of coordinates by file, with the file size and mtime
+        self._countsCache = {}
 
     def getObjectInfo(self, tomo):
         key = tomo.getObjId()
@@ -61,22 +81,38 @@ class SphireTomogramProvider(TomogramsTreeProvider):
     def getObjStatus(self, tomo):
         values = []
         tags = 'pending' if self.isInteractive else 'done'
-        for item in self.tomoList:
-            if item.getTsId() == tomo.getTsId():
-                coordinatesFilePath = self.getCoordinatesFile(item, ext='cbox')
-                if not os.path.exists(coordinatesFilePath):
-                    coordinatesFilePath = self.getCoordinatesFile(item, ext='coords')
-                if os.path.exists(coordinatesFilePath):
-                    coordTable = self.getCoordsCount(coordinatesFilePath)
-                    values.append(str(coordTable))
-                    values.append('Done')
-                else:
-                    values.append('0')
-                    values.append('Pending')
+        item = self._tomosIndex.get(tomo.getTsId())
+        if item is not None:
+            coordinatesFilePath = self.getCoordinatesFile(item, ext='cbox')
+            if not os.path.exists(coordinatesFilePath):
+                coordinatesFilePath = self.getCoordinatesFile(item, ext='coords')
+            if os.path.exists(coordinatesFilePath):
+                coordTable = self.getCoordsCount(coordinatesFilePath)
+                values.append(str(coordTable))
+                values.append('Done')
+            elif self.coordCounts and self.coordCounts.get(item.getTsId()):
+                values.append(str(self.coordCounts[item.getTsId()]))
+                values.append('Done')
+            else:
+                values.append('0')
+                values.append('Pending')
         return values, tags
 
     def getCoordsCount(self, coordFilePath: str) -> int:
-        """Method to get the number of coordinates from a coordinates file"""
+        """Method to get the number of coordinates from a coordinates file.
+        Files are only read again if their size or modification time change.
+        """
+        st = os.stat(coordFilePath)
+        key = (st.st_size, st.st_mtime_ns)
+        cached = self._countsCache.get(coordFilePath)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        coordCount = self._readCoordsCount(coordFilePath)
+        self._countsCache[coordFilePath] = (key, coordCount)
+        return coordCount
+
+    def _readCoordsCount(self, coordFilePath):
         coordCount = 0
         ext = pwutils.getExt(coordFilePath)
         # Check the extension and count the corresponding coordinates
@@ -91,6 +127,13 @@ class SphireTomogramProvider(TomogramsTreeProvider):
 
         return coordCount
 
+    def getObjectsByFiles(self, fileNames):
+        """ Return the tomograms whose coordinates files are in fileNames. """
+        objs = []
+        for fn in fileNames:
+            objs.extend(self._tomosByName.get(pwutils.removeExt(fn), []))
+        return objs
+
     def getCoordinatesFile(self, item, ext='cbox'):
         cboxFileName = pwutils.replaceBaseExt(item.getFileName(), ext)
         coordinatesFilePath = os.path.join(self._path, cboxFileName)
@@ -99,9 +142,18 @@ class SphireTomogramProvider(TomogramsTreeProvider):
 
 
 class SphireListDialog(ToolbarListDialog):
-    def __init__(self, parent, provider, path, **kwargs):
+    def __init__(self, parent, provider, path, prepareItem=None, **kwargs):
+        """
+        Params:
+            prepareItem: optional function called with the tomogram before
+                opening it, e.g. to generate its files.
+        """
         self.provider = provider
         self.path = path
+        self.prepareItem = prepareItem
+        self.proc = None
+        # Coordinates files written by napari are found from here
+        self._watcher = DirWatcher(path, ext=COORDS_EXTS)
         ToolbarListDialog.__init__(self, parent,
                                    "Tomogram List", provider,
                                    allowsEmptySelection=False,
@@ -121,6 +173,9 @@ class SphireListDialog(ToolbarListDialog):
     def runNapariBoxmanager(self, tomogram):
         from sphire import Plugin, NAPARI_BOXMANAGER
         from sphire.convert import getMicFn
+        if self.prepareItem is not None:
+            self.prepareItem(tomogram)
+
         ext = pwutils.getExt(tomogram.getFileName())
 
         if ext in CRYOLO_SUPPORTED_FORMATS:
@@ -141,21 +196,38 @@ class SphireListDialog(ToolbarListDialog):
             Plugin.runNapariBoxManager(self.path, NAPARI_BOXMANAGER, args)
 
     def refresh_gui(self):
-        self.tree.update()
+        self.updateChangedItems()
         if self.proc.is_alive():
             self.after(1000, self.refresh_gui)
 
+    def updateChangedItems(self):
+        """ Update only the rows of the tomograms whose coordinates
+        files changed since the last refresh. """
+        changed = self._watcher.poll()
+        if not changed:
+            return
+
+        for tomo in self.provider.getObjectsByFiles(changed):
+            treeId = getattr(tomo, '_treeId', None)
+            if treeId is not None and self.tree.exists(treeId):
+                info = self.provider.getObjectInfo(tomo)
+                self.tree.item(treeId, values=info['values'], tags=info['tags'])
+
 
 class SphireGenericView(pwviewer.View):
     """ This class implements a view using Tkinter ToolbarListDialog
     and the SphireTomogramProvider.
     """
 
-    def __init__(self, parent, tomoList, path, isInteractive=False):
+    def __init__(self, parent, tomoList, path, isInteractive=False,
+                 coordCounts=None, prepareItem=None):
         self._tkParent = parent
         self._provider = SphireTomogramProvider(tomoList, path,
-                                                isInteractive=isInteractive)
+                                                isInteractive=isInteractive,
+                                                coordCounts=coordCounts)
         self._path = path
+        self._prepareItem = prepareItem
 
     def show(self):
-        SphireListDialog(self._tkParent, self._provider, self._path)
+        SphireListDialog(self._tkParent, self._provider, self._path,
+                         prepareItem=self._prepareItem)